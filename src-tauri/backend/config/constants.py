@@ -17,6 +17,10 @@ def get_store_value(key, default=None):
     except (FileNotFoundError, json.JSONDecodeError):
         return default
 
+def configured_embedding_model():
+    """The embedding model the settings ask for: RAG_EMBEDDING_MODEL, else the store's embeddingModel."""
+    return os.getenv("RAG_EMBEDDING_MODEL") or get_store_value("embeddingModel") or DEFAULT_EMBEDDING_MODEL_NAME
+
 # CONSTANTS =======================================================
 
 # Environment variable template for future reference
@@ -24,11 +28,15 @@ LLAMA_SERVER_URL = "http://localhost:8080/v1/chat/completions"
 CRAWL_SEMAPHORE = asyncio.Semaphore(16)
 APPDATA = os.getenv("APPDATA")  
 STORE_PATH = os.path.join(APPDATA, "com.haru.app", "store.json")
-MAX_CONTEXT_TOKENS = 3500
+MAX_CONTEXT_TOKENS = 3500  # RAG context budget when the LLM server's context size is unknown
+RAG_CONTEXT_SHARE = 0.6  # at most this share of the server's context window goes to retrieved passages
 TOKEN_ENCODER = tiktoken.encoding_for_model("gpt-3.5-turbo")
-EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+DEFAULT_EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"  # what stores that predate recording their model were embedded with
+# Changing it re-embeds every collection in the background (see RAGCollections.migrate_embedding_model)
+EMBEDDING_MODEL_NAME = configured_embedding_model()
 EMBEDDING_DEVICE = "cuda" if os.getenv("USE_GPU", "false").lower() in ("true", "1", "yes") else "cpu"
 MAX_WORKERS = 8
+PARSE_WORKERS = max(1, (os.cpu_count() or 2) - 1)  # document parser processes during index builds
 DEFAULT_MODEL = os.environ.get("LLAMA_MODEL", "your-model-name")
 # --- RAG System Settings ---
 MIN_RERANK_SCORE = 0.5
@@ -42,9 +50,62 @@ USE_GPU = os.getenv("USE_GPU", "false").lower() in ("true", "1", "yes")
 USE_8BIT_QUANTIZATION = True
 RERANKER_MODEL_NAME = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
 SUPPORTED_EXTS = {".pdf", ".docx", ".txt", ".md", ".csv"}
-RETRIEVAL_TOP_K = 20
+RETRIEVAL_TOP_K = 12  # after fusing dense and BM25 hits
 RERANK_TOP_K = 5
-WATCHER_DEBOUNCE_SECONDS = 2.0
+WATCHER_DEBOUNCE_SECONDS = 2.0  # quiet period before a batch of vault changes is applied
+WATCHER_MAX_BATCH_FILES = 256
+WATCHER_MAX_BATCH_DELAY_SECONDS = 10.0  # apply a batch even if events keep arriving
+SYNC_INDEX_ON_STARTUP = True  # re-embed files whose content changed while the app was closed
+RAG_INDEX_MODE = os.getenv("RAG_INDEX_MODE", "auto").lower()  # auto, flat, ivf_flat, ivf_pq, hnsw
+# Vector storage of the flat, ivf_flat and hnsw modes: none (float32), int8 or fp16
+INDEX_QUANTIZATION = os.getenv("RAG_INDEX_QUANTIZATION", "none").lower()
+INDEX_RESCORE_FACTOR = 4  # quantized indexes fetch this many times k candidates for exact float32 re-scoring
+IVF_MIN_VECTORS = 50_000  # auto mode: brute force below this many chunks
+IVF_PQ_MIN_VECTORS = 1_000_000  # auto mode: compress vectors with PQ above this many chunks
+IVF_NPROBE = 16
+HNSW_M = 32
+HNSW_EF_SEARCH = 64
+HNSW_MAX_EF_SEARCH = 1024  # upper bound for a per-request ef_search
+HNSW_EF_CONSTRUCTION = 80
+INDEX_TRAIN_SAMPLE_SIZE = 100_000
+INDEX_RETRAIN_GROWTH = 4.0  # retrain IVF centroids and int8/PQ codes once the corpus grows this much
+INDEX_REBUILD_DEAD_RATIO = 0.2  # rebuild when this share of vectors belongs to removed chunks
+INDEX_COMPACTION_INTERVAL_SECONDS = 60
+INDEX_COMPACTION_MIN_OPS = 200  # logged index operations before the next snapshot is written
+INDEX_DELTA_MAX_VECTORS = 20_000  # new vectors searched brute-force before they are merged into the base index
+INDEX_MMAP = True  # serve the base index memory-mapped from its on-disk snapshot
+INGEST_QUEUE_DEPTH = 2 * PARSE_WORKERS  # files parsed ahead of the embedding stage
+INGEST_PROCESS_POOL_MIN_FILES = 16  # smaller builds parse on threads instead of spawning processes
+INGEST_COMMIT_EVERY_FILES = 200
+RETRIEVAL_BATCH_WINDOW_MS = 3  # concurrent queries arriving this close together share one encode/search
+RETRIEVAL_MAX_BATCH = 32
+RERANK_DENSE_GAP = 0.25  # candidates this far below the best dense score skip the cross-encoder
+RERANK_BATCH_SIZE = 8
+RERANK_CONFIDENT_SCORE = 3.0  # stop cross-encoding once RERANK_TOP_K hits score at least this
+RERANK_CACHE_SIZE = 20_000
+RRF_K = 60  # reciprocal rank fusion constant for dense + BM25 results
+MMR_TOP_K = 8  # diverse candidates picked from the fused hits for the cross-encoder
+MMR_LAMBDA = 0.7  # maximal marginal relevance: weight of fused rank against redundancy
+MMR_KEEP_TOP = 2  # the best fused hits always reach the cross-encoder, however alike they are
+MMR_DUPLICATE_SIMILARITY = 0.99  # candidates this similar to a picked one are duplicates, never cross-encoded
+DEDUP_NEAR_SIMILARITY = 0.8  # chunks whose word 3-shingles overlap this much (Jaccard, by MinHash) are near duplicates
+DEDUP_MIN_WORDS = 24  # shorter chunks are only deduplicated when identical
+SCOPED_EXACT_MAX_VECTORS = 50_000  # filtered queries matching fewer chunks scan just their vectors exactly
+# Two-level retrieval: shortlist sections by their mean chunk vector, then search chunks only inside them
+HIERARCHICAL_RETRIEVAL = os.getenv("RAG_HIERARCHICAL_RETRIEVAL", "auto").lower()  # auto, on, off
+HIERARCHICAL_MIN_CHUNKS = 200_000  # auto: whole-vault queries go two-level above this many chunks
+HIERARCHICAL_SECTION_CHUNKS = 32  # consecutive chunks of a document averaged into one section vector
+HIERARCHICAL_TOP_SECTIONS = 64  # sections whose chunks the fine search scans
+RETRIEVAL_LATENCY_WINDOW = 1000  # recent queries kept per kind for the latency percentiles in /index-status
+ANSWER_CACHE_SIZE = 256  # generated /rag answers kept for repeated questions
+ANSWER_CACHE_SIMILARITY = 0.95  # cosine similarity at which a new query reuses a cached answer
+ANSWER_CACHE_TTL_SECONDS = 3600  # cached answers expire so newly added notes get a chance to be cited
+EMBEDDING_MIGRATION_BATCH = 256  # chunks re-embedded per step when switching embedding models
+EMBEDDING_MIGRATION_DUTY_CYCLE = 0.5  # share of wall time the re-embedding may use; it sleeps the rest
+MODEL_IDLE_UNLOAD_SECONDS = float(os.getenv("RAG_MODEL_IDLE_SECONDS", "900"))  # free unused models after this long (0: never)
+# Above this resident size the models are freed as soon as they are not in use (0: no budget)
+RAG_MEMORY_BUDGET_MB = int(os.getenv("RAG_MEMORY_BUDGET_MB", "0"))
+MEMORY_GOVERNOR_INTERVAL_SECONDS = 30
 
 # --- Web Scraper Settings ---
 # Constants and configs
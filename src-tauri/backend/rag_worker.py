@@ -3,20 +3,23 @@ import re
 import asyncio
 
 import httpx 
+import orjson
 import traceback
 
 from contextlib import asynccontextmanager
-from pathlib import Path
 
 from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
 from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 
-from config.constants import LLAMA_SERVER_URL
+from config.constants import LLAMA_SERVER_URL, MAX_CONTEXT_TOKENS, RAG_CONTEXT_SHARE, configured_embedding_model
 from config.prompts import LLM_PROMPT_TEMPLATE_BASIC, LLM_PROMPT_TEMPLATE_ADVANCED
 
-from utils.llm_utils import create_llm_payload,handle_non_streaming_llm_response,stream_unified_response
-from utils.rag_utils import RAGSystem
+from utils.llm_utils import create_llm_payload,handle_non_streaming_llm_response,stream_unified_response,stream_cached_response,fetch_context_size
+from utils.rag_collections_utils import RAGCollections
+from utils.rag_store_utils import normalize_filters
+from utils.rag_index_utils import normalize_search_breadth
+from utils.rag_context_utils import count_tokens, pack_context
 
 # ======================================================================================
 # --- CONFIGURATION (via Environment Variables with Defaults) ---
@@ -28,6 +31,72 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(
 http_client = None
 main_process = None
 
+# Words that lean on earlier turns ("what about its complexity?"); a query without any of them
+# and with a few words of its own is taken as standalone
+_REFERRING_WORDS = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|their|he|him|his|she|her|there|above|previous|"
+    r"former|latter|same|else|again)\b", re.IGNORECASE
+)
+_STANDALONE_MIN_WORDS = 4
+
+
+def _needs_rephrasing(query: str, messages: list) -> bool:
+    """False when there is no earlier conversation or the query reads as self-contained."""
+    prior = [m for m in (messages or []) if m and m.get("content")]
+    # The current query may be the last message of the history
+    if prior and isinstance(prior[-1].get("content"), str) and prior[-1]["content"].strip() == query.strip():
+        prior = prior[:-1]
+    if not prior:
+        return False
+    return len(re.findall(r"\w+", query)) < _STANDALONE_MIN_WORDS or bool(_REFERRING_WORDS.search(query))
+
+
+async def _retrieve(query: str, payload: dict, filters: dict, collections: list, query_embedding=None) -> list:
+    """
+    Retrieve for `query`, rephrased with the chat history when it needs it. Retrieval on the raw
+    query runs while the LLM rephrases, so the LLM call no longer delays finding candidates; if
+    the rephrase differs, the raw results are re-scored against it and merged with its own.
+    `query_embedding` is only used for a query that needs no rephrasing.
+    """
+    options = dict(nprobe=payload.get("nprobe"), ef_search=payload.get("ef_search"),
+                   filters=filters, collections=collections)
+    history_messages = payload.get("messages") or payload.get("history") or []
+    if not _needs_rephrasing(query, history_messages):
+        return await rag_system.retrieve_context(query, query_embedding=query_embedding, **options)
+
+    speculative = asyncio.create_task(rag_system.retrieve_context(query, **options))
+    try:
+        rephrased_query = await _rephrase_query_with_history(query, history_messages, payload.get("llm_config", {}))
+    finally:
+        raw_results = await speculative
+    if " ".join(rephrased_query.lower().split()) == " ".join(query.lower().split()):
+        return raw_results
+    logging.info(f"Merging retrieval for rephrased query: {rephrased_query}")
+    return await rag_system.retrieve_context(rephrased_query, seed_results=raw_results, **options)
+
+
+def _answer_settings(payload: dict, filters: dict, collections: list) -> bytes:
+    """Everything besides the query that shapes a /rag answer; cached answers must match it."""
+    return orjson.dumps({
+        "filters": filters, "collections": sorted(collections),
+        "advanced": bool(payload.get("use_advanced_prompt", True)),
+        "llm_config": payload.get("llm_config") or {},
+        "nprobe": payload.get("nprobe"), "ef_search": payload.get("ef_search"),
+    }, option=orjson.OPT_SORT_KEYS)
+
+
+async def _context_budget(template: str, query: str, llm_config: dict) -> int:
+    """
+    Tokens left for retrieved passages: the server's context window minus the prompt template,
+    the query and the answer, capped at RAG_CONTEXT_SHARE of the window.
+    """
+    n_ctx = await fetch_context_size(http_client, LLAMA_SERVER_URL)
+    if not n_ctx:
+        return MAX_CONTEXT_TOKENS
+    fixed = count_tokens(template.format(context="", query=query)) + int((llm_config or {}).get("max_tokens", 512))
+    return max(0, min(int(RAG_CONTEXT_SHARE * n_ctx), n_ctx - fixed))
+
+
 async def _rephrase_query_with_history(query: str, messages: list, llm_config: dict) -> str:
     """
     Use LLM to rewrite the query into a concise, standalone retrieval query using recent chat history.
@@ -86,8 +155,8 @@ async def lifespan(app: FastAPI):
     # Create shared HTTP client immediately
     http_client = httpx.AsyncClient(timeout=120.0)
 
-    # Initialize RAG system off the event loop to speed startup
-    rag_system = await asyncio.to_thread(RAGSystem)
+    # Initialize the RAG collections off the event loop to speed startup
+    rag_system = await asyncio.to_thread(RAGCollections)
 
     yield
 
@@ -122,14 +191,36 @@ async def rag_query_endpoint(payload: dict):
 
     if not query:
         raise HTTPException(status_code=400, detail="Query is missing")
+    try:
+        # Optional scope: path_prefix (relative to each collection), filename_glob, extension,
+        # page_from/page_to, modified_after; and which collections to search (default: all loaded)
+        filters = normalize_filters(payload.get("filters"))
+        collections = rag_system.select(payload.get("collections"))
+        nprobe, ef_search = normalize_search_breadth(payload.get("nprobe"), payload.get("ef_search"))
+        payload = {**payload, "nprobe": nprobe, "ef_search": ef_search}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     try:
-        # Build a rephrased retrieval query using prior conversation (if provided)
+        # A standalone question close enough to one answered before, from chunks that have not
+        # changed since, is served from the answer cache without retrieval or generation
+        answer_key = None
         history_messages = payload.get("messages") or payload.get("history") or []
-        rephrased_query = await _rephrase_query_with_history(query, history_messages, payload.get("llm_config", {}))
-
-        # Retrieve using the rephrased query
-        retrieved_chunks = await rag_system.retrieve_context(rephrased_query)
+        if collections and not _needs_rephrasing(query, history_messages):
+            answer_key = (await rag_system.embed_query(query), _answer_settings(payload, filters, collections),
+                          rag_system.generations(collections), rag_system.answer_cache.epoch)
+            cached = rag_system.answer_cache.get(*answer_key[:3])
+            if cached:
+                logging.info(f"Answer cache hit (similarity {cached['similarity']}).")
+                if stream:
+                    return await stream_cached_response(cached["content"], cached["sources"], isLocal=True)
+                return JSONResponse({"content": cached["content"], "sources": cached["sources"],
+                                     "context_tokens": cached["context_tokens"], "cached": True})
+
+        # Retrieve on the raw query while rephrasing with prior conversation (when it needs it);
+        # nprobe/ef_search optionally trade recall for speed
+        retrieved_chunks = await _retrieve(query, payload, filters, collections,
+                                           query_embedding=answer_key[0] if answer_key else None)
         
         unique_contents = set()
         deduplicated_chunks = [c for c in retrieved_chunks if c["content"] not in unique_contents and not unique_contents.add(c["content"])]
@@ -137,31 +228,47 @@ async def rag_query_endpoint(payload: dict):
         if not deduplicated_chunks:
             return JSONResponse({"content": "No relevant documents found.", "sources": []})
 
+        template = LLM_PROMPT_TEMPLATE_ADVANCED if payload.get("use_advanced_prompt", True) else LLM_PROMPT_TEMPLATE_BASIC
+        # Neighbouring chunks merge into one passage and passages fill a token budget, best first
+        budget = await _context_budget(template, query, payload.get("llm_config", {}))
+        context_string, passages, context_tokens = pack_context(deduplicated_chunks, budget)
+        logging.info(f"Packed {context_tokens['chunks']} chunks into {context_tokens['passages']} passages: "
+                     f"{context_tokens['packed_tokens']} tokens instead of {context_tokens['raw_tokens']} (budget {budget}).")
+
         final_sources = [
             {
                 "title": "",
                 "url": "",
-                "path": c["source"],
-                "section": c.get("id", f"chunk_{i}"),
-                "score": round(c.get("rerank_score", 0.0), 4)
+                "path": p["source"],
+                "section": p["ids"][0] if p["ids"][0] is not None else f"chunk_{i}",
+                "collection": p.get("collection"),
+                "score": round(p["score"], 4),
+                # Other files holding the same (or nearly the same) passage, indexed once
+                "duplicate_sources": p.get("duplicate_sources", [])
             }
-            for i, c in enumerate(deduplicated_chunks)
+            for i, p in enumerate(passages)
         ]
-        
-        context_parts = [f"[Source {i+1}: {Path(c['source']).name}]\n{c['content']}" for i, c in enumerate(deduplicated_chunks)]
-        context_string = "\n---\n".join(context_parts)
-        
-        template = LLM_PROMPT_TEMPLATE_ADVANCED if payload.get("use_advanced_prompt", True) else LLM_PROMPT_TEMPLATE_BASIC
+
         full_prompt = template.format(context=context_string, query=query)  # answer the original user query
         messages = [{"role": "user", "content": full_prompt}]
         payload_llm = await create_llm_payload(messages, stream=stream, llm_config=payload.get("llm_config", {}))
 
+        def remember_answer(answer: str):
+            if answer_key and answer:
+                embedding, settings, generations, epoch = answer_key
+                used_chunks = [(p.get("collection"), chunk_id) for p in passages for chunk_id in p["ids"]]
+                rag_system.answer_cache.put(embedding, settings, generations, used_chunks, answer,
+                                            final_sources, context_tokens, epoch=epoch)
+
         if stream:
-            return await stream_unified_response(http_client, payload_llm, LLAMA_SERVER_URL, final_sources, isLocal=True)
+            return await stream_unified_response(http_client, payload_llm, LLAMA_SERVER_URL, final_sources, isLocal=True,
+                                                 on_complete=lambda answer: remember_answer(
+                                                     re.sub(r'(\[Source \d+\])\1+', r"\1", answer.strip())))
         else:
             llm_data = await handle_non_streaming_llm_response(http_client, payload_llm, LLAMA_SERVER_URL)
             final_answer = re.sub(r'(\[Source \d+\])\1+', r"\1", llm_data.get("content", "").strip())
-            return JSONResponse({"content": final_answer, "sources": final_sources})
+            remember_answer(final_answer)
+            return JSONResponse({"content": final_answer, "sources": final_sources, "context_tokens": context_tokens})
 
     except httpx.RequestError as e:
         logging.error(f"RAG request to LLM server failed: {e}\n{traceback.format_exc()}")
@@ -200,6 +307,41 @@ def persist_index_endpoint():
     rag_system.persist_index()
     return JSONResponse(content={"message": "Index has been persisted to disk."})
 
+@app.get("/collections")
+def list_collections_endpoint():
+    return {"collections": rag_system.list()}
+
+@app.post("/collections/{name}")
+async def collection_action_endpoint(name: str, payload: dict):
+    # Unloading frees a rarely used collection's index and stores; queries naming it load it again
+    if name not in rag_system.shards:
+        raise HTTPException(status_code=404, detail=f"Unknown collection '{name}'")
+    action = payload.get("action", "").lower()
+    if action == "load":
+        await asyncio.to_thread(rag_system.load, name)
+        return JSONResponse({"message": f"Collection '{name}' loaded."})
+    if action == "unload":
+        await asyncio.to_thread(rag_system.unload, name)
+        return JSONResponse({"message": f"Collection '{name}' unloaded."})
+    raise HTTPException(status_code=400, detail="action must be 'load' or 'unload'")
+
+@app.post("/embedding-model", status_code=202)
+def embedding_model_endpoint():
+    # Applies the embeddingModel setting (saved from Settings > Advanced before this is called), so
+    # startup keeps the same model.
+    # Re-embeds in the background and keeps serving the current model; progress is in /index-status
+    try:
+        return {"migration": rag_system.migrate_embedding_model(configured_embedding_model())}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.get("/index-status")
+def index_status_endpoint():
+    # Includes the watcher's queue depth and lag, to spot ingestion falling behind
+    return rag_system.status()
+
 # ======================================================================================
 # --- ENTRY POINT ---
 # ======================================================================================
@@ -0,0 +1,50 @@
+import os
+import re
+import sys
+import tempfile
+import zlib
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# config.constants reads the app store under %APPDATA%
+os.environ.setdefault("APPDATA", tempfile.mkdtemp())
+
+
+class FakeEmbedder:
+    """
+    Bag-of-words embedder over letters only: "topic7" and "topic8" embed alike, as identifiers
+    often do with real models, so exact terms are left to BM25.
+    """
+
+    dim = 64
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def encode(self, texts, normalize_embeddings=True, **kwargs):
+        vectors = np.zeros((len(texts), self.dim), dtype="float32")
+        for row, text in enumerate(texts):
+            for word in re.findall(r"[a-z]+", text.lower()):
+                vectors[row, zlib.crc32(word.encode()) % self.dim] += 1
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms, norms, 1)
+
+
+class FakeReranker:
+    """Scores a (query, passage) pair by the number of query words the passage contains."""
+
+    def predict(self, pairs, **kwargs):
+        return np.array([len(set(query.lower().split()) & set(passage.lower().split()))
+                         for query, passage in pairs], dtype="float32")
+
+
+@pytest.fixture
+def fake_models(monkeypatch):
+    """Serve RAGSystem the fake models instead of downloading the real ones."""
+    import utils.rag_utils as rag_utils
+    monkeypatch.setattr(rag_utils, "acquire_models", lambda name: (FakeEmbedder(), name, FakeReranker(), {}))
+    monkeypatch.setattr(rag_utils, "release_models", lambda: None)
+    return FakeEmbedder()
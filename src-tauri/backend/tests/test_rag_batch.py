@@ -0,0 +1,33 @@
+import asyncio
+import threading
+
+import pytest
+
+from utils.rag_batch_utils import MicroBatcher
+
+
+def test_close_fails_queued_requests():
+    running, release = threading.Event(), threading.Event()
+
+    def handler(requests):
+        running.set()
+        release.wait(10)
+        return requests
+
+    batcher = MicroBatcher(handler, window_ms=0, max_batch=1)
+
+    async def scenario():
+        first = asyncio.ensure_future(batcher.submit("first"))
+        await asyncio.to_thread(running.wait, 10)
+        queued = asyncio.ensure_future(batcher.submit("queued"))
+        await asyncio.sleep(0)
+        batcher.close()
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(queued, 10)
+        release.set()
+        # The batch in progress still completes
+        assert await asyncio.wait_for(first, 10) == "first"
+        with pytest.raises(RuntimeError):
+            await batcher.submit("late")
+
+    asyncio.run(scenario())
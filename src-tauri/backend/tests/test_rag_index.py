@@ -0,0 +1,97 @@
+import faiss
+import numpy as np
+import pytest
+
+import utils.rag_index_utils as rag_index_utils
+from utils.rag_index_utils import (
+    create_index, is_memory_mapped, normalize_search_breadth, quantization_of, read_index, search_params
+)
+from utils.rag_utils import RAGSystem
+
+
+def _wait_for_compaction(system: RAGSystem):
+    if system._compact_thread:
+        system._compact_thread.join()
+
+
+def test_quantized_base_is_retrained_as_it_grows(tmp_path, fake_models, monkeypatch):
+    monkeypatch.setattr(rag_index_utils, "INDEX_QUANTIZATION", "int8")
+    vault = tmp_path / "vault"
+    vault.mkdir()
+    (vault / "note0.md").write_text("the first note about apples")
+    system = RAGSystem("growing", str(vault), str(tmp_path / "store"), autostart=False)
+    system.load_resources()
+    try:
+        system.build_index_from_directory()
+        _wait_for_compaction(system)
+        system.persist_index()
+        # int8 ranges fitted to a single vector
+        assert system.index_built_size == 1
+
+        words = ["pears", "plums", "grapes", "melons", "cherries", "lemons", "limes", "figs", "dates", "kiwis"]
+        for i, word in enumerate(words, start=1):
+            (vault / f"note{i}.md").write_text(f"note {i} is all about {word} and {word} recipes")
+        system.build_index_from_directory()
+        _wait_for_compaction(system)
+        system._maybe_compact_index()
+        _wait_for_compaction(system)
+        assert system.index_built_size == len(system.chunk_store) == len(words) + 1
+        assert quantization_of(system.index) == "int8"
+    finally:
+        system.cleanup()
+
+
+@pytest.mark.parametrize("quantization", ["none", "int8"])
+def test_flat_snapshot_is_mapped_in_place(tmp_path, quantization):
+    vectors = np.random.default_rng(0).random((500, 16), dtype="float32")
+    index = create_index("flat", 16, quantization=quantization)
+    index.train(vectors)
+    index.add_with_ids(vectors, np.arange(len(vectors)))
+    path = tmp_path / "faiss_index.1.bin"
+    faiss.write_index(index, str(path))
+
+    mapped = read_index(path, mmap=True)
+    assert is_memory_mapped(mapped)
+    assert not is_memory_mapped(read_index(path))
+    assert mapped.search(vectors[:3], 1)[1][:, 0].tolist() == index.search(vectors[:3], 1)[1][:, 0].tolist()
+
+
+def test_reloaded_collection_serves_and_compacts_a_mapped_base(tmp_path, fake_models):
+    vault = tmp_path / "vault"
+    vault.mkdir()
+    for i, word in enumerate(["apples", "pears", "plums"]):
+        (vault / f"note{i}.md").write_text(f"note {i} is about {word}")
+    system = RAGSystem("mapped", str(vault), str(tmp_path / "store"), autostart=False)
+    system.load_resources()
+    system.build_index_from_directory()
+    _wait_for_compaction(system)
+    system.cleanup()
+
+    system = RAGSystem("mapped", str(vault), str(tmp_path / "store"), autostart=False)
+    system.load_resources()
+    try:
+        assert system.status()["index_memory_mapped"]
+        (vault / "note3.md").write_text("note 3 is about figs")
+        system.build_index_from_directory()
+        _wait_for_compaction(system)
+        # Merging into a mapped base must copy it first; resizing the mapped codes would abort
+        system.persist_index()
+        assert system.index.ntotal == 4
+        assert not system.status()["index_memory_mapped"]
+    finally:
+        system.cleanup()
+
+
+def test_search_breadth_is_validated_and_clamped():
+    assert normalize_search_breadth(None, None) == (None, None)
+    assert normalize_search_breadth(8, 10 ** 9) == (8, rag_index_utils.HNSW_MAX_EF_SEARCH)
+    for bad in (0, -3, "16", 2.5, True):
+        with pytest.raises(ValueError):
+            normalize_search_breadth(bad, None)
+        with pytest.raises(ValueError):
+            normalize_search_breadth(None, bad)
+
+    vectors = np.random.default_rng(0).random((200, 16), dtype="float32")
+    ivf = faiss.IndexIVFFlat(faiss.IndexFlatIP(16), 16, 4, faiss.METRIC_INNER_PRODUCT)
+    ivf.train(vectors)
+    assert search_params(ivf, nprobe=10 ** 9).nprobe == 4
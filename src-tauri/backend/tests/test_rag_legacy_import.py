@@ -0,0 +1,34 @@
+import pickle
+
+import faiss
+
+import utils.rag_index_utils as rag_index_utils
+from utils.rag_index_utils import quantization_of
+from utils.rag_utils import RAGSystem
+
+
+def test_imports_baseline_store_into_quantized_index(tmp_path, fake_models, monkeypatch):
+    # int8 codes must be trained before anything can be added
+    monkeypatch.setattr(rag_index_utils, "INDEX_QUANTIZATION", "int8")
+    # The original layout: a plain IndexFlatIP and a pickled list of chunks aligned with it
+    vault = tmp_path / "vault"
+    chunks = [{"content": f"note {i} about topic{i}", "metadata": {"source": str(vault / f"note{i}.md")}}
+              for i in range(40)]
+    vectors = fake_models.encode([chunk["content"] for chunk in chunks])
+    index = faiss.IndexFlatIP(vectors.shape[1])
+    index.add(vectors)
+    persist_dir = tmp_path / "store"
+    persist_dir.mkdir()
+    faiss.write_index(index, str(persist_dir / "faiss_index.bin"))
+    with open(persist_dir / "doc_store.pkl", "wb") as f:
+        pickle.dump(chunks, f)
+
+    system = RAGSystem("legacy", str(vault), str(persist_dir), autostart=False)
+    system.load_resources()
+    try:
+        assert quantization_of(system.index) == "int8"
+        assert system._version.ntotal == len(chunks)
+        assert len(system.chunk_store) == len(chunks)
+        assert not (persist_dir / "doc_store.pkl").exists()
+    finally:
+        system.cleanup()
@@ -0,0 +1,113 @@
+import asyncio
+import threading
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from utils.rag_collections_utils import RAGCollections
+from utils.rag_rerank_utils import ScoreCache, cascade_rerank, mmr_select
+from utils.rag_utils import RAGSystem
+
+
+def test_mmr_keeps_top_hits_and_drops_only_duplicates():
+    vectors = np.array([[1.0, 0.0], [0.98, 0.199], [1.0, 0.0], [0.0, 1.0]], dtype="float32")
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    relevance = np.array([1.0, 0.75, 0.5, 0.25], dtype="float32")
+    picked = mmr_select(relevance, vectors, k=4, relevance_weight=0.7, duplicate_similarity=0.99, keep=2)
+    # Rows 0 and 1 are 0.98 alike but both kept; row 2 duplicates row 0
+    assert picked[:2] == [0, 1]
+    assert 2 not in picked and 3 in picked
+
+
+
+def test_cached_score_does_not_follow_a_handed_over_id():
+    cache = ScoreCache(100)
+    predict = lambda pairs: [len(passage) for _, passage in pairs]
+    first = cascade_rerank("q", [(1, {"content": "ab"}, 0.0)], predict, cache, 0, 8, 1, 1.0)
+    # The id now holds a near-duplicate from another file, with other text
+    second = cascade_rerank("q", [(1, {"content": "abcd"}, 0.0)], predict, cache, 0, 8, 1, 1.0)
+    assert first[0][2] == 2.0 and second[0][2] == 4.0
+
+
+@pytest.fixture
+def templated_vault(tmp_path):
+    """
+    Thirty notes from one template; only "topic<i> item<i>" tells them apart for BM25. Some
+    mention "item" more often, so dense search ranks them above note7 while ~0.98 alike to it.
+    """
+    vault = tmp_path / "vault"
+    vault.mkdir()
+    template = " ".join(f"common{j}" for j in range(30))
+    for i in range(30):
+        words = template.split()
+        for j in range(0, 30, 5):
+            words.insert(j + j // 5, f"unique{i}x{j}")
+        (vault / f"note{i}.md").write_text(" ".join(words) + " item" * (i % 3) + f" topic{i} item{i}")
+    return vault
+
+
+@pytest.mark.parametrize("filters", [None, {"path_prefix": "."}])
+def test_lexical_top_hit_survives_mmr(tmp_path, fake_models, templated_vault, filters):
+    # The fake embedder ignores digits, so only BM25 ranks note7 first
+    system = RAGSystem("templated", str(templated_vault), str(tmp_path / "store"), autostart=False)
+    system.load_resources()
+    try:
+        system.build_index_from_directory()
+        results = asyncio.run(system.retrieve_context("topic7 item7", filters=filters))
+        assert results and Path(results[0]["source"]).name == "note7.md"
+    finally:
+        system.cleanup()
+
+
+def test_rephrased_query_rescores_the_raw_results(tmp_path, fake_models, monkeypatch):
+    vault = tmp_path / "vault"
+    vault.mkdir()
+    (vault / "apples.md").write_text("apples grow on trees by the orchard")
+    (vault / "bananas.md").write_text("bananas ripen in warm weather")
+    monkeypatch.setattr(RAGCollections, "run", lambda self: None)
+    monkeypatch.setattr(RAGCollections, "_persist_dir", staticmethod(lambda name: tmp_path / "store" / name))
+    collections = RAGCollections({"notes": str(vault)})
+    collections.load("notes")
+    try:
+        # The raw query of a follow-up scores the apples note highly...
+        raw = asyncio.run(collections.retrieve_context("apples grow on trees"))
+        assert [Path(r["source"]).name for r in raw] == ["apples.md"]
+        # ...which says nothing about how it answers the rephrase
+        results = asyncio.run(collections.retrieve_context("bananas ripen in weather", seed_results=raw))
+        assert [Path(r["source"]).name for r in results] == ["bananas.md"]
+    finally:
+        collections.cleanup()
+
+
+def test_cleanup_waits_for_queries_in_flight(tmp_path, fake_models):
+    vault = tmp_path / "vault"
+    vault.mkdir()
+    (vault / "apples.md").write_text("apples grow on trees by the orchard")
+    system = RAGSystem("closing", str(vault), str(tmp_path / "store"), autostart=False)
+    system.load_resources()
+    system.build_index_from_directory()
+    reranking, release = threading.Event(), threading.Event()
+    predict = system.reranker.predict
+
+    def slow_predict(pairs, **kwargs):
+        reranking.set()
+        release.wait(10)
+        return predict(pairs, **kwargs)
+
+    system.reranker.predict = slow_predict
+    results = []
+    query = threading.Thread(target=lambda: results.append(asyncio.run(system.retrieve_context("apples"))))
+    query.start()
+    assert reranking.wait(10)
+    closing = threading.Thread(target=system.cleanup)
+    closing.start()
+    closing.join(0.2)
+    # The query still holds the chunk store and the reranker
+    assert closing.is_alive()
+    release.set()
+    query.join(10)
+    closing.join(10)
+    assert [Path(r["source"]).name for r in results[0]] == ["apples.md"]
+    with pytest.raises(RuntimeError):
+        asyncio.run(system.retrieve_context("apples"))
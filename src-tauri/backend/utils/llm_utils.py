@@ -128,21 +128,61 @@ async def handle_non_streaming_llm_response(client: httpx.AsyncClient, payload:
 
 import os
 
-async def stream_unified_response(client: httpx.AsyncClient, payload: dict, url: str, sources: list, isLocal: bool = False) -> StreamingResponse:
+_context_sizes = {}
+
+async def fetch_context_size(client: httpx.AsyncClient, url: str) -> int | None:
+    """
+    Context window (n_ctx) of the llama-server behind `url`, read from its /props endpoint and
+    cached once known. None when the server does not report it.
+    """
+    base = url.split("/v1/")[0].rstrip("/")
+    if base in _context_sizes:
+        return _context_sizes[base]
+    try:
+        resp = await client.get(f"{base}/props", timeout=2)
+        resp.raise_for_status()
+        props = orjson.loads(resp.content)
+        n_ctx = props.get("default_generation_settings", {}).get("n_ctx") or props.get("n_ctx")
+    except Exception as e:
+        logger.warning(f"Could not read the LLM context size from {base}/props: {e}")
+        return None
+    if isinstance(n_ctx, int) and n_ctx > 0:
+        _context_sizes[base] = n_ctx
+        return n_ctx
+    return None
+
+def _display_sources(sources: list, isLocal: bool) -> list:
+    # Transform sources if local
+    if not isLocal:
+        return sources
+    display_sources = []
+    for s in sources:
+        path = s.get("path", "")
+        if path:
+            # Get parent folder name and file name only
+            folder = os.path.basename(os.path.dirname(path))
+            filename = os.path.basename(path)
+            s = s.copy()  # avoid mutating original
+            s["path"] = f"{folder}\\{filename}"
+        display_sources.append(s)
+    return display_sources
+
+async def stream_cached_response(content: str, sources: list, isLocal: bool = False) -> StreamingResponse:
+    """Replay a stored answer with the same sources/token/end events as stream_unified_response."""
+    async def generate_sse():
+        yield f"event: sources\ndata: {orjson.dumps(_display_sources(sources, isLocal)).decode('utf-8')}\n\n"
+        if content:
+            yield f"event: token\ndata: {orjson.dumps(content).decode('utf-8')}\n\n"
+        yield "event: end\ndata: {}\n\n"
+
+    return StreamingResponse(generate_sse(), media_type='text/event-stream')
+
+async def stream_unified_response(client: httpx.AsyncClient, payload: dict, url: str, sources: list, isLocal: bool = False,
+                                  on_complete=None) -> StreamingResponse:
+    """`on_complete`, if given, receives the full answer text once the stream finishes without error."""
     async def generate_sse():
-        # Transform sources if local
-        display_sources = sources
-        if isLocal:
-            display_sources = []
-            for s in sources:
-                path = s.get("path", "")
-                if path:
-                    # Get parent folder name and file name only
-                    folder = os.path.basename(os.path.dirname(path))
-                    filename = os.path.basename(path)
-                    s = s.copy()  # avoid mutating original
-                    s["path"] = f"{folder}\\{filename}"
-                display_sources.append(s)
+        display_sources = _display_sources(sources, isLocal)
+        pieces = []
 
         try:
             yield f"event: sources\ndata: {orjson.dumps(display_sources).decode('utf-8')}\n\n"
@@ -183,8 +223,14 @@ async def stream_unified_response(client: httpx.AsyncClient, payload: dict, url:
                                 token_piece = obj.get("text")
 
                         if token_piece:
+                            pieces.append(token_piece)
                             yield f"event: token\ndata: {orjson.dumps(token_piece).decode('utf-8')}\n\n"
 
+                if on_complete is not None:
+                    try:
+                        on_complete("".join(pieces))
+                    except Exception as e:
+                        logger.error(f"Stream completion callback failed: {e}")
                 yield "event: end\ndata: {}\n\n"
 
         except httpx.RequestError as e:
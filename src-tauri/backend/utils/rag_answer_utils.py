@@ -0,0 +1,104 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+
+class AnswerCache:
+    """
+    Thread-safe LRU of generated /rag answers, found by query-embedding cosine similarity. An
+    entry is served only for the same request settings, while every collection it was answered
+    from keeps the index generation it had, and until one of its chunks is re-indexed, moved or
+    removed (chunk ids are never reused within a generation, so an edit always drops them).
+    """
+
+    def __init__(self, capacity: int, threshold: float, ttl: float):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        # (collection, chunk id) -> keys of the entries answered from that chunk
+        self._by_chunk = {}
+        self._next_key = 0
+        # Bumped by every invalidation, so an answer generated across one is not stored
+        self._epoch = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def epoch(self) -> int:
+        return self._epoch
+
+    def get(self, embedding: np.ndarray, settings: Hashable, generations: Dict[str, int]) -> Optional[Dict[str, Any]]:
+        """The most similar live entry at or above the threshold, or None."""
+        now = time.monotonic()
+        with self._lock:
+            best_key, best_score = None, self.threshold
+            for key, entry in list(self._entries.items()):
+                if now - entry["created"] > self.ttl:
+                    self._remove(key)
+                    continue
+                if entry["settings"] != settings or entry["generations"] != generations:
+                    continue
+                score = float(np.dot(entry["embedding"], embedding))
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._entries.move_to_end(best_key)
+            entry = self._entries[best_key]
+            return {"content": entry["content"], "sources": entry["sources"],
+                    "context_tokens": entry["context_tokens"], "similarity": round(best_score, 4)}
+
+    def put(self, embedding: np.ndarray, settings: Hashable, generations: Dict[str, int],
+            chunks: Iterable[Tuple[str, int]], content: str, sources: List[Dict[str, Any]],
+            context_tokens: Optional[Dict[str, int]] = None, epoch: Optional[int] = None):
+        """Store an answer; skipped when a chunk changed since `epoch` (taken before retrieval)."""
+        with self._lock:
+            if epoch is not None and epoch != self._epoch:
+                return
+            key, self._next_key = self._next_key, self._next_key + 1
+            chunks = frozenset(chunks)
+            self._entries[key] = {
+                "embedding": np.asarray(embedding, dtype="float32"), "settings": settings,
+                "generations": dict(generations), "chunks": chunks, "content": content,
+                "sources": sources, "context_tokens": context_tokens, "created": time.monotonic(),
+            }
+            for chunk in chunks:
+                self._by_chunk.setdefault(chunk, set()).add(key)
+            while len(self._entries) > self.capacity:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, collection: str, ids: Iterable[int]):
+        """Drop every answer that used one of these chunks of `collection`."""
+        with self._lock:
+            self._epoch += 1
+            for chunk_id in ids:
+                for key in self._by_chunk.pop((collection, int(chunk_id)), ()):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._by_chunk.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self._hits, "misses": self._misses}
+
+    def _remove(self, key: int):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for chunk in entry["chunks"]:
+            keys = self._by_chunk.get(chunk)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_chunk[chunk]
@@ -0,0 +1,77 @@
+import queue
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, List
+
+
+class MicroBatcher:
+    """
+    Collects requests that arrive within `window_ms` of each other and hands them to `handler`
+    as one list on a dedicated thread, so concurrent callers share a single model call instead of
+    queueing behind each other on the event loop. `handler` returns one result per request.
+    """
+
+    def __init__(self, handler: Callable[[List[Any]], List[Any]], window_ms: float, max_batch: int,
+                 name: str = "micro-batcher"):
+        self.handler = handler
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._closed = False
+        # Orders submit() against close(), so nothing is queued after the queue has been drained
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    async def submit(self, request: Any) -> Any:
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f"{self._thread.name} is closed")
+            self._queue.put((request, future))
+        return await asyncio.wrap_future(future)
+
+    def close(self):
+        """Stop the thread after the batch in progress; requests still queued fail with RuntimeError."""
+        with self._lock:
+            self._closed = True
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    item[1].set_exception(RuntimeError(f"{self._thread.name} was closed"))
+            self._queue.put(None)
+
+    def _loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            # Block for the first request only; then give stragglers a few ms to join
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=self.window)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            self._run(batch)
+
+    def _run(self, batch):
+        requests = [request for request, _ in batch]
+        try:
+            results = self.handler(requests)
+        except Exception as e:
+            logging.error(f"Batched request of {len(batch)} failed: {e}", exc_info=True)
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
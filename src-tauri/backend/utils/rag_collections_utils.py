@@ -0,0 +1,299 @@
+import re
+import asyncio
+import logging
+import threading
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from config.constants import (
+    DOCUMENTS_DIR, PERSIST_DIRECTORY, EMBEDDING_BATCH_SIZE, RERANK_TOP_K,
+    RETRIEVAL_BATCH_WINDOW_MS, RETRIEVAL_MAX_BATCH, ANSWER_CACHE_SIZE, ANSWER_CACHE_SIMILARITY,
+    ANSWER_CACHE_TTL_SECONDS, configured_embedding_model, get_store_value
+)
+from utils.rag_answer_utils import AnswerCache
+from utils.rag_batch_utils import MicroBatcher
+from utils.rag_migration_utils import MigrationProgress, ShadowIndex
+from utils.rag_models_utils import (
+    load_embedding_model, replace_embedding_model, embedding_model_name, memory_status
+)
+from utils.rag_utils import RAGSystem
+
+
+def load_collection_config() -> Dict[str, str]:
+    """
+    Collections as {name: documents directory}. Read from the app store: "ragCollections"
+    ({name: path}) or the "ragLocations" list of the Paths settings, named after each folder;
+    without either, the single DOCUMENTS_DIR vault is the "default" collection.
+    """
+    configured = get_store_value("ragCollections")
+    if isinstance(configured, dict) and configured:
+        return {_safe_name(name): str(path) for name, path in configured.items() if isinstance(path, str) and path}
+    collections = {}
+    locations = get_store_value("ragLocations")
+    if isinstance(locations, list):
+        for path in locations:
+            if not isinstance(path, str) or not path:
+                continue
+            name = base = _safe_name(Path(path).name)
+            suffix = 2
+            while name in collections:
+                name, suffix = f"{base}-{suffix}", suffix + 1
+            collections[name] = path
+    return collections or {"default": DOCUMENTS_DIR}
+
+
+def _safe_name(name: str) -> str:
+    # Collection names double as directory names under PERSIST_DIRECTORY
+    return re.sub(r"[^\w.-]+", "_", str(name)).strip("._") or "collection"
+
+
+class RAGCollections:
+    """
+    Named collections, each a RAGSystem shard with its own index, stores and watcher. Queries
+    fan out to the selected shards concurrently and merge by rerank score. A shard can be
+    unloaded to free its index and stores, and is loaded again on first use.
+    """
+
+    def __init__(self, collections: Optional[Dict[str, str]] = None):
+        collections = collections or load_collection_config()
+        self.shards = {
+            name: RAGSystem(name, path, self._persist_dir(name), autostart=False)
+            for name, path in collections.items()
+        }
+        self._load_lock = threading.Lock()
+        # Generated answers for repeated questions, dropped when a chunk they cite changes
+        self.answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_TTL_SECONDS)
+        for shard in self.shards.values():
+            shard.chunk_listeners.append(self.answer_cache.invalidate)
+        # Encodes a query once for every shard it fans out to
+        self._query_encoder = MicroBatcher(
+            self._encode_queries, RETRIEVAL_BATCH_WINDOW_MS, RETRIEVAL_MAX_BATCH, name="rag-query-encoder"
+        )
+        # Progress of the last embedding model migration, if any
+        self.migration = None
+        self._migration_lock = threading.Lock()
+        logging.info(f"RAG collections: {', '.join(f'{n} ({p})' for n, p in collections.items())}. "
+                     "Loading resources in the background...")
+        self.run()
+
+    @staticmethod
+    def _persist_dir(name: str) -> Path:
+        # The default collection keeps the original single-vault location, so its index is reused
+        return Path(PERSIST_DIRECTORY) if name == "default" else Path(PERSIST_DIRECTORY) / "collections" / name
+
+    @property
+    def is_running(self) -> bool:
+        return any(shard.is_running for shard in self.shards.values())
+
+    def run(self):
+        """
+        Load every collection in the background, one after another so syncs don't compete, then
+        start migrating to the configured embedding model if they were embedded with another.
+        """
+        def load_all():
+            for name in self.shards:
+                self.load(name)
+            migrating = self.migration is not None and self.migration.running
+            configured = configured_embedding_model()
+            if not migrating and embedding_model_name() not in (None, configured):
+                self.migrate_embedding_model(configured)
+
+        threading.Thread(target=load_all, daemon=True).start()
+
+    def load(self, name: str):
+        """Load a collection (index, stores, watcher) and sync it with its directory; blocking."""
+        shard = self.shards[name]
+        with self._load_lock:
+            if not shard.is_running:
+                shard._start()
+
+    def unload(self, name: str):
+        """Persist and free one collection; its models stay loaded while other collections use them."""
+        shard = self.shards[name]
+        with self._load_lock:
+            if shard.is_running:
+                shard.cleanup()
+
+    def select(self, names: Optional[List[str]]) -> List[str]:
+        """Validate requested collection names; None means every loaded collection."""
+        if names is None:
+            return [name for name, shard in self.shards.items() if shard.is_running]
+        if isinstance(names, str):
+            names = [names]
+        unknown = [name for name in names if name not in self.shards]
+        if unknown:
+            raise ValueError(f"Unknown collections: {', '.join(map(str, unknown))}")
+        return list(dict.fromkeys(names))
+
+    async def retrieve_context(self, query: str, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                               filters: Optional[Dict[str, Any]] = None,
+                               collections: Optional[List[str]] = None,
+                               seed_results: Optional[List[Dict[str, Any]]] = None,
+                               query_embedding: Optional[np.ndarray] = None) -> List[Dict[str, Any]]:
+        """
+        Search the selected collections (default: all loaded ones) and keep the best RERANK_TOP_K.
+        `seed_results` retrieved for another query (the raw query a rephrase came from) are
+        candidates too: the ones this search did not find again are cross-encoded against
+        `query` (at most RERANK_TOP_K pairs); their old scores are not comparable.
+        `query_embedding` is the query's embed_query() result when the caller already has it.
+        """
+        names = self.select(collections)
+        for name in names:
+            if not self.shards[name].is_running:
+                logging.info(f"Loading collection '{name}' on demand...")
+                await asyncio.to_thread(self.load, name)
+        if not names:
+            raise RuntimeError("Resources not loaded or index is not built. Please wait.")
+
+        if len(names) == 1:
+            results = {names[0]: await self.shards[names[0]].retrieve_context(
+                query, nprobe, ef_search, filters, query_embedding=query_embedding
+            )}
+        else:
+            embedding = query_embedding if query_embedding is not None else await self._query_encoder.submit(query)
+            outcomes = await asyncio.gather(*(
+                self.shards[name].retrieve_context(query, nprobe, ef_search, filters, query_embedding=embedding)
+                for name in names
+            ), return_exceptions=True)
+            results = {}
+            for name, outcome in zip(names, outcomes):
+                if isinstance(outcome, Exception):
+                    logging.error(f"Retrieval from collection '{name}' failed: {outcome}")
+                else:
+                    results[name] = outcome
+
+        # Scores come from the same cross-encoder, so they compare across collections
+        merged = {(name, r["id"]): {**r, "collection": name} for name, shard_results in results.items()
+                  for r in shard_results}
+        unseen = {}
+        for result in seed_results or []:
+            if (result["collection"], result["id"]) not in merged and result["collection"] in results:
+                unseen.setdefault(result["collection"], []).append(result)
+        for name, seeds in unseen.items():
+            for result in await asyncio.to_thread(self.shards[name].rescore, query, seeds):
+                merged[(name, result["id"])] = result
+        return sorted(merged.values(), key=lambda x: x["rerank_score"], reverse=True)[:RERANK_TOP_K]
+
+    async def embed_query(self, query: str) -> np.ndarray:
+        """Normalized query embedding, batched with concurrent queries."""
+        if not self.is_running:
+            raise RuntimeError("Resources not loaded or index is not built. Please wait.")
+        return await self._query_encoder.submit(query)
+
+    def generations(self, names: List[str]) -> Dict[str, int]:
+        """Index generation of each named collection; a forced rebuild starts a new one."""
+        return {name: self.shards[name]._index_generation for name in names}
+
+    def _encode_queries(self, queries: List[str]) -> List[np.ndarray]:
+        model = next(shard.embedding_model for shard in self.shards.values() if shard.embedding_model)
+        return list(np.asarray(model.encode(
+            queries, batch_size=EMBEDDING_BATCH_SIZE, normalize_embeddings=True, show_progress_bar=False
+        ), dtype="float32"))
+
+    def migrate_embedding_model(self, model_name: str) -> Dict[str, Any]:
+        """
+        Start re-embedding every loaded collection with `model_name` in the background. Queries
+        and indexing keep using the current model until all of them are re-embedded, then every
+        collection switches at once (they share one query embedding). Returns the progress.
+        """
+        with self._migration_lock:
+            if self.migration is not None and self.migration.running:
+                raise RuntimeError(f"Already migrating to {self.migration.model_name}.")
+            current = embedding_model_name()
+            if current is None:
+                raise RuntimeError("Resources not loaded or index is not built. Please wait.")
+            if model_name == current:
+                raise ValueError(f"Collections are already embedded with {model_name}.")
+            self.migration = MigrationProgress(model_name, current)
+        threading.Thread(target=self._migrate, args=(self.migration,), daemon=True, name="rag-migration").start()
+        return self.migration.snapshot()
+
+    def _migrate(self, progress: MigrationProgress):
+        try:
+            logging.info(f"Migrating collections from {progress.previous} to {progress.model_name}...")
+            model = load_embedding_model(progress.model_name)
+            shadows = {}
+            while True:
+                stale = self._unmigrated(shadows)
+                for name in stale:
+                    progress.set_pending(name, len(self.shards[name].chunk_store or ()))
+                for name in stale:
+                    shard = self.shards[name]
+                    try:
+                        shadows[name] = shard.build_shadow(model, progress.model_name, progress)
+                    except Exception:
+                        if shard.is_running:
+                            raise
+                        # Unloaded meanwhile; it is re-embedded when it is loaded again
+                        shadows.pop(name, None)
+                        progress.set_pending(name, 0)
+                if not stale and self._cut_over(shadows, model, progress):
+                    break
+            progress.set_state("done")
+            logging.info(f"Embedding model migration to {progress.model_name} finished.")
+        except Exception as e:
+            logging.error(f"Embedding model migration to {progress.model_name} failed: {e}", exc_info=True)
+            progress.fail(e)
+
+    def _unmigrated(self, shadows: Dict[str, ShadowIndex]) -> List[str]:
+        """Loaded collections without an up-to-date shadow (new, or force-rebuilt since)."""
+        return [name for name, shard in self.shards.items() if shard.is_running and
+                (name not in shadows or shadows[name].generation != shard._index_generation)]
+
+    def _cut_over(self, shadows: Dict[str, ShadowIndex], model, progress: MigrationProgress) -> bool:
+        """
+        Switch every loaded collection to its shadow and share the new model, with all of them
+        locked so no query embedding or indexed vector mixes the two models. False if a
+        collection was loaded or rebuilt in the meantime and needs a shadow first.
+        """
+        progress.set_state("cutting over")
+        with self._load_lock, ExitStack() as compaction_locks:
+            names = [name for name, shard in self.shards.items() if shard.is_running]
+            for name in names:
+                compaction_locks.enter_context(self.shards[name]._compaction_lock)
+            with ExitStack() as write_locks:
+                for name in names:
+                    write_locks.enter_context(self.shards[name]._write_lock)
+                if self._unmigrated(shadows):
+                    progress.set_state("embedding")
+                    return False
+                if not replace_embedding_model(model, progress.model_name):
+                    raise RuntimeError("Every collection was unloaded during the migration.")
+                retired = {name: self.shards[name].cut_over(shadows[name]) for name in names}
+                self.answer_cache.clear()
+            # Snapshots are written with only the compaction locks held, so queries and indexing resume
+            for name in names:
+                self.shards[name].finish_cut_over(shadows[name], retired[name])
+        return True
+
+    def build_index_from_directory(self, force_rebuild: bool = False, collections: Optional[List[str]] = None):
+        for name in self.select(collections) if collections else self.shards:
+            self.shards[name].build_index_from_directory(force_rebuild=force_rebuild)
+
+    def persist_index(self):
+        for shard in self.shards.values():
+            if shard.is_running:
+                shard.persist_index()
+
+    def cleanup(self):
+        for name in self.shards:
+            self.unload(name)
+
+    def list(self) -> List[Dict[str, Any]]:
+        return [
+            {"name": name, "path": str(shard.documents_dir), "loaded": shard.is_running}
+            for name, shard in self.shards.items()
+        ]
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "running": self.is_running,
+            "collections": {name: shard.status() for name, shard in self.shards.items()},
+            "answer_cache": self.answer_cache.stats(),
+            "embedding_model": embedding_model_name(),
+            "embedding_migration": self.migration.snapshot() if self.migration else None,
+            "memory": memory_status(),
+        }
@@ -0,0 +1,94 @@
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from config.constants import TOKEN_ENCODER, CHUNK_OVERLAP
+
+# Splitter overlap is at most CHUNK_OVERLAP characters; shorter matches are treated as chance
+_MIN_OVERLAP_CHARS = 16
+_PASSAGE_SEPARATOR = "\n---\n"
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    """Token count under the shared encoder; repeated chunks and headers are counted once."""
+    return len(TOKEN_ENCODER.encode(text, disallowed_special=()))
+
+
+def _strip_overlap(previous: str, text: str) -> str:
+    """Drop the head of `text` that repeats the tail of `previous` (splitter overlap)."""
+    for size in range(min(len(previous), len(text), 2 * CHUNK_OVERLAP), _MIN_OVERLAP_CHARS - 1, -1):
+        if previous.endswith(text[:size]):
+            return text[size:].lstrip()
+    return text
+
+
+def merge_adjacent(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Join retrieved chunks that are consecutive (by chunk_index) in the same source into one
+    passage with the overlap between them removed. Passages come best rerank score first.
+    """
+    groups = {}
+    for order, chunk in enumerate(chunks):
+        groups.setdefault((chunk.get("collection"), chunk["source"]), []).append((order, chunk))
+
+    passages = []
+    for (collection, source), members in groups.items():
+        members.sort(key=lambda member: (member[1].get("chunk_index") is None, member[1].get("chunk_index") or 0))
+        passage, last_index = None, None
+        for order, chunk in members:
+            index = chunk.get("chunk_index")
+            if passage is not None and index is not None and last_index is not None and index == last_index + 1:
+                passage["content"] += "\n" + _strip_overlap(passage["content"], chunk["content"])
+                passage["ids"].append(chunk.get("id"))
+                passage["score"] = max(passage["score"], chunk.get("rerank_score", 0.0))
+                passage["order"] = min(passage["order"], order)
+                passage["page_end"] = chunk.get("page_end", passage["page_end"])
+                passage["duplicate_sources"] = list(dict.fromkeys(
+                    passage["duplicate_sources"] + chunk.get("duplicate_sources", [])))
+            else:
+                passage = {
+                    "collection": collection, "source": source, "ids": [chunk.get("id")],
+                    "content": chunk["content"], "score": chunk.get("rerank_score", 0.0), "order": order,
+                    "page": chunk.get("page"), "page_end": chunk.get("page_end"), "heading": chunk.get("heading", ""),
+                    "duplicate_sources": list(chunk.get("duplicate_sources", [])),
+                }
+                passages.append(passage)
+            last_index = index
+    passages.sort(key=lambda p: (-p["score"], p["order"]))
+    return passages
+
+
+def _render(number: int, passage: Dict[str, Any]) -> str:
+    return f"[Source {number}: {Path(passage['source']).name}]\n{passage['content']}"
+
+
+def pack_context(chunks: List[Dict[str, Any]], budget: int) -> Tuple[str, List[Dict[str, Any]], Dict[str, int]]:
+    """
+    Build the prompt context from retrieved chunks within `budget` tokens: adjacent chunks are
+    merged, then passages are added best first while they fit (the best one is truncated if
+    it alone is over budget). Returns the context, the packed passages in source-number order
+    and token stats comparing it with joining every chunk as is.
+    """
+    raw_tokens = sum(
+        count_tokens(_render(i + 1, {"source": c["source"], "content": c["content"]})) for i, c in enumerate(chunks)
+    ) + count_tokens(_PASSAGE_SEPARATOR) * max(0, len(chunks) - 1)
+    separator_tokens = count_tokens(_PASSAGE_SEPARATOR)
+
+    packed, parts, used = [], [], 0
+    for passage in merge_adjacent(chunks):
+        part = _render(len(packed) + 1, passage)
+        cost = count_tokens(part) + (separator_tokens if parts else 0)
+        if used + cost > budget:
+            if packed:
+                continue
+            # Never send an empty context because the best passage alone is too long
+            part = TOKEN_ENCODER.decode(TOKEN_ENCODER.encode(part, disallowed_special=())[:budget])
+            cost = budget
+        packed.append(passage)
+        parts.append(part)
+        used += cost
+
+    stats = {"chunks": len(chunks), "passages": len(packed), "raw_tokens": raw_tokens,
+             "packed_tokens": used, "budget": budget}
+    return _PASSAGE_SEPARATOR.join(parts), packed, stats
@@ -0,0 +1,453 @@
+import os
+import math
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Iterable, Tuple
+
+import faiss
+import numpy as np
+
+from config.constants import (
+    RAG_INDEX_MODE, IVF_MIN_VECTORS, IVF_PQ_MIN_VECTORS,
+    IVF_NPROBE, HNSW_M, HNSW_EF_SEARCH, HNSW_MAX_EF_SEARCH, HNSW_EF_CONSTRUCTION,
+    INDEX_TRAIN_SAMPLE_SIZE, INDEX_QUANTIZATION, HIERARCHICAL_SECTION_CHUNKS
+)
+
+INDEX_MODES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+# Scalar quantizers for the flat, ivf_flat and hnsw modes; ivf_pq always stores PQ codes
+_SCALAR_QUANTIZERS = {"int8": "SQ8", "fp16": "SQfp16"}
+
+# faiss warns below ~39 training points per centroid; PQ codebooks need 256 centroids each
+_POINTS_PER_CENTROID = 39
+_PQ_TRAINING_POINTS = 256 * _POINTS_PER_CENTROID
+
+
+class VectorStore:
+    """
+    Append-only float32 side file where row i holds the embedding of FAISS id i.
+    It is the lossless source for training and migrating approximate indexes.
+    """
+
+    def __init__(self, path: Path, dim: int):
+        self.path = Path(path)
+        self.dim = dim
+        self._mmap = None
+
+    @property
+    def row_bytes(self) -> int:
+        return self.dim * 4
+
+    def __len__(self) -> int:
+        return self.path.stat().st_size // self.row_bytes if self.path.exists() else 0
+
+    def append(self, vectors: np.ndarray):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "ab") as f:
+            f.write(np.ascontiguousarray(vectors, dtype="float32").tobytes())
+        self._mmap = None
+
+    def truncate(self, rows: int):
+        """Drop trailing rows, e.g. ones written after the last consistent save."""
+        if len(self) > rows:
+            with open(self.path, "r+b") as f:
+                f.truncate(rows * self.row_bytes)
+            self._mmap = None
+
+    def sync(self):
+        """fsync appended rows before the chunk store commits the ids that point at them."""
+        if self.path.exists():
+            with open(self.path, "ab") as f:
+                os.fsync(f.fileno())
+
+    def clear(self):
+        self._mmap = None
+        if self.path.exists():
+            self.path.unlink()
+
+    def get(self, ids: Iterable[int]) -> np.ndarray:
+        ids = np.asarray(list(ids), dtype="int64")
+        if not len(ids):
+            return np.empty((0, self.dim), dtype="float32")
+        # Writers reset the map from other threads; keep a local reference to the one being read
+        mmap = self._mmap
+        if mmap is None or len(mmap) <= ids.max():
+            mmap = self._mmap = np.memmap(self.path, dtype="float32", mode="r", shape=(len(self), self.dim))
+        return np.array(mmap[ids])
+
+
+class DeltaBuffer:
+    """
+    Append-only vectors (with their FAISS ids) added since the base index was built. Rows are
+    never rewritten, so a published IndexVersion keeps reading its prefix while the writer
+    appends behind it; growing copies into a new buffer and leaves older versions untouched.
+    """
+
+    def __init__(self, dim: int, capacity: int = 1024):
+        self.dim = dim
+        self.vectors = np.empty((capacity, dim), dtype="float32")
+        self.ids = np.empty(capacity, dtype="int64")
+        self.size = 0
+
+    def append(self, vectors: np.ndarray, ids: np.ndarray) -> "DeltaBuffer":
+        """Append rows; returns the buffer to use from now on (a new one if this one was full)."""
+        buffer = self
+        if self.size + len(ids) > len(self.ids):
+            buffer = self.tail(0, capacity=max(2 * len(self.ids), self.size + len(ids)))
+        end = buffer.size + len(ids)
+        buffer.vectors[buffer.size:end] = vectors
+        buffer.ids[buffer.size:end] = ids
+        buffer.size = end
+        return buffer
+
+    def tail(self, start: int, capacity: int = 1024) -> "DeltaBuffer":
+        """A new buffer holding the rows from `start` on, e.g. those not folded into a new base."""
+        rows = self.size - start
+        buffer = DeltaBuffer(self.dim, max(capacity, rows))
+        buffer.vectors[:rows] = self.vectors[start:self.size]
+        buffer.ids[:rows] = self.ids[start:self.size]
+        buffer.size = rows
+        return buffer
+
+
+class IndexVersion:
+    """
+    What a query sees: a base index that is never modified once published, plus a fixed
+    prefix of the delta buffer, the vector side file, the embedding model and the chunk store
+    they belong to. Readers take the current version with a plain attribute read and search it
+    without locks; writers publish a new version instead of mutating one.
+    """
+
+    def __init__(self, base, delta: DeltaBuffer, number: int, generation: int,
+                 vectors: Optional[VectorStore] = None, model=None, chunk_store=None):
+        self.base = base
+        self.delta = delta
+        self.delta_size = delta.size
+        self.number = number
+        self.generation = generation
+        self.vectors = vectors
+        self.model = model
+        self.chunk_store = chunk_store
+
+    @property
+    def ntotal(self) -> int:
+        return self.base.ntotal + self.delta_size
+
+    def search(self, queries: np.ndarray, k: int, params=None, allowed: Optional[np.ndarray] = None):
+        """
+        Top-k inner products over base and delta, in faiss' (distances, ids) layout. `allowed`
+        restricts the delta rows to those ids; the base is restricted by a selector in `params`.
+        """
+        if self.base.ntotal:
+            distances, ids = self.base.search(queries, k, params=params)
+        else:
+            # An empty base may not be trained yet, and searching an untrained index raises
+            distances = np.full((len(queries), k), -np.inf, dtype="float32")
+            ids = np.full((len(queries), k), -1, dtype="int64")
+        delta_vectors, delta_ids = self.delta.vectors[:self.delta_size], self.delta.ids[:self.delta_size]
+        if allowed is not None:
+            keep = np.isin(delta_ids, allowed)
+            delta_vectors, delta_ids = delta_vectors[keep], delta_ids[keep]
+        if not len(delta_ids):
+            return distances, ids
+        scores = queries @ delta_vectors.T
+        top = min(k, len(delta_ids))
+        rows = np.argpartition(-scores, top - 1, axis=1)[:, :top]
+        distances = np.concatenate([distances, np.take_along_axis(scores, rows, axis=1)], axis=1)
+        ids = np.concatenate([ids, delta_ids[rows]], axis=1)
+        order = np.argsort(-distances, axis=1)[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+class SectionIndex:
+    """
+    Coarse index of one vector per section, a run of HIERARCHICAL_SECTION_CHUNKS consecutive
+    chunks of a document: the normalized mean of their vectors. Used to shortlist the sections
+    a query's chunk search runs in. Small enough to search exhaustively; updates and searches
+    are serialized by a lock.
+    """
+
+    def __init__(self, dim: int):
+        self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+        self._blocks = {}  # source id -> section blocks in the index
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._index.ntotal
+
+    @staticmethod
+    def _key(source_id: int, block: int) -> int:
+        return (source_id << 24) | block
+
+    def replace_source(self, source_id: int, centroids: Dict[int, np.ndarray]):
+        with self._lock:
+            self._remove(source_id)
+            if centroids:
+                blocks = sorted(centroids)
+                self._index.add_with_ids(np.stack([centroids[b] for b in blocks]).astype("float32"),
+                                         np.array([self._key(source_id, b) for b in blocks], dtype="int64"))
+                self._blocks[source_id] = blocks
+
+    def remove_source(self, source_id: int):
+        with self._lock:
+            self._remove(source_id)
+
+    def _remove(self, source_id: int):
+        blocks = self._blocks.pop(source_id, None)
+        if blocks:
+            self._index.remove_ids(np.array([self._key(source_id, b) for b in blocks], dtype="int64"))
+
+    def search(self, queries: np.ndarray, k: int) -> List[List[Tuple[int, int]]]:
+        """The top-k (source id, block) sections per query."""
+        with self._lock:
+            if not self._index.ntotal:
+                return [[] for _ in queries]
+            _, keys = self._index.search(queries, min(k, self._index.ntotal))
+        return [[(int(key) >> 24, int(key) & 0xFFFFFF) for key in row if key != -1] for row in keys]
+
+
+def section_centroids(chunk_indexes: Iterable[int], vectors: np.ndarray) -> Dict[int, np.ndarray]:
+    """Normalized mean vector per section block (chunk_index // HIERARCHICAL_SECTION_CHUNKS)."""
+    groups = {}
+    for row, chunk_index in enumerate(chunk_indexes):
+        groups.setdefault(chunk_index // HIERARCHICAL_SECTION_CHUNKS, []).append(row)
+    centroids = {}
+    for block, rows in groups.items():
+        mean = vectors[rows].mean(axis=0)
+        centroids[block] = mean / max(float(np.linalg.norm(mean)), 1e-12)
+    return centroids
+
+
+def read_index(path: Path, mmap: bool = False):
+    """
+    Read an index from disk. With `mmap` the stored codes (flat, scalar-quantized, HNSW storage
+    and IVF lists) are used in place from a read-only mapping, so loading is near instant and
+    pages are faulted in by the OS as queries touch them; such an index can be searched but not
+    modified or cloned. Whether that worked is told by is_memory_mapped().
+    """
+    if mmap:
+        try:
+            # IO_FLAG_MMAP alone maps only IVF lists and copies flat codes into memory
+            return faiss.read_index(str(path), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError as e:
+            logging.warning(f"Memory-mapped load of {Path(path).name} failed, reading it into memory: {e}")
+    return faiss.read_index(str(path))
+
+
+def is_memory_mapped(index) -> bool:
+    """
+    True if the codes of `index` live in a file mapping rather than in process memory. Such codes
+    are a view that faiss aborts the process on resizing, so the index and its clones stay read-only.
+    """
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else faiss.downcast_index(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        inner = faiss.downcast_index(inner.storage)
+    try:
+        if isinstance(inner, faiss.IndexIVF):
+            invlists = faiss.downcast_InvertedLists(inner.invlists)
+            if isinstance(invlists, faiss.OnDiskInvertedLists):
+                return True
+            codes = invlists.codes
+            return not all(codes.at(i).is_owned for i in range(codes.size()))
+        return not inner.codes.is_owned
+    except AttributeError:
+        # Index types without flat codes, or a faiss build without zero-copy loading
+        return False
+
+
+def choose_index_mode(ntotal: int, requested: str = RAG_INDEX_MODE) -> str:
+    """Resolve the configured mode against the corpus size; falls back to flat while too small to train."""
+    if requested == "auto":
+        if ntotal >= IVF_PQ_MIN_VECTORS:
+            requested = "ivf_pq"
+        elif ntotal >= IVF_MIN_VECTORS:
+            requested = "ivf_flat"
+        else:
+            return "flat"
+    if requested == "ivf_pq" and ntotal < max(_PQ_TRAINING_POINTS, _nlist(ntotal) * _POINTS_PER_CENTROID):
+        requested = "ivf_flat"
+    if requested == "ivf_flat" and ntotal < _nlist(ntotal) * _POINTS_PER_CENTROID:
+        requested = "flat"
+    if requested not in INDEX_MODES:
+        logging.warning(f"Unknown RAG index mode '{requested}', using flat.")
+        return "flat"
+    return requested
+
+
+def _nlist(ntotal: int) -> int:
+    # Usual rule of thumb: ~4 * sqrt(n) inverted lists
+    return max(1, min(65536, int(4 * math.sqrt(max(ntotal, 1)))))
+
+
+def _pq_subquantizers(d: int) -> int:
+    # Prefer ~8 dimensions per sub-quantizer; m must divide d
+    for m in (d // 8, 64, 48, 32, 24, 16, 12, 8, 4):
+        if m > 0 and d % m == 0:
+            return m
+    return 1
+
+
+def create_index(mode: str, d: int, ntotal: int = 0, quantization: Optional[str] = None):
+    """
+    Build an empty inner-product index for `mode`. Every index accepts add_with_ids:
+    IVF indexes carry ids natively, flat and HNSW are wrapped in an IDMap2. With an
+    int8/fp16 `quantization` the flat, ivf_flat and hnsw modes store scalar-quantized codes
+    (4x/2x smaller than float32); int8 codes need training like IVF centroids do. The default
+    is RAG_INDEX_QUANTIZATION.
+    """
+    sq = _SCALAR_QUANTIZERS.get(quantization or INDEX_QUANTIZATION)
+    if mode == "ivf_flat":
+        return faiss.index_factory(d, f"IVF{_nlist(ntotal)},{sq or 'Flat'}", faiss.METRIC_INNER_PRODUCT)
+    if mode == "ivf_pq":
+        return faiss.index_factory(d, f"IVF{_nlist(ntotal)},PQ{_pq_subquantizers(d)}", faiss.METRIC_INNER_PRODUCT)
+    if mode == "hnsw":
+        index = faiss.index_factory(d, f"IDMap2,HNSW{HNSW_M}{'_' + sq if sq else ''}", faiss.METRIC_INNER_PRODUCT)
+        faiss.downcast_index(index.index).hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        return index
+    return faiss.index_factory(d, f"IDMap2,{sq or 'Flat'}", faiss.METRIC_INNER_PRODUCT)
+
+
+def index_mode_of(index) -> str:
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(inner, faiss.IndexIVF):
+        return "ivf_flat"
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+
+def quantization_of(index) -> str:
+    """How `index` stores vectors: "none" (float32), "int8", "fp16" or "pq"."""
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexHNSW):
+        inner = faiss.downcast_index(inner.storage)
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return "pq"
+    if isinstance(inner, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return "fp16" if inner.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "int8"
+    return "none"
+
+
+def wanted_quantization(mode: str) -> str:
+    """The storage `create_index` uses for `mode` under the current settings."""
+    if mode == "ivf_pq":
+        return "pq"
+    return INDEX_QUANTIZATION if INDEX_QUANTIZATION in _SCALAR_QUANTIZERS else "none"
+
+
+def needs_training(index) -> bool:
+    """IVF centroids and int8/PQ codes are fitted to the vectors they were trained on."""
+    return index_mode_of(index).startswith("ivf") or quantization_of(index) in ("int8", "pq")
+
+
+def supports_removal(index) -> bool:
+    """HNSW graphs cannot delete nodes; removed ids stay in the graph until the next rebuild."""
+    return index_mode_of(index) != "hnsw"
+
+
+def train_index(index, vector_store: VectorStore, ids: np.ndarray):
+    """Train an IVF or int8 index on a random sample of the live vectors."""
+    if index.is_trained or not len(ids):
+        return
+    rng = np.random.default_rng(0)
+    sample_ids = np.sort(rng.choice(ids, size=min(len(ids), INDEX_TRAIN_SAMPLE_SIZE), replace=False))
+    logging.info(f"Training {index_mode_of(index)} index on {len(sample_ids)} sampled vectors...")
+    index.train(vector_store.get(sample_ids))
+
+
+def build_index(mode: str, vector_store: VectorStore, ids: np.ndarray, batch_size: int = 65536):
+    """Create, train and fill an index of `mode` from the vectors of `ids`."""
+    index = create_index(mode, vector_store.dim, len(ids))
+    train_index(index, vector_store, ids)
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        index.add_with_ids(vector_store.get(batch), batch)
+    return index
+
+
+def rescore(vector_store: VectorStore, queries: np.ndarray, ids: np.ndarray, k: int):
+    """
+    Re-rank candidate ids from a quantized search by their exact float32 inner product, read
+    from the memory-mapped vector side file. Same (distances, ids) layout as faiss; -1 pads.
+    """
+    valid = ids >= 0
+    scores = np.full(ids.shape, -np.inf, dtype="float32")
+    if valid.any():
+        rows = np.repeat(np.arange(len(queries)), valid.sum(axis=1))
+        scores[valid] = np.einsum("ij,ij->i", queries[rows], vector_store.get(ids[valid]))
+    order = np.argsort(-scores, axis=1)[:, :k]
+    scores, ids = np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+    ids[np.isneginf(scores)] = -1
+    return scores, ids
+
+
+def exact_search(vector_store: VectorStore, ids: np.ndarray, queries: np.ndarray, k: int, batch_size: int = 65536):
+    """Brute-force top-k over the float32 vectors of `ids`; the ground truth for recall checks."""
+    best_scores = np.full((len(queries), 0), -np.inf, dtype="float32")
+    best_ids = np.empty((len(queries), 0), dtype="int64")
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        scores = np.concatenate([best_scores, queries @ vector_store.get(batch).T], axis=1)
+        candidates = np.concatenate([best_ids, np.broadcast_to(batch, (len(queries), len(batch)))], axis=1)
+        order = np.argsort(-scores, axis=1)[:, :k]
+        best_scores = np.take_along_axis(scores, order, axis=1)
+        best_ids = np.take_along_axis(candidates, order, axis=1)
+    return best_scores, best_ids
+
+
+def measure_recall(index, vector_store: VectorStore, ids: np.ndarray, k: int, rescore_factor: int,
+                   sample_size: int = 64, params=None) -> dict:
+    """
+    Recall@k of `index` against exact float32 search, with and without re-scoring
+    `rescore_factor * k` candidates, using a sample of stored vectors as queries.
+    """
+    if not len(ids):
+        return {}
+    rng = np.random.default_rng(0)
+    queries = vector_store.get(rng.choice(ids, size=min(len(ids), sample_size), replace=False))
+    k = min(k, len(ids))
+    _, truth = exact_search(vector_store, ids, queries, k)
+    _, candidates = index.search(queries, rescore_factor * k, params=params)
+    _, rescored = rescore(vector_store, queries, candidates, k)
+
+    def recall(found):
+        return float(np.mean([len(set(f) & set(t)) / k for f, t in zip(found.tolist(), truth.tolist())]))
+
+    return {"k": k, "raw": round(recall(candidates[:, :k]), 4), "rescored": round(recall(rescored), 4)}
+
+
+def normalize_search_breadth(nprobe, ef_search) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Validate per-request nprobe/ef_search from a request; raises ValueError unless each is
+    absent or a positive integer. ef_search is capped at HNSW_MAX_EF_SEARCH; search_params()
+    caps nprobe at the list count of the index it searches.
+    """
+    def positive(name, value):
+        if value is None:
+            return None
+        if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+            raise ValueError(f"{name} must be a positive integer")
+        return value
+
+    nprobe, ef_search = positive("nprobe", nprobe), positive("ef_search", ef_search)
+    if ef_search is not None:
+        ef_search = min(ef_search, HNSW_MAX_EF_SEARCH)
+    return nprobe, ef_search
+
+
+def search_params(index, nprobe: Optional[int] = None, ef_search: Optional[int] = None, selector=None):
+    """
+    Per-request search parameters; thread-safe, unlike setting nprobe/efSearch on the index.
+    `selector` (a faiss.IDSelector) limits the search to its ids; the caller keeps it alive.
+    nprobe and ef_search are clamped to what the index can use.
+    """
+    mode = index_mode_of(index)
+    if mode in ("ivf_flat", "ivf_pq"):
+        nlist = faiss.extract_index_ivf(index).nlist
+        return faiss.SearchParametersIVF(nprobe=max(1, min(int(nprobe or IVF_NPROBE), nlist)), sel=selector)
+    if mode == "hnsw":
+        ef_search = max(1, min(int(ef_search or HNSW_EF_SEARCH), HNSW_MAX_EF_SEARCH))
+        return faiss.SearchParametersHNSW(efSearch=ef_search, sel=selector)
+    return faiss.SearchParameters(sel=selector) if selector is not None else None
@@ -0,0 +1,261 @@
+import re
+import csv
+import hashlib
+import logging
+import unicodedata
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Tuple, Iterator, Iterable
+
+import numpy as np
+
+from config.constants import CHUNK_SIZE, CHUNK_OVERLAP, DEDUP_MIN_WORDS
+
+# Parsing runs in pool worker processes: keep this module free of model imports so
+# spawning a worker stays cheap, and build the splitter once per process.
+_text_splitter = None
+
+
+def _get_text_splitter():
+    global _text_splitter
+    if _text_splitter is None:
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+        _text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    return _text_splitter
+
+
+def _element(content: str, category: str = None, depth: int = 0, page_number: int = None) -> Dict[str, Any]:
+    return {"content": content, "category": category, "depth": depth, "page_number": page_number}
+
+
+_MD_HEADING = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_MD_FENCE = re.compile(r"^\s*(```|~~~)")
+
+
+def _parse_markdown(path: Path) -> Iterator[Dict[str, Any]]:
+    """Stream ATX headings as titles and blank-line separated blocks as text; fenced code stays whole."""
+    block, in_fence = [], False
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            if _MD_FENCE.match(line):
+                in_fence = not in_fence
+                block.append(line)
+                continue
+            if in_fence:
+                block.append(line)
+                continue
+            heading = _MD_HEADING.match(line)
+            if heading or not line.strip():
+                if block:
+                    yield _element("".join(block))
+                    block = []
+                if heading:
+                    yield _element(heading.group(2), "Title", len(heading.group(1)) - 1)
+                continue
+            block.append(line)
+    if block:
+        yield _element("".join(block))
+
+
+def _parse_text(path: Path) -> Iterator[Dict[str, Any]]:
+    """Stream blank-line separated paragraphs."""
+    block = []
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            if line.strip():
+                block.append(line)
+            elif block:
+                yield _element("".join(block))
+                block = []
+    if block:
+        yield _element("".join(block))
+
+
+def _parse_csv(path: Path) -> Iterator[Dict[str, Any]]:
+    """Stream rows in batches of up to CHUNK_SIZE characters, each batch led by the header row."""
+    with open(path, "r", encoding="utf-8", errors="ignore", newline="") as f:
+        reader = csv.reader(f)
+        header = ", ".join(next(reader, []))
+        rows, size = [], len(header)
+        for row in reader:
+            line = ", ".join(row)
+            if rows and size + len(line) + 1 > CHUNK_SIZE:
+                yield _element("\n".join([header, *rows]))
+                rows, size = [], len(header)
+            rows.append(line)
+            size += len(line) + 1
+        if rows or header:
+            yield _element("\n".join([header, *rows]))
+
+
+_FAST_PARSERS = {".md": _parse_markdown, ".txt": _parse_text, ".csv": _parse_csv}
+
+
+def extract_structured_text(path: Path) -> Iterable[Dict[str, Any]]:
+    """
+    Document elements in reading order as {"content", "category", "depth", "page_number"}.
+    Markdown, text and CSV are streamed by native parsers; only other formats (PDF, DOCX)
+    pay for importing and running unstructured.
+    """
+    fast_parser = _FAST_PARSERS.get(path.suffix.lower())
+    if fast_parser:
+        return fast_parser(path)
+
+    from unstructured.partition.auto import partition
+    try:
+        elements = partition(filename=str(path))
+        structured_docs = []
+        for el in elements:
+            metadata = getattr(el, 'metadata', None)
+            structured_docs.append(_element(
+                el.text or "", getattr(el, 'category', None),
+                getattr(metadata, 'category_depth', None) or 0, getattr(metadata, 'page_number', None)
+            ))
+        return structured_docs
+    except Exception as e:
+        logging.warning(f"Failed to parse with unstructured {path.name}: {e}")
+        return _parse_text(path)
+
+
+def clean_text(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def tokenize(text: str) -> frozenset:
+    """Lower-cased word set used for the lexical-overlap check at query time."""
+    return frozenset(re.findall(r"\w+", text.lower()))
+
+
+def content_key(text: str) -> bytes:
+    """Hash of the whitespace- and Unicode-normalized text; equal keys mean exact duplicates."""
+    normalized = " ".join(unicodedata.normalize("NFC", text).split())
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).digest()
+
+
+# MinHash: 64 multiply-xor hash permutations of the shingle hashes, in LSH bands of 4 rows
+_MINHASH_PERMUTATIONS = 64
+_MINHASH_BAND_ROWS = 4
+_minhash_rng = np.random.default_rng(0x4A5255)
+_MINHASH_MASKS = _minhash_rng.integers(0, 2 ** 64, _MINHASH_PERMUTATIONS, dtype=np.uint64, endpoint=False)
+_MINHASH_MULTIPLIERS = _minhash_rng.integers(0, 2 ** 64, _MINHASH_PERMUTATIONS, dtype=np.uint64, endpoint=False) | np.uint64(1)
+
+
+def minhash(text: str) -> Optional[np.ndarray]:
+    """
+    MinHash signature (uint32 per permutation) of the text's word 3-shingles; the share of equal
+    entries estimates the Jaccard similarity of two texts. None for texts under DEDUP_MIN_WORDS
+    words, where a single changed word already moves the similarity a lot.
+    """
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < DEDUP_MIN_WORDS:
+        return None
+    shingles = {" ".join(words[i:i + 3]) for i in range(len(words) - 2)}
+    hashes = np.frombuffer(
+        b"".join(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest() for s in shingles), dtype="<u8"
+    )
+    with np.errstate(over="ignore"):
+        mixed = (hashes[:, None] ^ _MINHASH_MASKS) * _MINHASH_MULTIPLIERS
+    return (mixed.min(axis=0) >> np.uint64(32)).astype("<u4")
+
+
+def minhash_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.mean(a == b))
+
+
+def minhash_bands(signature: np.ndarray) -> List[int]:
+    """
+    LSH keys, one per band of rows: texts of Jaccard similarity s share at least one with
+    probability 1 - (1 - s^4)^16 (0.999 at s = 0.8, 0.1 at s = 0.3).
+    """
+    return [
+        int.from_bytes(hashlib.blake2b(bytes([band]) + rows.tobytes(), digest_size=8).digest(), "little", signed=True)
+        for band, rows in enumerate(signature.reshape(-1, _MINHASH_BAND_ROWS))
+    ]
+
+
+def content_fingerprint(text: str) -> Tuple[bytes, Optional[np.ndarray]]:
+    """(content_key, minhash) used to find exact and near duplicates at ingest."""
+    return content_key(text), minhash(text)
+
+
+def pack_elements(elements: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Pack consecutive elements of one document into chunks of up to CHUNK_SIZE characters, so
+    titles, list items and short paragraphs share a chunk instead of each becoming a vector.
+    A heading starts a new chunk once the current one is half full; elements larger than the
+    budget are split on their own. Chunks carry the page range and heading path they cover.
+    """
+    chunks = []
+    headings = []  # (depth, title) of the enclosing sections
+    parts, pages, heading_path = [], [], ""
+
+    def flush():
+        nonlocal parts, pages
+        if parts:
+            chunks.append({"content": clean_text("\n".join(parts)), "pages": pages, "heading_path": heading_path})
+        parts, pages = [], []
+
+    for element in elements:
+        text = element["content"].strip()
+        if not text:
+            continue
+        is_heading = element.get("category") == "Title"
+        if is_heading and sum(len(p) for p in parts) >= CHUNK_SIZE // 2:
+            flush()
+        if is_heading:
+            depth = element.get("depth") or 0
+            while headings and headings[-1][0] >= depth:
+                headings.pop()
+            headings.append((depth, clean_text(text)))
+        page = element.get("page_number")
+
+        if len(text) > CHUNK_SIZE:
+            flush()
+            heading_path = " > ".join(title for _, title in headings)
+            for piece in _get_text_splitter().split_text(text):
+                parts, pages = [piece], [page] if page is not None else []
+                flush()
+            continue
+        if parts and sum(len(p) for p in parts) + len(parts) + len(text) > CHUNK_SIZE:
+            flush()
+        if not parts:
+            # A chunk is filed under the section it starts in
+            heading_path = " > ".join(title for _, title in headings)
+        parts.append(text)
+        if page is not None:
+            pages.append(page)
+    flush()
+    return chunks
+
+
+def unpacked_chunk_count(text: str) -> int:
+    """Chunks that splitting this element on its own would have produced (approximately)."""
+    length = len(text.strip())
+    if not length:
+        return 0
+    return max(1, -(-(length - CHUNK_OVERLAP) // max(1, CHUNK_SIZE - CHUNK_OVERLAP)))
+
+
+def parse_document(file_path: Path) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Parse and chunk one file into [{"content", "metadata"}]. Also returns how many chunks
+    per-element splitting would have made, for reporting. Safe to run in a worker process.
+    """
+    file_path = Path(file_path)
+    unpacked = 0
+
+    def counted(elements):
+        nonlocal unpacked
+        for element in elements:
+            unpacked += unpacked_chunk_count(element["content"])
+            yield element
+
+    all_chunks = []
+    for i, chunk in enumerate(pack_elements(counted(extract_structured_text(file_path)))):
+        metadata = {"source": str(file_path), "filename": file_path.name, "chunk_index": i}
+        if chunk["pages"]:
+            metadata["page_number"] = min(chunk["pages"])
+            metadata["page_end"] = max(chunk["pages"])
+        if chunk["heading_path"]:
+            metadata["heading_path"] = chunk["heading_path"]
+        all_chunks.append({"content": chunk["content"], "metadata": metadata})
+    return all_chunks, unpacked
@@ -0,0 +1,100 @@
+import re
+import time
+import threading
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from utils.rag_index_utils import VectorStore
+from utils.rag_store_utils import EmbeddingCache
+
+
+def vectors_file_name(model_name: str) -> str:
+    """Name of the vector side file holding a collection embedded with `model_name`."""
+    # Hub model names contain slashes ("BAAI/bge-small-en-v1.5")
+    safe = re.sub(r"[^\w.-]+", "_", model_name).strip("._")
+    return f"vectors.{safe}.f32"
+
+
+class ShadowIndex:
+    """
+    A collection re-embedded with another model, built next to the one being served: a vector
+    side file where row i holds the new embedding of chunk id i (filled in id order, zeros for
+    removed ids) and a base index over the ids that were live when it was built.
+    """
+
+    def __init__(self, vectors: VectorStore, model, model_name: str, cache: EmbeddingCache, generation: int):
+        self.vectors = vectors
+        self.model = model
+        self.model_name = model_name
+        self.cache = cache
+        # Index generation of the collection it was built from; a forced rebuild invalidates it
+        self.generation = generation
+        self.base = None
+        self.base_ids = np.empty(0, dtype="int64")
+
+
+class MigrationProgress:
+    """Thread-safe progress of an embedding model migration, with throughput and an ETA."""
+
+    def __init__(self, model_name: str, previous: Optional[str]):
+        self.model_name = model_name
+        self.previous = previous
+        # loading, embedding, indexing, cutting over, done or failed
+        self.state = "loading"
+        self.collection = None
+        self.error = None
+        self.started = time.time()
+        self._embedding_started = None
+        self._finished = None
+        self._done = 0
+        # Chunks still to embed per collection; grows while documents are indexed meanwhile
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.state not in ("done", "failed")
+
+    def set_state(self, state: str, collection: Optional[str] = None):
+        with self._lock:
+            self.state, self.collection = state, collection
+            if state == "embedding" and self._embedding_started is None:
+                self._embedding_started = time.monotonic()
+            if state in ("done", "failed"):
+                self._finished = time.time()
+
+    def fail(self, error: Exception):
+        self.error = str(error)
+        self.set_state("failed")
+
+    def set_pending(self, collection: str, count: int):
+        with self._lock:
+            self._pending[collection] = count
+
+    def advance(self, collection: str, count: int):
+        with self._lock:
+            self._done += count
+            self._pending[collection] = max(0, self._pending.get(collection, 0) - count)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            pending = sum(self._pending.values())
+            total = self._done + pending
+            elapsed = time.monotonic() - self._embedding_started if self._embedding_started else 0.0
+            rate = self._done / elapsed if elapsed > 0 else 0.0
+            return {
+                "model": self.model_name,
+                "previous_model": self.previous,
+                "state": self.state,
+                "collection": self.collection,
+                "chunks_done": self._done,
+                "chunks_total": total,
+                "percent": round(100.0 * self._done / total, 1) if total else None,
+                "chunks_per_second": round(rate, 1),
+                # Embedding dominates; building the new index and cutting over add a little on top
+                "eta_seconds": round(pending / rate) if rate and self.running else None,
+                "started": self.started,
+                "finished": self._finished,
+                "error": self.error,
+            }
@@ -0,0 +1,223 @@
+import gc
+import os
+import sys
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from sentence_transformers import SentenceTransformer
+from sentence_transformers.cross_encoder import CrossEncoder
+
+from config.constants import (
+    RERANKER_MODEL_NAME, EMBEDDING_DEVICE, MODEL_IDLE_UNLOAD_SECONDS, RAG_MEMORY_BUDGET_MB,
+    MEMORY_GOVERNOR_INTERVAL_SECONDS
+)
+
+# One embedding model and cross-encoder per process, shared by every collection shard
+_lock = threading.Lock()
+_models = None  # (embedding model, its name, reranker)
+_users = 0
+_governor = None
+
+
+class LazyModel:
+    """
+    Stands in for a model that is loaded on first use and freed by the memory governor once
+    idle, then loaded again by the next call; collections keep the same object throughout.
+    Forwards the calls the RAG code makes (encode, predict, get_sentence_embedding_dimension).
+    """
+
+    def __init__(self, name: str, loader: Callable[[], Any]):
+        self.name = name
+        self._loader = loader
+        self._model = None
+        self._dimension = None
+        self._active = 0
+        self.last_used = time.monotonic()
+        self.loads = 0
+        self.load_seconds = None
+        self.size_bytes = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def load(self) -> "LazyModel":
+        with self._lock:
+            self._load()
+        return self
+
+    def _load(self):
+        if self._model is not None:
+            return
+        start = time.perf_counter()
+        self._model = self._loader()
+        self.load_seconds = time.perf_counter() - start
+        self.loads += 1
+        self.size_bytes = _parameter_bytes(self._model)
+        if hasattr(self._model, "get_sentence_embedding_dimension"):
+            self._dimension = self._model.get_sentence_embedding_dimension()
+        if self.loads > 1:
+            logging.info(f"Reloaded {self.name} in {self.load_seconds:.2f}s.")
+
+    def _call(self, method: str, *args, **kwargs):
+        # Loading holds the lock, so concurrent first calls wait for one load instead of racing
+        with self._lock:
+            self._load()
+            self._active += 1
+            model = self._model
+        try:
+            return getattr(model, method)(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._active -= 1
+                self.last_used = time.monotonic()
+
+    def encode(self, *args, **kwargs):
+        return self._call("encode", *args, **kwargs)
+
+    def predict(self, *args, **kwargs):
+        return self._call("predict", *args, **kwargs)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        if self._dimension is None:
+            self.load()
+        return self._dimension
+
+    def unload_if_idle(self, idle_seconds: float) -> bool:
+        """Free the model if loaded, not in use and unused for `idle_seconds`; True if it was freed."""
+        with self._lock:
+            if self._model is None or self._active or time.monotonic() - self.last_used < idle_seconds:
+                return False
+            self._model = None
+            return True
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "loaded": self.loaded,
+            "size_bytes": self.size_bytes,
+            "idle_seconds": round(time.monotonic() - self.last_used, 1),
+            "loads": self.loads,
+            "load_seconds": round(self.load_seconds, 3) if self.load_seconds is not None else None,
+        }
+
+
+def _parameter_bytes(model) -> Optional[int]:
+    """Bytes of a torch model's parameters and buffers; CrossEncoder wraps its module in .model."""
+    module = model if hasattr(model, "parameters") else getattr(model, "model", None)
+    if not hasattr(module, "parameters"):
+        return None
+    tensors = [*module.parameters(), *module.buffers()]
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def process_rss() -> Optional[int]:
+    """Resident set size of this process in bytes, or None where it cannot be read."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    if sys.platform.startswith("linux"):
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    return None
+
+
+def load_embedding_model(name: str) -> LazyModel:
+    """A private, loaded instance of embedding model `name`, e.g. to re-embed collections before sharing it."""
+    return LazyModel(name, lambda: SentenceTransformer(name, device=EMBEDDING_DEVICE)).load()
+
+
+def acquire_models(embedding_model_name: str) -> Tuple[LazyModel, str, LazyModel, Dict[str, float]]:
+    """
+    Return the shared (embedding model, its name, reranker), loading them on first use, plus
+    the load time of each model this call had to load. The embedding model is loaded as
+    `embedding_model_name` only if no collection holds one yet; a caller given another model
+    must re-embed with it. Every acquire is paired with a release_models().
+    """
+    global _models, _users, _governor
+    timings = {}
+    with _lock:
+        if _models is None:
+            logging.info(f"Loading embedding ({embedding_model_name}) and re-ranker models...")
+            embedding_model = load_embedding_model(embedding_model_name)
+            timings["embedding_model"] = embedding_model.load_seconds
+            reranker = LazyModel(RERANKER_MODEL_NAME,
+                                 lambda: CrossEncoder(RERANKER_MODEL_NAME, device=EMBEDDING_DEVICE)).load()
+            timings["reranker"] = reranker.load_seconds
+            _models = (embedding_model, embedding_model_name, reranker)
+        if _governor is None:
+            _governor = threading.Thread(target=_govern, daemon=True, name="rag-memory-governor")
+            _governor.start()
+        _users += 1
+        return _models[0], _models[1], _models[2], timings
+
+
+def replace_embedding_model(embedding_model: LazyModel, name: str) -> bool:
+    """Share `embedding_model` from now on; False (and nothing changes) if no collection is loaded."""
+    global _models
+    with _lock:
+        if _models is None:
+            return False
+        _models = (embedding_model, name, _models[2])
+        return True
+
+
+def embedding_model_name() -> Optional[str]:
+    """Name of the shared embedding model, or None while no collection is loaded."""
+    models = _models
+    return models[1] if models else None
+
+
+def release_models():
+    """Drop one reference; the models are freed once no shard holds them."""
+    global _models, _users
+    with _lock:
+        _users = max(0, _users - 1)
+        if _users == 0 and _models is not None:
+            _models = None
+            logging.info("Embedding and re-ranker models released.")
+
+
+def _govern():
+    """
+    Free the shared models once idle for MODEL_IDLE_UNLOAD_SECONDS, or as soon as they are not
+    in use while the process is over RAG_MEMORY_BUDGET_MB; indexes stay loaded either way.
+    """
+    while True:
+        time.sleep(MEMORY_GOVERNOR_INTERVAL_SECONDS)
+        try:
+            models = _models
+            if models is None:
+                continue
+            idle = MODEL_IDLE_UNLOAD_SECONDS
+            rss = process_rss()
+            if RAG_MEMORY_BUDGET_MB and rss is not None and rss > RAG_MEMORY_BUDGET_MB << 20:
+                # Still keep a model through a burst of queries rather than reloading it for each one
+                idle = min(idle, MEMORY_GOVERNOR_INTERVAL_SECONDS) if idle > 0 else MEMORY_GOVERNOR_INTERVAL_SECONDS
+            elif idle <= 0:
+                continue
+            freed = [model.name for model in (models[0], models[2]) if model.unload_if_idle(idle)]
+            if freed:
+                gc.collect()
+                if EMBEDDING_DEVICE == "cuda":
+                    import torch
+                    torch.cuda.empty_cache()
+                logging.info(f"Unloaded idle models {', '.join(freed)}; they reload on the next query.")
+        except Exception as e:
+            logging.error(f"Memory governor failed: {e}", exc_info=True)
+
+
+def memory_status() -> Dict[str, Any]:
+    """Process RSS and the shared models' footprints, for /index-status."""
+    models = _models
+    return {
+        "rss_bytes": process_rss(),
+        "budget_bytes": RAG_MEMORY_BUDGET_MB << 20 if RAG_MEMORY_BUDGET_MB else None,
+        "model_idle_unload_seconds": MODEL_IDLE_UNLOAD_SECONDS or None,
+        "models": {"embedding": models[0].status(), "reranker": models[2].status()} if models else None,
+    }
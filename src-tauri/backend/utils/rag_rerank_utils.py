@@ -0,0 +1,144 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+from utils.rag_ingest_utils import tokenize
+
+
+class ScoreCache:
+    """Thread-safe LRU of (scope, query hash, chunk id, content hash) -> cross-encoder score."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def query_key(query: str) -> bytes:
+        return hashlib.blake2b(" ".join(query.lower().split()).encode("utf-8"), digest_size=16).digest()
+
+    @staticmethod
+    def content_key(content: str) -> bytes:
+        return hashlib.blake2b(content.encode("utf-8"), digest_size=8).digest()
+
+    def get(self, key: Hashable) -> Optional[float]:
+        with self._lock:
+            score = self._scores.get(key)
+            if score is not None:
+                self._scores.move_to_end(key)
+            return score
+
+    def put(self, key: Hashable, score: float):
+        with self._lock:
+            self._scores[key] = score
+            self._scores.move_to_end(key)
+            while len(self._scores) > self.capacity:
+                self._scores.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._scores.clear()
+
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int) -> List[int]:
+    """Merge ranked id lists by summed 1 / (k + rank); ids found by several retrievers rise."""
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def mmr_select(relevance: np.ndarray, vectors: np.ndarray, k: int, relevance_weight: float,
+               duplicate_similarity: float, keep: int = 0) -> List[int]:
+    """
+    Maximal marginal relevance over normalized `vectors` with the caller's per-row `relevance`
+    in [0, 1]: the first `keep` rows are taken as they are, then the row maximizing
+    relevance_weight * relevance - (1 - relevance_weight) * max sim(picked) is picked repeatedly,
+    up to `k` rows. Rows at least `duplicate_similarity` alike to a picked row are never picked.
+    Returns row positions in pick order.
+    """
+    if not len(vectors):
+        return []
+    similarity = vectors @ vectors.T
+    redundancy = np.zeros(len(vectors), dtype="float32")
+    available = np.ones(len(vectors), dtype=bool)
+    picked = []
+    while len(picked) < min(k, len(vectors)):
+        if len(picked) < keep:
+            row = len(picked)
+        else:
+            if not available.any():
+                break
+            scores = relevance_weight * relevance - (1 - relevance_weight) * redundancy
+            row = int(np.argmax(np.where(available, scores, -np.inf)))
+        picked.append(row)
+        redundancy = np.maximum(redundancy, similarity[row])
+        available[row] = False
+        available &= similarity[row] < duplicate_similarity
+    return picked
+
+
+def prune_candidates(query: str, candidates: List[Tuple[int, Dict[str, Any], float]],
+                     dense_gap: float, keep: int) -> List[Tuple[int, Dict[str, Any], float]]:
+    """
+    Cheap pre-filter ahead of the cross-encoder. `candidates` are (chunk_id, chunk, dense_score) in
+    retrieval order; a candidate survives if it shares a token with the query and either ranks in
+    the top `keep` or scores within `dense_gap` of the best dense hit.
+    """
+    if not candidates:
+        return []
+    query_tokens = tokenize(query)
+    best = max(score for _, _, score in candidates)
+    survivors = []
+    for rank, (chunk_id, chunk, score) in enumerate(candidates):
+        tokens = chunk.get("tokens") or tokenize(chunk["content"])
+        if not query_tokens & tokens:
+            continue
+        if rank >= keep and score < best - dense_gap:
+            continue
+        survivors.append((chunk_id, chunk, score))
+    return survivors
+
+
+def cascade_rerank(query: str, candidates: List[Tuple[int, Dict[str, Any], float]],
+                   predict: Callable[[List[List[str]]], Any], cache: ScoreCache, cache_scope: Hashable,
+                   batch_size: int, top_k: int, confident_score: float) -> List[Tuple[int, Dict[str, Any], float]]:
+    """
+    Cross-encode `candidates` in retrieval order, `batch_size` pairs at a time, and stop once
+    `top_k` of them score at least `confident_score`. Cached scores are reused without a model call;
+    they are keyed by the chunk's text as well as its id, since an id can be handed to a
+    near-duplicate when the file holding it is re-indexed or removed.
+    Returns (chunk_id, chunk, rerank_score) for every candidate that was scored.
+    """
+    query_key = cache.query_key(query)
+    scored, confident = [], 0
+    pending = []
+
+    def flush():
+        nonlocal confident
+        scores = predict([[query, chunk["content"]] for _, chunk in pending])
+        for (chunk_id, chunk), score in zip(pending, scores):
+            score = float(score)
+            cache.put((cache_scope, query_key, chunk_id, cache.content_key(chunk["content"])), score)
+            scored.append((chunk_id, chunk, score))
+            confident += score >= confident_score
+        pending.clear()
+
+    for chunk_id, chunk, _ in candidates:
+        if confident >= top_k:
+            break
+        score = cache.get((cache_scope, query_key, chunk_id, cache.content_key(chunk["content"])))
+        if score is not None:
+            scored.append((chunk_id, chunk, score))
+            confident += score >= confident_score
+            continue
+        pending.append((chunk_id, chunk))
+        if len(pending) == batch_size:
+            flush()
+    if pending and confident < top_k:
+        flush()
+    return scored
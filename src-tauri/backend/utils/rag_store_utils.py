@@ -0,0 +1,658 @@
+import os
+import json
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Iterable, Tuple
+
+import numpy as np
+
+from utils.rag_ingest_utils import tokenize, content_key, content_fingerprint, minhash_bands, minhash_similarity
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sources (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    filename TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    hash TEXT
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY,
+    source_id INTEGER NOT NULL REFERENCES sources(id),
+    chunk_index INTEGER NOT NULL,
+    page_number INTEGER,
+    page_end INTEGER,
+    heading_path TEXT,
+    content TEXT NOT NULL,
+    tokens TEXT
+);
+CREATE INDEX IF NOT EXISTS chunks_by_source ON chunks(source_id);
+-- Chunks found to duplicate an indexed chunk at ingest: kept as a reference to it instead of a
+-- vector of their own, with enough to take its place when the original's file goes away
+CREATE TABLE IF NOT EXISTS chunk_refs (
+    chunk_id INTEGER NOT NULL,
+    source_id INTEGER NOT NULL REFERENCES sources(id),
+    chunk_index INTEGER NOT NULL,
+    page_number INTEGER,
+    page_end INTEGER,
+    heading_path TEXT,
+    content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunk_refs_by_chunk ON chunk_refs(chunk_id);
+CREATE INDEX IF NOT EXISTS chunk_refs_by_source ON chunk_refs(source_id);
+-- MinHash LSH band keys of each chunk: near-duplicate candidates share at least one
+CREATE TABLE IF NOT EXISTS minhash_bands (
+    band INTEGER NOT NULL,
+    chunk_id INTEGER NOT NULL,
+    PRIMARY KEY (band, chunk_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS minhash_bands_by_chunk ON minhash_bands(chunk_id);
+CREATE TRIGGER IF NOT EXISTS chunks_minhash_delete AFTER DELETE ON chunks BEGIN
+    DELETE FROM minhash_bands WHERE chunk_id = old.id;
+END;
+-- Mean chunk vector of each run of HIERARCHICAL_SECTION_CHUNKS chunks (block) of a file,
+-- duplicates included, for the coarse level of two-level retrieval
+CREATE TABLE IF NOT EXISTS sections (
+    source_id INTEGER NOT NULL,
+    block INTEGER NOT NULL,
+    centroid BLOB NOT NULL,
+    PRIMARY KEY (source_id, block)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS index_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL,
+    ids BLOB NOT NULL
+);
+"""
+
+# BM25 inverted index over chunk text. External content: FTS5 stores only the postings and the
+# triggers keep it in the same transaction as the chunk rows. '_' is a token character so
+# identifiers such as function names stay whole.
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE chunks_fts USING fts5(
+    content, content='chunks', content_rowid='id', tokenize="unicode61 tokenchars '_'"
+);
+CREATE TRIGGER chunks_fts_insert AFTER INSERT ON chunks BEGIN
+    INSERT INTO chunks_fts (rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER chunks_fts_delete AFTER DELETE ON chunks BEGIN
+    INSERT INTO chunks_fts (chunks_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+"""
+
+# Needs the fingerprint columns, so it runs after older stores are altered
+_DEDUP_SCHEMA = "CREATE INDEX IF NOT EXISTS chunks_by_hash ON chunks(content_hash);"
+
+# Columns added after the first release; older stores are altered on open
+_ADDED_COLUMNS = {"tokens": "TEXT", "page_end": "INTEGER", "heading_path": "TEXT",
+                  "content_hash": "BLOB", "minhash": "BLOB"}
+
+# SQLite caps the number of bound parameters per statement
+_MAX_PARAMS = 900
+# Query terms passed to the lexical index
+_MAX_QUERY_TERMS = 32
+
+_FILTER_KEYS = {"path_prefix", "filename_glob", "extension", "page_from", "page_to", "modified_after"}
+
+
+def normalize_filters(filters: Optional[Dict[str, Any]], root: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Validate retrieval filters from a request; raises ValueError on anything malformed.
+    Normalizing again is a no-op, apart from resolving relative prefixes once `root` is given.
+    path_prefix, filename_glob and extension take a string or a list (any may match);
+    relative prefixes are resolved against `root` (the collection directory). page_from/page_to bound the page range a
+    chunk must overlap. modified_after is epoch seconds or an ISO-8601 timestamp.
+    """
+    if not filters:
+        return {}
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be an object")
+    unknown = set(filters) - _FILTER_KEYS
+    if unknown:
+        raise ValueError(f"Unknown filters: {', '.join(sorted(unknown))}")
+
+    def strings(key):
+        value = filters[key]
+        values = [value] if isinstance(value, str) else value
+        if not isinstance(values, list) or not values or not all(isinstance(v, str) and v for v in values):
+            raise ValueError(f"{key} must be a non-empty string or list of strings")
+        return values
+
+    normalized = {}
+    if "path_prefix" in filters:
+        normalized["path_prefix"] = sorted({os.path.normpath(os.path.join(root or "", v)) for v in strings("path_prefix")})
+    if "filename_glob" in filters:
+        normalized["filename_glob"] = sorted({v.lower() for v in strings("filename_glob")})
+    if "extension" in filters:
+        normalized["extension"] = sorted({"." + v.lower().lstrip(".") for v in strings("extension")})
+    for key in ("page_from", "page_to"):
+        if filters.get(key) is not None:
+            if isinstance(filters[key], bool) or not isinstance(filters[key], int):
+                raise ValueError(f"{key} must be an integer")
+            normalized[key] = filters[key]
+    if filters.get("modified_after") is not None:
+        value = filters["modified_after"]
+        try:
+            normalized["modified_after"] = (float(value) if isinstance(value, (int, float))
+                                            else datetime.fromisoformat(value).timestamp())
+        except (TypeError, ValueError):
+            raise ValueError("modified_after must be epoch seconds or an ISO-8601 timestamp")
+    return normalized
+
+
+def _filter_clause(filters: Dict[str, Any], chunk: str = "c") -> Tuple[str, List[Any]]:
+    """SQL condition over chunks (or chunk_refs) aliased `chunk` joined with sources `s` for normalized filters."""
+    conditions, params = [], []
+    if "path_prefix" in filters:
+        # A prefix matches the path itself or anything below it as a directory
+        alternatives = []
+        for prefix in filters["path_prefix"]:
+            directory = prefix.rstrip(os.sep) + os.sep
+            alternatives.append("s.path = ? OR substr(s.path, 1, ?) = ?")
+            params += [prefix, len(directory), directory]
+        conditions.append(f"({' OR '.join(alternatives)})")
+    for key in ("filename_glob", "extension"):
+        if key in filters:
+            conditions.append(f"({' OR '.join(['lower(s.filename) GLOB ?'] * len(filters[key]))})")
+            params += filters[key] if key == "filename_glob" else ["*" + ext for ext in filters[key]]
+    if "page_from" in filters:
+        conditions.append(f"COALESCE({chunk}.page_end, {chunk}.page_number) >= ?")
+        params.append(filters["page_from"])
+    if "page_to" in filters:
+        conditions.append(f"{chunk}.page_number <= ?")
+        params.append(filters["page_to"])
+    if "modified_after" in filters:
+        conditions.append("s.mtime > ?")
+        params.append(filters["modified_after"])
+    return " AND ".join(conditions) or "1", params
+
+
+def _scope_query(filters: Dict[str, Any]) -> Tuple[str, List[Any]]:
+    """SELECT of the chunk ids matching normalized filters, through the chunk or any duplicate of it."""
+    where, params = _filter_clause(filters)
+    ref_where, ref_params = _filter_clause(filters, chunk="r")
+    return (
+        f"SELECT c.id FROM chunks c JOIN sources s ON s.id = c.source_id WHERE {where} "
+        f"UNION SELECT r.chunk_id FROM chunk_refs r JOIN sources s ON s.id = r.source_id WHERE {ref_where}",
+        params + ref_params
+    )
+
+
+class ChunkStore:
+    """
+    On-disk chunk text and metadata keyed by FAISS id. Each file path is stored once in `sources`
+    (which doubles as the file manifest) and chunks reference it, so nothing but the rows a query
+    needs is ever materialized in Python.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # Let SQLite serve reads straight from the OS page cache
+        self._conn.execute("PRAGMA mmap_size=1073741824")
+        self._conn.executescript(_SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(chunks)")}
+        for column, column_type in _ADDED_COLUMNS.items():
+            if column not in columns:
+                # Existing rows read back as NULL; e.g. chunks without tokens are tokenized at query time
+                self._conn.execute(f"ALTER TABLE chunks ADD COLUMN {column} {column_type}")
+        self._conn.executescript(_DEDUP_SCHEMA)
+        self._fingerprint_old_chunks()
+        self.has_lexical_index = self._init_lexical_index()
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _fingerprint_old_chunks(self):
+        # Chunks stored before ingest deduplication existed become dedup targets once fingerprinted
+        while True:
+            rows = self._conn.execute("SELECT id, content FROM chunks WHERE content_hash IS NULL LIMIT 1000").fetchall()
+            if not rows:
+                return
+            fingerprints = [(chunk_id, *content_fingerprint(content)) for chunk_id, content in rows]
+            self._conn.executemany(
+                "UPDATE chunks SET content_hash = ?, minhash = ? WHERE id = ?",
+                [(key, signature.tobytes() if signature is not None else None, chunk_id)
+                 for chunk_id, key, signature in fingerprints]
+            )
+            self._insert_bands([(chunk_id, signature) for chunk_id, _, signature in fingerprints])
+
+    def _insert_chunks(self, rows: List[Tuple]):
+        """Insert (id, source_id, chunk_index, page_number, page_end, heading_path, content) rows with their fingerprints."""
+        fingerprints = [content_fingerprint(row[6]) for row in rows]
+        self._conn.executemany(
+            "INSERT INTO chunks (id, source_id, chunk_index, page_number, page_end, heading_path, content, tokens, "
+            "content_hash, minhash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(*row, " ".join(tokenize(row[6])), key, signature.tobytes() if signature is not None else None)
+             for row, (key, signature) in zip(rows, fingerprints)]
+        )
+        self._insert_bands([(row[0], signature) for row, (_, signature) in zip(rows, fingerprints)])
+
+    def _insert_bands(self, signatures: Iterable[Tuple[int, Optional[np.ndarray]]]):
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO minhash_bands (band, chunk_id) VALUES (?, ?)",
+            [(band, chunk_id) for chunk_id, signature in signatures if signature is not None
+             for band in minhash_bands(signature)]
+        )
+
+    def _init_lexical_index(self) -> bool:
+        if self._conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chunks_fts'").fetchone():
+            return True
+        try:
+            self._conn.executescript(_FTS_SCHEMA)
+        except sqlite3.OperationalError as e:
+            logging.warning(f"SQLite FTS5 unavailable, lexical retrieval disabled: {e}")
+            return False
+        # Stores created before the lexical index existed are indexed once here
+        self._conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('rebuild')")
+        return True
+
+    # --- meta ---------------------------------------------------------------
+
+    def get_meta(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key: str, value: Any):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    # --- files --------------------------------------------------------------
+
+    def get_file(self, path: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime, hash FROM sources WHERE path = ?", (path,)
+            ).fetchone()
+        return {"size": row[0], "mtime": row[1], "hash": row[2]} if row else None
+
+    def file_paths(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT path FROM sources")]
+
+    def touch_file(self, path: str, size: int, mtime: float):
+        with self._lock:
+            self._conn.execute("UPDATE sources SET size = ?, mtime = ? WHERE path = ?", (size, mtime, path))
+
+    def file_chunk_ids(self, path: str) -> List[int]:
+        """Ids of the file's chunks, including indexed chunks it only holds a duplicate of."""
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT c.id FROM chunks c JOIN sources s ON s.id = c.source_id WHERE s.path = ? "
+                "UNION SELECT r.chunk_id FROM chunk_refs r JOIN sources s ON s.id = r.source_id WHERE s.path = ?",
+                (path, path)
+            )]
+
+    def release_file(self, path: str) -> Tuple[List[int], List[int]]:
+        """
+        Detach a file's chunks ahead of re-indexing or removing it. Its duplicate references are
+        dropped; a chunk of its own that other files still hold a duplicate of is handed over to
+        the first of them (its text and metadata take the row) so the id and vector stay. Returns
+        (deleted chunk ids, handed-over chunk ids).
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT id FROM sources WHERE path = ?", (path,)).fetchone()
+            if row is None:
+                return [], []
+            self._conn.execute("DELETE FROM chunk_refs WHERE source_id = ?", (row[0],))
+            deleted, handed_over = [], []
+            for (chunk_id,) in self._conn.execute("SELECT id FROM chunks WHERE source_id = ?", (row[0],)).fetchall():
+                ref = self._conn.execute(
+                    "SELECT rowid, source_id, chunk_index, page_number, page_end, heading_path, content "
+                    "FROM chunk_refs WHERE chunk_id = ? ORDER BY rowid LIMIT 1", (chunk_id,)
+                ).fetchone()
+                # Delete and re-insert rather than update, so the lexical index and bands follow
+                self._conn.execute("DELETE FROM chunks WHERE id = ?", (chunk_id,))
+                if ref is None:
+                    deleted.append(chunk_id)
+                    continue
+                self._insert_chunks([(chunk_id, *ref[1:])])
+                self._conn.execute("DELETE FROM chunk_refs WHERE rowid = ?", (ref[0],))
+                handed_over.append(chunk_id)
+            self._count -= len(deleted)
+            return deleted, handed_over
+
+    def replace_file(self, path: str, record: Dict[str, Any], ids: List[int], chunks: List[Dict],
+                     refs: Iterable[Tuple[int, Dict]] = (), sections: Optional[Dict[int, np.ndarray]] = None) -> int:
+        """
+        Upsert the file's manifest row and store `chunks` under `ids`, plus `refs` as (indexed
+        chunk id, chunk) for chunks that duplicate an indexed one, and the file's section
+        centroids by block when given. Call release_file() first. Returns the file's source id.
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sources (path, filename, size, mtime, hash) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, hash = excluded.hash",
+                (path, Path(path).name, record.get("size"), record.get("mtime"), record.get("hash"))
+            )
+            source_id = self._conn.execute("SELECT id FROM sources WHERE path = ?", (path,)).fetchone()[0]
+
+            def row(chunk_id, chunk):
+                meta = chunk["metadata"]
+                return (chunk_id, source_id, meta.get("chunk_index", 0), meta.get("page_number"),
+                        meta.get("page_end"), meta.get("heading_path"), chunk["content"])
+
+            self._insert_chunks([row(chunk_id, chunk) for chunk_id, chunk in zip(ids, chunks)])
+            self._conn.executemany(
+                "INSERT INTO chunk_refs (chunk_id, source_id, chunk_index, page_number, page_end, heading_path, content) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", [row(chunk_id, chunk) for chunk_id, chunk in refs]
+            )
+            self._count += len(ids)
+            if sections is not None:
+                self.set_sections(source_id, sections)
+            return source_id
+
+    def remove_file(self, path: str) -> Optional[Tuple[List[int], List[int]]]:
+        """
+        Delete a file and its chunks; returns release_file()'s (deleted, handed-over) chunk ids,
+        or None if it was not indexed.
+        """
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM sources WHERE path = ?", (path,)).fetchone() is None:
+                return None
+            released = self.release_file(path)
+            self._conn.execute("DELETE FROM sections WHERE source_id = (SELECT id FROM sources WHERE path = ?)", (path,))
+            self._conn.execute("DELETE FROM sources WHERE path = ?", (path,))
+            return released
+
+    def source_id(self, path: str) -> Optional[int]:
+        with self._lock:
+            row = self._conn.execute("SELECT id FROM sources WHERE path = ?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def find_duplicates(self, fingerprints: List[Tuple[bytes, Optional[np.ndarray]]],
+                        min_similarity: float) -> List[Optional[int]]:
+        """
+        For each content_fingerprint(), the id of an indexed chunk with the same normalized text,
+        else of the most similar one by MinHash if at least `min_similarity`, else None.
+        """
+        found = []
+        with self._lock:
+            for key, signature in fingerprints:
+                row = self._conn.execute("SELECT id FROM chunks WHERE content_hash = ? LIMIT 1", (key,)).fetchone()
+                if row is None and signature is not None:
+                    bands = minhash_bands(signature)
+                    candidates = self._conn.execute(
+                        "SELECT id, minhash FROM chunks WHERE id IN "
+                        f"(SELECT chunk_id FROM minhash_bands WHERE band IN ({','.join('?' * len(bands))}))", bands
+                    ).fetchall()
+                    near = [(minhash_similarity(signature, np.frombuffer(other, dtype="<u4")), chunk_id)
+                            for chunk_id, other in candidates]
+                    best = max(near, default=None)
+                    row = (best[1],) if best and best[0] >= min_similarity else None
+                found.append(row[0] if row else None)
+        return found
+
+    # --- sections -----------------------------------------------------------
+
+    def set_sections(self, source_id: int, centroids: Dict[int, np.ndarray]):
+        with self._lock:
+            self._conn.execute("DELETE FROM sections WHERE source_id = ?", (source_id,))
+            self._conn.executemany(
+                "INSERT INTO sections (source_id, block, centroid) VALUES (?, ?, ?)",
+                [(source_id, block, np.asarray(vector, dtype="float32").tobytes()) for block, vector in centroids.items()]
+            )
+
+    def clear_sections(self):
+        """Drop every section, e.g. when the vectors they average are replaced."""
+        with self._lock:
+            self._conn.execute("DELETE FROM sections")
+
+    def sections(self) -> Iterable[Tuple[int, Dict[int, np.ndarray]]]:
+        """(source id, {block: centroid}) for every file with sections."""
+        with self._lock:
+            rows = self._conn.execute("SELECT source_id, block, centroid FROM sections ORDER BY source_id").fetchall()
+        by_source = {}
+        for source_id, block, centroid in rows:
+            by_source.setdefault(source_id, {})[block] = np.frombuffer(centroid, dtype="float32")
+        return by_source.items()
+
+    def unsectioned_sources(self) -> List[int]:
+        """Files with chunks but no sections, e.g. indexed before sections were recorded."""
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT s.id FROM sources s WHERE NOT EXISTS (SELECT 1 FROM sections x WHERE x.source_id = s.id) "
+                "AND (EXISTS (SELECT 1 FROM chunks c WHERE c.source_id = s.id) "
+                "OR EXISTS (SELECT 1 FROM chunk_refs r WHERE r.source_id = s.id))"
+            )]
+
+    def source_chunks(self, source_id: int) -> List[Tuple[int, int]]:
+        """(chunk_index, indexed chunk id) of a file's chunks, duplicates included."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT chunk_index, id FROM chunks WHERE source_id = ? "
+                "UNION ALL SELECT chunk_index, chunk_id FROM chunk_refs WHERE source_id = ?", (source_id, source_id)
+            ).fetchall()
+
+    def section_chunk_ids(self, sections: List[Tuple[int, int]], section_chunks: int) -> np.ndarray:
+        """Sorted ids of the indexed chunks in (source id, block) sections, duplicates resolved."""
+        if not sections:
+            return np.empty(0, dtype="int64")
+        condition = " OR ".join(["(source_id = ? AND chunk_index >= ? AND chunk_index < ?)"] * len(sections))
+        params = [value for source_id, block in sections
+                  for value in (source_id, block * section_chunks, (block + 1) * section_chunks)]
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id FROM chunks WHERE {condition} UNION SELECT chunk_id FROM chunk_refs WHERE {condition} "
+                "ORDER BY 1", params + params
+            ).fetchall()
+        return np.array([r[0] for r in rows], dtype="int64")
+
+    def duplicate_count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chunk_refs").fetchone()[0]
+
+    def move_file(self, src: str, dest: str, size: int, mtime: float):
+        """Re-point a file's chunks at a new path; a single row update thanks to interning."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE sources SET path = ?, filename = ?, size = ?, mtime = ? WHERE path = ?",
+                (dest, Path(dest).name, size, mtime, src)
+            )
+
+    # --- chunks -------------------------------------------------------------
+
+    def get_chunks(self, ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+        """
+        Fetch chunks by FAISS id; ids that were removed are simply absent from the result.
+        "tokens" holds the word set stored at index time, or None for rows from older stores.
+        """
+        ids = [int(i) for i in ids]
+        found = {}
+        with self._lock:
+            for start in range(0, len(ids), _MAX_PARAMS):
+                batch = ids[start:start + _MAX_PARAMS]
+                rows = self._conn.execute(
+                    "SELECT c.id, c.content, c.tokens, c.chunk_index, c.page_number, c.page_end, c.heading_path, "
+                    "s.path, s.filename FROM chunks c JOIN sources s ON s.id = c.source_id "
+                    f"WHERE c.id IN ({','.join('?' * len(batch))})", batch
+                )
+                for chunk_id, content, tokens, chunk_index, page_number, page_end, heading_path, path, filename in rows:
+                    metadata = {"source": path, "filename": filename, "chunk_index": chunk_index}
+                    if page_number is not None:
+                        metadata["page_number"] = page_number
+                        metadata["page_end"] = page_end if page_end is not None else page_number
+                    if heading_path:
+                        metadata["heading_path"] = heading_path
+                    found[chunk_id] = {
+                        "content": content, "metadata": metadata,
+                        "tokens": frozenset(tokens.split()) if tokens is not None else None
+                    }
+                # Files holding a duplicate of the chunk
+                for chunk_id, path in self._conn.execute(
+                    "SELECT r.chunk_id, s.path FROM chunk_refs r JOIN sources s ON s.id = r.source_id "
+                    f"WHERE r.chunk_id IN ({','.join('?' * len(batch))}) ORDER BY r.rowid", batch
+                ):
+                    if chunk_id in found:
+                        found[chunk_id]["metadata"].setdefault("duplicate_sources", []).append(path)
+        return found
+
+    def lexical_search(self, query: str, k: int, filters: Optional[Dict[str, Any]] = None) -> List[Tuple[int, float]]:
+        """BM25 top-k as [(chunk_id, score)], best first; any query term may match."""
+        terms = sorted(tokenize(query))[:_MAX_QUERY_TERMS]
+        if not self.has_lexical_index or not terms:
+            return []
+        match = " OR ".join(f'"{term}"' for term in terms)
+        with self._lock:
+            if filters:
+                scope, params = _scope_query(filters)
+                rows = self._conn.execute(
+                    "SELECT rowid, bm25(chunks_fts) FROM chunks_fts WHERE chunks_fts MATCH ? "
+                    f"AND rowid IN ({scope}) ORDER BY bm25(chunks_fts) LIMIT ?", (match, *params, k)
+                ).fetchall()
+            else:
+                rows = self._conn.execute(
+                    "SELECT rowid, bm25(chunks_fts) FROM chunks_fts WHERE chunks_fts MATCH ? "
+                    "ORDER BY bm25(chunks_fts) LIMIT ?", (match, k)
+                ).fetchall()
+        # FTS5 reports BM25 negated so that lower sorts first
+        return [(chunk_id, -score) for chunk_id, score in rows]
+
+    def chunk_ids(self, min_id: int = 0) -> np.ndarray:
+        """Sorted ids of every live chunk at or above `min_id`."""
+        with self._lock:
+            rows = self._conn.execute("SELECT id FROM chunks WHERE id >= ? ORDER BY id", (min_id,)).fetchall()
+        return np.array([r[0] for r in rows], dtype="int64")
+
+    def filter_chunk_ids(self, filters: Dict[str, Any]) -> np.ndarray:
+        """Sorted ids of the live chunks matching normalized retrieval filters."""
+        scope, params = _scope_query(filters)
+        with self._lock:
+            rows = self._conn.execute(f"SELECT id FROM ({scope}) ORDER BY id", params).fetchall()
+        return np.array([r[0] for r in rows], dtype="int64")
+
+    # --- index write-ahead log ----------------------------------------------
+
+    def log_index_op(self, op: str, ids: Iterable[int]):
+        """
+        Record a FAISS add/remove in the same transaction as the chunk rows it belongs to,
+        so a committed chunk always has its index operation on disk as well.
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO index_log (op, ids) VALUES (?, ?)",
+                (op, np.asarray(list(ids), dtype="int64").tobytes())
+            )
+
+    def index_log(self, after_seq: int) -> List[Tuple[int, str, np.ndarray]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, op, ids FROM index_log WHERE seq > ? ORDER BY seq", (after_seq,)
+            ).fetchall()
+        return [(seq, op, np.frombuffer(ids, dtype="int64")) for seq, op, ids in rows]
+
+    def index_log_size(self, after_seq: int) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM index_log WHERE seq > ?", (after_seq,)).fetchone()[0]
+
+    def last_index_seq(self) -> int:
+        # AUTOINCREMENT keeps sequence numbers growing even after the log is truncated
+        with self._lock:
+            row = self._conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'index_log'").fetchone()
+        return row[0] if row else 0
+
+    def truncate_index_log(self, upto_seq: int):
+        with self._lock:
+            self._conn.execute("DELETE FROM index_log WHERE seq <= ?", (upto_seq,))
+            self._conn.commit()
+
+    # --- lifecycle ----------------------------------------------------------
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.executescript(
+                "DELETE FROM chunks; DELETE FROM chunk_refs; DELETE FROM sections; DELETE FROM sources; "
+                "DELETE FROM meta; DELETE FROM index_log;"
+            )
+            self._conn.commit()
+            self._count = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+
+class EmbeddingCache:
+    """
+    Embeddings keyed by (model name, hash of the normalized chunk text). Kept in its own database
+    so it survives forced rebuilds: re-chunking or re-indexing only pays for text never seen before.
+    """
+
+    def __init__(self, path: Path, model_name: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.model_name = model_name
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, text_hash BLOB NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, text_hash)) WITHOUT ROWID"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def text_key(text: str) -> bytes:
+        return content_key(text)
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        found = {}
+        unique = list(set(keys))
+        with self._lock:
+            for start in range(0, len(unique), _MAX_PARAMS):
+                batch = unique[start:start + _MAX_PARAMS]
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({','.join('?' * len(batch))})",
+                    [self.model_name, *batch]
+                )
+                for text_hash, vector in rows:
+                    found[text_hash] = np.frombuffer(vector, dtype="float32")
+        hits = sum(1 for key in keys if key in found)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return found
+
+    def put_many(self, keys: List[bytes], vectors: np.ndarray):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector) VALUES (?, ?, ?)",
+                [(self.model_name, key, np.asarray(vector, dtype="float32").tobytes()) for key, vector in zip(keys, vectors)]
+            )
+            self._conn.commit()
+
+    def reset_stats(self):
+        self.hits = self.misses = 0
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate)"
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
@@ -1,33 +1,55 @@
 import os
-import re
 import gc
+import time
+import json
+import hashlib
 import logging
 import threading
+from contextlib import contextmanager
 from pathlib import Path
 from typing import List, Dict, Any, Tuple, Optional
 import pickle
 import asyncio  # added
+from collections import deque
 # import httpx  # added
 
 import faiss
 import numpy as np
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from sentence_transformers import SentenceTransformer
-from sentence_transformers.cross_encoder import CrossEncoder
-from unstructured.partition.auto import partition
 # from utils.chat_utils import create_llm_payload, handle_non_streaming_llm_response  # added
 from config.constants import (
-    CHUNK_SIZE, CHUNK_OVERLAP, PERSIST_DIRECTORY,
+    PERSIST_DIRECTORY,
     EMBEDDING_BATCH_SIZE, DOCUMENTS_DIR, SUPPORTED_EXTS,
-    RETRIEVAL_TOP_K, RERANK_TOP_K, EMBEDDING_DEVICE,
-    EMBEDDING_MODEL_NAME, RERANKER_MODEL_NAME, MAX_WORKERS,
-    WATCHER_DEBOUNCE_SECONDS, MIN_RERANK_SCORE
+    RETRIEVAL_TOP_K, RERANK_TOP_K,
+    EMBEDDING_MODEL_NAME, DEFAULT_EMBEDDING_MODEL_NAME, MAX_WORKERS,
+    WATCHER_DEBOUNCE_SECONDS, WATCHER_MAX_BATCH_FILES, WATCHER_MAX_BATCH_DELAY_SECONDS, MIN_RERANK_SCORE, SYNC_INDEX_ON_STARTUP,
+    INDEX_RETRAIN_GROWTH, INDEX_REBUILD_DEAD_RATIO,
+    INDEX_COMPACTION_INTERVAL_SECONDS, INDEX_COMPACTION_MIN_OPS, INDEX_MMAP, INDEX_DELTA_MAX_VECTORS,
+    INDEX_RESCORE_FACTOR,
+    PARSE_WORKERS, INGEST_QUEUE_DEPTH, INGEST_PROCESS_POOL_MIN_FILES, INGEST_COMMIT_EVERY_FILES,
+    RETRIEVAL_BATCH_WINDOW_MS, RETRIEVAL_MAX_BATCH,
+    RERANK_DENSE_GAP, RERANK_BATCH_SIZE, RERANK_CONFIDENT_SCORE, RERANK_CACHE_SIZE, RRF_K,
+    SCOPED_EXACT_MAX_VECTORS, RETRIEVAL_LATENCY_WINDOW, MMR_TOP_K, MMR_LAMBDA, MMR_KEEP_TOP,
+    MMR_DUPLICATE_SIMILARITY,
+    DEDUP_NEAR_SIMILARITY, HIERARCHICAL_RETRIEVAL, HIERARCHICAL_MIN_CHUNKS, HIERARCHICAL_SECTION_CHUNKS,
+    HIERARCHICAL_TOP_SECTIONS, EMBEDDING_MIGRATION_BATCH, EMBEDDING_MIGRATION_DUTY_CYCLE
     # , LLAMA_SERVER_URL  # added
 )
+from utils.rag_index_utils import (
+    VectorStore, DeltaBuffer, IndexVersion, read_index, choose_index_mode, create_index, build_index,
+    index_mode_of, quantization_of, wanted_quantization, needs_training, supports_removal, search_params,
+    is_memory_mapped,
+    rescore, exact_search, measure_recall, SectionIndex, section_centroids
+)
+from utils.rag_store_utils import ChunkStore, EmbeddingCache, normalize_filters
+from utils.rag_ingest_utils import parse_document, content_fingerprint, minhash_similarity
+from utils.rag_batch_utils import MicroBatcher
+from utils.rag_models_utils import acquire_models, release_models
+from utils.rag_migration_utils import ShadowIndex, MigrationProgress, vectors_file_name
+from utils.rag_rerank_utils import ScoreCache, reciprocal_rank_fusion, mmr_select, prune_candidates, cascade_rerank
 
 # Define the rephrasing prompt
 REPHRASE_RAG_PROMPT = """
-You are an expert at rewriting questions for a Retrieval-Augmented Generation (RAG) system. 
+You are an expert at rewriting questions for a Retrieval-Augmented Generation (RAG) system.
 Your goal is to take a user's query and rephrase it to be more optimal for retrieving relevant documents from a vector database.
 The rephrased query should be clear, concise, and standalone.
 
@@ -37,285 +59,1507 @@ Rephrased Query:
 """
 
 class RAGSystem:
-    """Advanced RAG with re-ranking, rich metadata, and memory optimization using FAISS."""
+    """
+    Advanced RAG with re-ranking, rich metadata, and memory optimization using FAISS. One
+    instance serves one collection: a documents directory with its own index, stores and
+    watcher under `persist_dir`. The models are shared with every other collection.
+    """
 
-    def __init__(self):
-        logging.info("Initializing RAG System with FAISS...")
+    def __init__(self, name: str = "default", documents_dir: Optional[str] = None,
+                 persist_dir: Optional[str] = None, autostart: bool = True):
+        logging.info(f"Initializing RAG System with FAISS for collection '{name}'...")
+        self.name = name
+        self.documents_dir = Path(documents_dir or DOCUMENTS_DIR)
+        persist_dir = Path(persist_dir or PERSIST_DIRECTORY)
         self.embedding_model = None
+        # Name of the model this collection's vectors and queries are embedded with
+        self.embedding_model_name = None
         self.reranker = None
         self.is_running = False
+        self.watcher = None
 
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=CHUNK_SIZE,
-            chunk_overlap=CHUNK_OVERLAP
-        )
-        
+        # Base index of the newest version; never modified once published, writes go to the delta
         self.index = None
-        self.doc_store = []
-        self.index_path = Path(PERSIST_DIRECTORY) / "faiss_index.bin"
-        self.doc_store_path = Path(PERSIST_DIRECTORY) / "doc_store.pkl"
+        self._delta = None
+        # What queries search: swapped atomically, never mutated
+        self._version = None
+        self._version_number = 0
+        # Chunk text/metadata by FAISS id plus the per-file manifest (size, mtime, hash)
+        self.chunk_store = None
+        # Embeddings by (model, chunk text hash); outlives forced rebuilds
+        self.embedding_cache = None
+        self.next_id = 0
+        self.vector_store = None
+        # Number of vectors the current index was built/trained with, to know when IVF needs retraining
+        self.index_built_size = 0
+        self._index_generation = 0
+        self._compact_thread = None
+        self._compaction_lock = threading.Lock()
+        # Log sequence number covered by the base index (and its on-disk snapshot)
+        self._snapshot_seq = 0
+        # Log sequence number of the last embedding model switch; older snapshots hold the old model's vectors
+        self._embedding_seq = 0
+        # Coarse per-section vectors for two-level retrieval, loaded on the first query that uses them
+        self.section_index = None
+        # Recall@k of the quantized base against exact search, measured when it was built
+        self.index_recall = None
+        # Recent retrieve_context latencies in seconds, whole-vault and filtered queries apart
+        self._latencies = {kind: deque(maxlen=RETRIEVAL_LATENCY_WINDOW) for kind in ("unscoped", "scoped")}
+        # Read-only memory-mapped index loaded at startup and the snapshot file backing it
+        self._mapped_index = None
+        self._mapped_path = None
+        # Seconds spent in each startup phase, for the logs and /index-status
+        self.startup_timings = {}
+        self._compaction_stop = threading.Event()
+        self._compaction_thread = None
+        self._manifest_dirty = False
+        self._write_lock = threading.RLock()
+        self._retrieval_batcher = None
+        # Queries in flight; cleanup() waits for them before closing what they read
+        self._readers = 0
+        self._readers_done = threading.Condition()
+        # Cross-encoder scores by (index generation, query hash, chunk id, chunk text hash)
+        self._rerank_cache = ScoreCache(RERANK_CACHE_SIZE)
+        # Called as listener(collection, ids) when indexed chunks are dropped or re-keyed
+        self.chunk_listeners = []
+        self.index_dir = persist_dir
+        self.chunk_store_path = persist_dir / "chunks.db"
+        self.vectors_path = persist_dir / "vectors.f32"
+        self.embedding_cache_path = persist_dir / "embedding_cache.db"
+        # Pre-SQLite layout, imported once on load
+        self.index_path = persist_dir / "faiss_index.bin"
+        self.doc_store_path = persist_dir / "doc_store.pkl"
+        self.manifest_path = persist_dir / "manifest.json"
 
-        logging.info("RAG System Ready. Loading resources in the background...")
-        self.run()
+        if autostart:
+            logging.info("RAG System Ready. Loading resources in the background...")
+            self.run()
 
     # Remove LLM-powered rephrasing from utils; rag_worker will handle it.
     def _transform_query(self, query: str) -> str:
         return query
 
     # === START MODIFICATION 2: Change process_document to return results ===
-    def process_document(self, file_path: Path) -> Optional[Tuple[List[Dict], np.ndarray]]:
+    def _check_document(self, file_path: Path) -> Optional[Dict]:
+        """
+        Return the new manifest record if `file_path` must be (re)indexed, or None when its
+        content is unchanged since it was last indexed.
+        """
+        key = str(file_path)
+        stat = file_path.stat()
+        record = self.chunk_store.get_file(key)
+        if record and record["size"] == stat.st_size and record["mtime"] == stat.st_mtime:
+            logging.info(f"Skipping unchanged document: {file_path.name}")
+            return None
+
+        content_hash = self._hash_file(file_path)
+        if record and record["hash"] == content_hash:
+            # Touched but not edited: refresh the fingerprint and keep the vectors
+            with self._write_lock:
+                self.chunk_store.touch_file(key, stat.st_size, stat.st_mtime)
+                self._manifest_dirty = True
+            logging.info(f"Skipping document with unchanged content: {file_path.name}")
+            return None
+
+        return {"size": stat.st_size, "mtime": stat.st_mtime, "hash": content_hash}
+
+    def _safe_check_document(self, file_path: Path) -> Optional[Dict]:
         try:
-            if any(entry['metadata']['source'] == str(file_path) for entry in self.doc_store):
-                logging.info(f"Skipping already indexed document: {file_path.name}")
-                return None
+            return self._check_document(file_path)
+        except Exception as e:
+            logging.error(f"Error checking {file_path}: {e}", exc_info=True)
+            return None
 
-            structured_elements = self._extract_structured_text(file_path)
-            if not structured_elements:
+    def process_document(self, file_path: Path) -> Optional[Tuple[List[Dict], np.ndarray, Dict, Any]]:
+        """
+        Parse, chunk and embed a single file in-process if its content changed since it was last indexed.
+        Returns (chunks, embeddings, manifest_record, embedding model), or None if the file is
+        unchanged or failed.
+        """
+        # The pair in use now; an embedding model cut-over while this runs must not mix them
+        model, cache = self.embedding_model, self.embedding_cache
+        try:
+            new_record = self._check_document(file_path)
+            if new_record is None:
                 return None
 
-            all_chunks = []
-            for element in structured_elements:
-                chunks = self.text_splitter.split_text(element['content'])
-                base_metadata = element['metadata']
-                for i, chunk_text in enumerate(chunks):
-                    metadata = base_metadata.copy()
-                    metadata["chunk_index"] = i
-                    cleaned_chunk = self._clean_text(chunk_text)
-                    all_chunks.append({"content": cleaned_chunk, "metadata": metadata})
-
+            all_chunks, _ = parse_document(file_path)
             if not all_chunks:
-                return None
+                # Still recorded, so an emptied file drops its old vectors and is not re-parsed
+                return [], None, new_record, model
+
+            # Chunks duplicating indexed ones are stored as references and need no embedding
+            plan = self._plan_duplicates([content_fingerprint(chunk['content']) for chunk in all_chunks])
+            unique = [i for i, target in enumerate(plan) if target is None]
+            embeddings = np.full((len(all_chunks), model.get_sentence_embedding_dimension()), np.nan, dtype='float32')
+            if unique:
+                embeddings[unique] = self._embed_texts([all_chunks[i]['content'] for i in unique], model, cache)
 
-            contents = [chunk['content'] for chunk in all_chunks]
-            embeddings = self.embedding_model.encode(
-                contents, batch_size=EMBEDDING_BATCH_SIZE,
-                normalize_embeddings=True, show_progress_bar=False
-            )
-            
             logging.info(f"Processed {len(all_chunks)} chunks from {file_path.name}")
-            return all_chunks, embeddings
+            return all_chunks, embeddings, new_record, model
         except Exception as e:
             logging.error(f"Error processing {file_path}: {e}", exc_info=True)
             return None
+
+    def _plan_duplicates(self, fingerprints: List[Tuple[bytes, Optional[np.ndarray]]]) -> List[Optional[Tuple[str, int]]]:
+        """
+        Per content_fingerprint() of a file's chunks: ("stored", chunk id) for a duplicate of an
+        indexed chunk, ("local", position) for a duplicate of an earlier chunk in the same list,
+        or None for a chunk that needs its own vector. Exact duplicates share the normalized
+        text; near duplicates have a MinHash similarity of at least DEDUP_NEAR_SIMILARITY.
+        """
+        stored = self.chunk_store.find_duplicates(fingerprints, DEDUP_NEAR_SIMILARITY)
+        plan, first_by_key, near = [], {}, []
+        for position, ((key, signature), chunk_id) in enumerate(zip(fingerprints, stored)):
+            if chunk_id is not None:
+                plan.append(("stored", chunk_id))
+                continue
+            original = first_by_key.get(key)
+            if original is None and signature is not None:
+                original = next((p for other, p in near
+                                 if minhash_similarity(signature, other) >= DEDUP_NEAR_SIMILARITY), None)
+            if original is not None:
+                plan.append(("local", original))
+                continue
+            plan.append(None)
+            first_by_key[key] = position
+            if signature is not None:
+                near.append((signature, position))
+        return plan
+
+    def _embed_texts(self, texts: List[str], model=None, cache: Optional[EmbeddingCache] = None) -> np.ndarray:
+        """Embed `texts` with `model` (default: the current one), encoding only those missing from its cache."""
+        if model is None:
+            model, cache = self.embedding_model, self.embedding_cache
+        keys = [EmbeddingCache.text_key(text) for text in texts]
+        cached = cache.get_many(keys)
+        embeddings = np.empty((len(texts), model.get_sentence_embedding_dimension()), dtype='float32')
+        missing = []
+        for i, key in enumerate(keys):
+            if key in cached:
+                embeddings[i] = cached[key]
+            else:
+                missing.append(i)
+        if missing:
+            vectors = model.encode(
+                [texts[i] for i in missing], batch_size=EMBEDDING_BATCH_SIZE,
+                normalize_embeddings=True, show_progress_bar=False
+            )
+            embeddings[missing] = vectors
+            cache.put_many([keys[i] for i in missing], vectors)
+        return embeddings
+
+    def _ingest_files(self, jobs: List[Tuple[Path, Dict]]) -> Tuple[int, int, int]:
+        """
+        Staged ingestion for (path, manifest_record) jobs. Files are parsed and chunked in a
+        process pool, a single embedding stage packs chunks from many files into full
+        EMBEDDING_BATCH_SIZE batches, and each file is streamed into the index as soon as all of
+        its chunks are embedded. At most INGEST_QUEUE_DEPTH files are parsed ahead of the
+        embedder, so memory stays flat no matter how many files are rebuilt. Chunks found in the
+        embedding cache, and chunks duplicating an indexed chunk, skip the embedding stage entirely.
+        Returns (files indexed, chunks indexed, chunks per-element splitting would have made).
+        """
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+        if not jobs:
+            return 0, 0, 0
+
+        # Spawning parser processes costs more than it saves for a handful of files
+        executor_cls = ProcessPoolExecutor if len(jobs) >= INGEST_PROCESS_POOL_MIN_FILES else ThreadPoolExecutor
+        # Kept for the whole run; files embedded before an embedding model cut-over are re-embedded when indexed
+        model, cache = self.embedding_model, self.embedding_cache
+        dim = model.get_sentence_embedding_dimension()
+        job_iter = iter(jobs)
+        parsing = {}  # future -> (path, record)
+        # Parsed files in arrival order: [path, record, chunks, vectors, embedded count]
+        waiting = deque()
+        # (file entry, chunk position, cache key) for chunks not embedded yet, in file order
+        pending_texts = []
+        # Texts queued for embedding in this run; copies in files indexed later become references
+        queued_keys = set()
+        indexed_files = indexed_chunks = unpacked_chunks = 0
+
+        def embed(count: int):
+            batch = pending_texts[:count]
+            del pending_texts[:count]
+            vectors = model.encode(
+                [entry[2][i]['content'] for entry, i, _ in batch], batch_size=EMBEDDING_BATCH_SIZE,
+                normalize_embeddings=True, show_progress_bar=False
+            )
+            for (entry, i, _), vector in zip(batch, vectors):
+                entry[3][i] = vector
+                entry[4] += 1
+            cache.put_many([key for _, _, key in batch], vectors)
+
+        def index_finished_files():
+            nonlocal indexed_files, indexed_chunks
+            while waiting and waiting[0][4] == len(waiting[0][2]):
+                path, record, chunks, vectors, _ = waiting.popleft()
+                self.add_chunks_to_index(path, chunks, vectors if chunks else None, record, persist=False, model=model)
+                indexed_files += 1
+                indexed_chunks += len(chunks)
+                if indexed_files % INGEST_COMMIT_EVERY_FILES == 0:
+                    self._commit_changes()
+                    logging.info(f"Ingested {indexed_files}/{len(jobs)} files ({indexed_chunks} chunks)...")
+
+        with executor_cls(max_workers=PARSE_WORKERS) as executor:
+            while True:
+                while len(parsing) < INGEST_QUEUE_DEPTH:
+                    job = next(job_iter, None)
+                    if job is None:
+                        break
+                    parsing[executor.submit(parse_document, job[0])] = job
+
+                if not parsing:
+                    break
+
+                done, _ = wait(parsing, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, record = parsing.pop(future)
+                    try:
+                        chunks, unpacked = future.result()
+                    except Exception as e:
+                        # Left out of the manifest, so the next sync retries it
+                        logging.error(f"Error parsing {path}: {e}")
+                        continue
+                    unpacked_chunks += unpacked
+                    entry = [path, record, chunks, np.empty((len(chunks), dim), dtype='float32'), 0]
+                    waiting.append(entry)
+                    fingerprints = [content_fingerprint(chunk['content']) for chunk in chunks]
+                    plan = self._plan_duplicates(fingerprints)
+                    keys = [key for key, _ in fingerprints]
+                    cached = cache.get_many(keys)
+                    for i, key in enumerate(keys):
+                        if plan[i] is not None or key in queued_keys:
+                            # Re-checked when the file is indexed; a NaN row is embedded then if needed
+                            entry[3][i] = np.nan
+                            entry[4] += 1
+                        elif key in cached:
+                            entry[3][i] = cached[key]
+                            entry[4] += 1
+                        else:
+                            queued_keys.add(key)
+                            pending_texts.append((entry, i, key))
+
+                full_batches = len(pending_texts) - len(pending_texts) % EMBEDDING_BATCH_SIZE
+                if full_batches:
+                    embed(full_batches)
+                index_finished_files()
+
+            if pending_texts:
+                embed(len(pending_texts))
+            index_finished_files()
+
+        return indexed_files, indexed_chunks, unpacked_chunks
     # === END MODIFICATION 2 ===
 
     # === START MODIFICATION 3: Update build_index to handle results safely ===
     def build_index_from_directory(self, force_rebuild=False):
+        """
+        Bring the index in line with the documents directory. Only new or edited files are re-embedded,
+        and files that disappeared since the last run are dropped from the index.
+        """
         # Ensure resources are loaded if rebuild is triggered early
         if not self.embedding_model:
             logging.info("Embedding model not loaded. Loading synchronously before building the index...")
             self.load_resources()
 
+        self.embedding_cache.reset_stats()
         if force_rebuild:
-            logging.info("Rebuilding index. Clearing old FAISS index and doc store.")
-            d = self.embedding_model.get_sentence_embedding_dimension()
-            self.index = faiss.IndexFlatIP(d)
-            self.doc_store = []
-            if self.index_path.exists(): self.index_path.unlink()
-            if self.doc_store_path.exists(): self.doc_store_path.unlink()
-
-        files = [f for f in Path(DOCUMENTS_DIR).rglob("*") if f.suffix.lower() in SUPPORTED_EXTS]
-        
-        all_processed_chunks = []
-        all_embeddings = []
+            logging.info("Rebuilding index. Clearing old FAISS index, doc store and manifest.")
+            with self._write_lock:
+                self._index_generation += 1
+                self._reset_index()
+                self.section_index = None
+                self.index_built_size = 0
+                self.chunk_store.clear()
+                self.next_id = 0
+                self.vector_store.clear()
+                self._snapshot_seq = self.chunk_store.last_index_seq()
+                self._publish()
+                self._prune_snapshots(keep_seq=None)
+
+        if not self.documents_dir.is_dir():
+            # Never treat a missing vault as "every file was deleted"
+            logging.warning(f"Documents directory {self.documents_dir} not found. Index remains unchanged.")
+            return
+
+        files = [f for f in self.documents_dir.rglob("*") if f.suffix.lower() in SUPPORTED_EXTS]
+
+        present = {str(f) for f in files}
+        removed = [path for path in self.chunk_store.file_paths() if path not in present]
+        for path in removed:
+            self.remove_document(path, persist=False)
 
         from concurrent.futures import ThreadPoolExecutor
         with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            # map will run process_document for each file and return the results
-            results = executor.map(self.process_document, files)
-            for result in results:
-                if result:
-                    chunks, embeddings = result
-                    all_processed_chunks.extend(chunks)
-                    all_embeddings.append(embeddings)
-
-        if not all_processed_chunks:
-            logging.warning("No new documents were processed. Index remains unchanged.")
+            # Hashing is I/O bound, so the change check runs on threads
+            records = list(executor.map(self._safe_check_document, files))
+        jobs = [(f, record) for f, record in zip(files, records) if record is not None]
+
+        updated_files, added_chunks, unpacked_chunks = self._ingest_files(jobs)
+        logging.info(f"Embedding cache: {self.embedding_cache.stats()}.")
+        if unpacked_chunks:
+            logging.info(f"Element packing: {added_chunks} chunks instead of ~{unpacked_chunks} per-element chunks "
+                         f"({100.0 * (1 - added_chunks / unpacked_chunks):.1f}% fewer vectors).")
+
+        if not updated_files and not removed and not self._manifest_dirty:
+            logging.info("No document changes found. Index remains unchanged.")
             return
 
-        # Perform the update in the main thread for safety
-        final_embeddings = np.vstack(all_embeddings)
-        self.index.add(final_embeddings.astype('float32'))
-        self.doc_store.extend(all_processed_chunks)
-        
-        logging.info(f"Added {len(all_processed_chunks)} new chunks to the index.")
+        logging.info(f"Re-indexed {updated_files} files ({added_chunks} chunks), removed {len(removed)} deleted files.")
 
-        self._save_faiss_index()
+        self._commit_changes()
+        if force_rebuild:
+            # Nothing in the old snapshot is reusable; don't make startup replay the whole corpus
+            self._compact_index(index_mode_of(self.index), rebuild=False)
         logging.info("Index build complete and saved to disk.")
+        self._maybe_compact_index()
     # === END MODIFICATION 3 ===
 
-    def add_chunks_to_index(self, chunks: List[Dict], embeddings: np.ndarray):
-        """Safely add chunks and embeddings to FAISS and doc store, then persist."""
-        if embeddings is None or len(chunks) == 0:
+    def add_chunks_to_index(self, file_path: Path, chunks: List[Dict], embeddings: Optional[np.ndarray],
+                            record: Dict, persist: bool = True, model=None):
+        """
+        Replace every chunk previously indexed for `file_path` with the new ones, then persist.
+        Chunks duplicating an indexed chunk (see _plan_duplicates) are stored as references to it
+        without a vector; their `embeddings` rows may be NaN. `model` is the embedding model the
+        rows came from; if it has been cut over since, the chunks are embedded again.
+        """
+        key = str(file_path)
+        fingerprints = [content_fingerprint(chunk['content']) for chunk in chunks]
+        with self._write_lock:
+            if self.index is None:
+                self._reset_index()
+            deleted, handed_over = self.chunk_store.release_file(key)
+            self._drop_ids(deleted)
+            self._notify_chunks_changed(handed_over)
+
+            plan = self._plan_duplicates(fingerprints)
+            unique = [i for i, target in enumerate(plan) if target is None]
+            ids = list(range(self.next_id, self.next_id + len(unique)))
+            if ids and model is not None and model is not self.embedding_model:
+                embeddings = np.full((len(chunks), self.vector_store.dim), np.nan, dtype='float32')
+            if ids:
+                embeddings = embeddings[unique].astype('float32')
+                # Planned as a duplicate at parse time, but its original is gone now
+                stale = np.flatnonzero(np.isnan(embeddings[:, 0]))
+                if len(stale):
+                    embeddings[stale] = self._embed_texts([chunks[unique[i]]['content'] for i in stale])
+                self.vector_store.append(embeddings)
+                # Invisible to queries until the next commit publishes a version that includes it
+                self._delta = self._delta.append(embeddings, np.array(ids, dtype='int64'))
+                self.chunk_store.log_index_op("add", ids)
+                self.next_id += len(ids)
+            id_of = dict(zip(unique, ids))
+            refs = [(target[1] if target[0] == "stored" else id_of[target[1]], chunks[i])
+                    for i, target in enumerate(plan) if target is not None]
+            sections = self._file_sections(chunks, plan, unique, embeddings if ids else None)
+            source_id = self.chunk_store.replace_file(key, record, ids, [chunks[i] for i in unique], refs, sections)
+            if self.section_index is not None:
+                self.section_index.replace_source(source_id, sections)
+
+            if persist:
+                self._commit_changes()
+        duplicates = f" ({len(refs)} duplicates kept as references)" if refs else ""
+        logging.info(f"Indexed {len(ids)} chunks for {Path(key).name}{duplicates}.")
+
+    def _file_sections(self, chunks: List[Dict], plan: List[Optional[Tuple[str, int]]], unique: List[int],
+                       embeddings: Optional[np.ndarray]) -> Dict[int, np.ndarray]:
+        """Section centroids of a file being indexed; a duplicate counts with its original's vector."""
+        if not chunks:
+            return {}
+        vectors = np.empty((len(chunks), self.vector_store.dim), dtype="float32")
+        if unique:
+            vectors[unique] = embeddings
+        stored = [(i, target[1]) for i, target in enumerate(plan) if target is not None and target[0] == "stored"]
+        if stored:
+            vectors[[i for i, _ in stored]] = self.vector_store.get([chunk_id for _, chunk_id in stored])
+        for i, target in enumerate(plan):
+            if target is not None and target[0] == "local":
+                vectors[i] = vectors[target[1]]
+        return section_centroids([chunk["metadata"].get("chunk_index", i) for i, chunk in enumerate(chunks)], vectors)
+
+    def index_document(self, file_path: Path, persist: bool = True):
+        """Re-index a single file if its content changed."""
+        result = self.process_document(Path(file_path))
+        if result:
+            chunks, embeddings, record, model = result
+            self.add_chunks_to_index(file_path, chunks, embeddings, record, persist=persist, model=model)
+            self._maybe_compact_index()
+
+    def remove_document(self, file_path, persist: bool = True):
+        """Drop every vector and chunk that belongs to a file deleted from the vault."""
+        key = str(file_path)
+        with self._write_lock:
+            source_id = self.chunk_store.source_id(key)
+            released = self.chunk_store.remove_file(key)
+            if released is None:
+                return
+            if self.section_index is not None:
+                self.section_index.remove_source(source_id)
+            ids, handed_over = released
+            self._drop_ids(ids)
+            # Chunks other files hold duplicates of stay indexed under one of them
+            self._notify_chunks_changed(handed_over)
+            if persist:
+                self._commit_changes()
+        logging.info(f"Removed {len(ids)} chunks of deleted document {Path(key).name}.")
+
+    def move_document(self, src_path, dest_path, persist: bool = True):
+        """
+        Re-key a moved or renamed file. Its vectors are kept when the content is unchanged,
+        otherwise the old chunks are dropped and the destination is indexed from scratch.
+        """
+        if not self._move_if_unchanged(src_path, dest_path, persist):
+            self.remove_document(src_path, persist=persist)
+            self.index_document(Path(dest_path), persist=persist)
+
+    def _move_if_unchanged(self, src_path, dest_path, persist: bool) -> bool:
+        """
+        Re-key src to dest when the content is unchanged (or drop it when dest is not a supported type).
+        Returns False when dest must be indexed from scratch instead.
+        """
+        src, dest = str(src_path), Path(dest_path)
+        if dest.suffix.lower() not in SUPPORTED_EXTS:
+            self.remove_document(src, persist=persist)
+            return True
+        record = self.chunk_store.get_file(src)
+        if record is None:
+            return False
+
+        try:
+            stat = dest.stat()
+            same_content = self._hash_file(dest) == record["hash"]
+        except OSError:
+            same_content = False
+        if not same_content:
+            return False
+
+        with self._write_lock:
+            self._notify_chunks_changed(self.chunk_store.file_chunk_ids(src))
+            self.chunk_store.move_file(src, str(dest), stat.st_size, stat.st_mtime)
+            if persist:
+                self._commit_changes()
+        logging.info(f"Moved indexed chunks from {Path(src).name} to {dest.name}.")
+        return True
+
+    def apply_file_changes(self, changes: List[Tuple]):
+        """
+        Apply a coalesced watcher batch of ("index", path), ("remove", path) and ("move", src, dest)
+        changes. Removals and moves go first, then every file left to (re)index runs through the
+        ingest pipeline as one job, and the batch is committed once.
+        """
+        to_index = []
+        for change in changes:
+            try:
+                if change[0] == "remove":
+                    self.remove_document(change[1], persist=False)
+                elif change[0] == "move":
+                    if not self._move_if_unchanged(change[1], change[2], persist=False):
+                        self.remove_document(change[1], persist=False)
+                        to_index.append(Path(change[2]))
+                else:
+                    to_index.append(Path(change[1]))
+            except Exception as e:
+                logging.error(f"Failed to apply {change}: {e}", exc_info=True)
+
+        # Files removed again before the batch ran are dropped by their own "remove" event
+        files = [f for f in to_index if f.is_file()]
+        jobs = [(f, record) for f, record in zip(files, map(self._safe_check_document, files)) if record is not None]
+        indexed_files, indexed_chunks, _ = self._ingest_files(jobs)
+        self._commit_changes()
+        logging.info(f"Applied {len(changes)} vault changes; re-indexed {indexed_files} files ({indexed_chunks} chunks).")
+        self._maybe_compact_index()
+
+    def status(self) -> Dict[str, Any]:
+        version = self._version
+        return {
+            "collection": self.name,
+            "documents_dir": str(self.documents_dir),
+            "running": self.is_running,
+            "embedding_model": self.embedding_model_name,
+            "index_mode": index_mode_of(version.base) if version else None,
+            "index_quantization": quantization_of(version.base) if version else None,
+            "index_recall": self.index_recall,
+            "index_version": version.number if version else None,
+            "vectors": version.ntotal if version else 0,
+            "delta_vectors": version.delta_size if version else 0,
+            "chunks": len(self.chunk_store) if self.chunk_store else 0,
+            "duplicate_chunks": self.chunk_store.duplicate_count() if self.chunk_store else 0,
+            "two_level_retrieval": self.chunk_store is not None and self._use_sections(),
+            "sections": len(self.section_index) if self.section_index is not None else None,
+            "index_memory_mapped": version is not None and version.base is self._mapped_index,
+            "retrieval_latency_ms": {
+                kind: {"queries": len(samples),
+                       "p50": round(1000 * float(np.percentile(samples, 50)), 2) if samples else None,
+                       "p95": round(1000 * float(np.percentile(samples, 95)), 2) if samples else None}
+                for kind, samples in self._latencies.items()
+            },
+            "startup_timings": {phase: round(seconds, 3) for phase, seconds in self.startup_timings.items()},
+            "memory_bytes": self._memory_footprint(version),
+            "watcher": self.watcher.stats() if self.watcher else None,
+        }
+
+    def _memory_footprint(self, version: Optional[IndexVersion]) -> Optional[Dict[str, int]]:
+        """
+        Approximate bytes held per index component. The base index is sized by its snapshot file:
+        resident when read into memory, file-backed pages faulted in on use when mapped (see
+        index_memory_mapped). The vector side file is always mapped, not resident.
+        """
+        if version is None:
+            return None
+
+        def file_size(path: Optional[Path]) -> int:
+            try:
+                return path.stat().st_size if path is not None else 0
+            except OSError:
+                return 0  # Pruned by a concurrent compaction
+
+        snapshot = self.index_dir / f"faiss_index.{self._snapshot_seq}.bin"
+        sections = self.section_index
+        return {
+            "base_index": file_size(snapshot if snapshot.exists() else self.index_path) if version.base.ntotal else 0,
+            "delta": version.delta.vectors.nbytes + version.delta.ids.nbytes,
+            "vectors_file": file_size(version.vectors.path if version.vectors else None),
+            "section_index": len(sections) * version.delta.dim * 4 if sections is not None else 0,
+        }
+
+    def _drop_ids(self, ids: List[int]):
+        # Removed ids stay in the published base as tombstones, which search skips because they
+        # no longer resolve to a chunk; the next compaction drops them from the index
+        if ids:
+            self.chunk_store.log_index_op("remove", ids)
+            self._notify_chunks_changed(ids)
+
+    def _notify_chunks_changed(self, ids: List[int]):
+        if not ids:
             return
-        if self.index is None:
-            d = self.embedding_model.get_sentence_embedding_dimension()
-            self.index = faiss.IndexFlatIP(d)
-        self.index.add(embeddings.astype('float32'))
-        self.doc_store.extend(chunks)
-        self._save_faiss_index()
-        logging.info(f"Added {len(chunks)} chunks to the index and persisted.")
+        for listener in self.chunk_listeners:
+            try:
+                listener(self.name, ids)
+            except Exception as e:
+                logging.error(f"Chunk change listener failed: {e}", exc_info=True)
+
+    def _publish(self):
+        """Make the current base and every delta row appended so far visible to queries, atomically."""
+        with self._write_lock:
+            self._version_number += 1
+            self._version = IndexVersion(self.index, self._delta, self._version_number, self._index_generation,
+                                         self.vector_store, self.embedding_model, self.chunk_store)
+
+    def _reset_index(self):
+        self.index = self._new_index()
+        self._delta = DeltaBuffer(self.vector_store.dim)
+
+    def _maybe_compact_index(self):
+        """
+        Start a background compaction. The base is rebuilt when its type no longer fits the corpus
+        (it crossed an auto-mode size threshold, outgrew its training or carries too many
+        removed vectors); otherwise the delta and logged removals are merged into a copy of it
+        once enough of them piled up.
+        """
+        with self._write_lock:
+            version = self._version
+            if version is None or (self._compact_thread and self._compact_thread.is_alive()):
+                return
+            live = len(self.chunk_store)
+            current = index_mode_of(version.base)
+            target = choose_index_mode(live)
+            dead = version.ntotal - live
+            pending_ops = self.chunk_store.index_log_size(self._snapshot_seq)
+            rebuild = True
+            # Doubling the size for the comparison adds hysteresis, so a vault hovering
+            # around a threshold does not flip between index types on every save
+            if target != current and choose_index_mode(2 * live) != current:
+                reason = f"switching {current} -> {target}"
+            elif quantization_of(version.base) != wanted_quantization(current):
+                target = current
+                reason = f"re-encoding {quantization_of(version.base)} vectors as {wanted_quantization(current)}"
+            elif needs_training(version.base) and live > INDEX_RETRAIN_GROWTH * max(self.index_built_size, 1):
+                reason = f"retraining after growing from {self.index_built_size} to {live} vectors"
+            elif dead > INDEX_REBUILD_DEAD_RATIO * max(version.ntotal, 1):
+                reason = f"purging {dead} removed vectors"
+            elif self._delta.size >= INDEX_DELTA_MAX_VECTORS or pending_ops >= INDEX_COMPACTION_MIN_OPS:
+                rebuild, target = False, current
+                reason = f"merging {self._delta.size} new vectors ({pending_ops} logged operations)"
+            else:
+                return
+            logging.info(f"Compacting FAISS index in the background: {reason}.")
+            self._compact_thread = threading.Thread(target=self._compact_index, args=(target, rebuild), daemon=True)
+            self._compact_thread.start()
+
+    def _compact_index(self, mode: str, rebuild: bool):
+        """
+        Build the next base while the published version keeps serving, publish it and make it the
+        on-disk snapshot. A rebuild creates a `mode` index from the vector side file; otherwise the
+        current base is copied and the delta and logged removals are applied to the copy. Rows
+        appended meanwhile carry over as the new delta.
+        """
+        with self._compaction_lock:
+            try:
+                with self._write_lock:
+                    if self.index is None:
+                        return
+                    self._commit_changes()
+                    snapshot = self.index_dir / f"faiss_index.{self._snapshot_seq}.bin"
+                    if not (rebuild or self._delta.size or not snapshot.exists() or
+                            self.chunk_store.index_log_size(self._snapshot_seq)):
+                        return
+                    # A marker op gives the new snapshot a sequence number of its own, so it never
+                    # overwrites the (possibly memory-mapped) file of the current base
+                    self.chunk_store.log_index_op("compact", [])
+                    self._commit_changes()
+                    generation, base, delta, delta_size = self._index_generation, self.index, self._delta, self._delta.size
+                    seq = self.chunk_store.last_index_seq()
+                    # Nothing can be added to an untrained (empty int8) base; train it on what is there now
+                    rebuild = rebuild or not base.is_trained
+                    if rebuild:
+                        live_ids = self.chunk_store.chunk_ids()
+                    else:
+                        removed = [ids for _, op, ids in self.chunk_store.index_log(self._snapshot_seq) if op == "remove"]
+
+                if rebuild:
+                    new_base = build_index(mode, self.vector_store, live_ids)
+                    recall = None
+                    if quantization_of(new_base) != "none" and len(live_ids):
+                        recall = measure_recall(new_base, self.vector_store, live_ids, RERANK_TOP_K,
+                                                INDEX_RESCORE_FACTOR, params=search_params(new_base))
+                        logging.info(f"{quantization_of(new_base)} {mode} index recall@{recall['k']} vs float32: "
+                                     f"{recall['raw']:.3f}, {recall['rescored']:.3f} with re-scoring.")
+                else:
+                    # A mapped base cannot be cloned, but re-reading its snapshot gives the same index
+                    new_base = read_index(self._mapped_path) if base is self._mapped_index else faiss.clone_index(base)
+                    if delta_size:
+                        new_base.add_with_ids(delta.vectors[:delta_size], delta.ids[:delta_size])
+                    if removed and supports_removal(new_base):
+                        new_base.remove_ids(np.concatenate(removed))
+                tmp_path = self._save_snapshot(new_base, seq)
+
+                with self._write_lock:
+                    if self.index is not base or generation != self._index_generation:
+                        logging.info("Index was rebuilt or unloaded during compaction. Discarding the compacted index.")
+                        tmp_path.unlink()
+                        return
+                    os.replace(tmp_path, tmp_path.with_suffix(".bin"))
+                    self.index = new_base
+                    self._delta = delta.tail(delta_size)
+                    self._snapshot_seq = seq
+                    if rebuild:
+                        self.index_built_size = len(live_ids)
+                        self.index_recall = recall
+                    self._publish()
+                    self.chunk_store.truncate_index_log(seq)
+                    self._prune_snapshots(keep_seq=seq)
+                logging.info(f"FAISS {mode} index compacted to {new_base.ntotal} vectors (snapshot {seq}).")
+            except Exception as e:
+                logging.error(f"FAISS index compaction to {mode} failed: {e}", exc_info=True)
+
+    def build_shadow(self, model, model_name: str, progress: Optional[MigrationProgress] = None,
+                     throttle: bool = True) -> ShadowIndex:
+        """
+        Re-embed every live chunk with `model` into a new vector side file and build a base index
+        over it, while this collection keeps serving and indexing with its current model. Chunks
+        indexed meanwhile are embedded on the way; cut_over() embeds the last few and swaps the
+        result in. With `throttle`, embedding uses at most EMBEDDING_MIGRATION_DUTY_CYCLE of the time.
+        """
+        shadow = ShadowIndex(
+            VectorStore(self.index_dir / vectors_file_name(model_name), model.get_sentence_embedding_dimension()),
+            model, model_name, EmbeddingCache(self.embedding_cache_path, model_name), self._index_generation
+        )
+        # Left over from a migration that was interrupted; the embedding cache kept its work
+        shadow.vectors.clear()
+        if progress:
+            progress.set_state("embedding", self.name)
+        self._fill_shadow(shadow, progress, throttle)
+
+        with self._write_lock:
+            ids = self.chunk_store.chunk_ids()
+        ids = ids[ids < len(shadow.vectors)]
+        if progress:
+            progress.set_state("indexing", self.name)
+        shadow.base, shadow.base_ids = build_index(choose_index_mode(len(ids)), shadow.vectors, ids), ids
+
+        # Catch up with what was indexed during the build, so little is left for the cut-over
+        if progress:
+            progress.set_state("embedding", self.name)
+        self._fill_shadow(shadow, progress, throttle)
+        return shadow
+
+    def _fill_shadow(self, shadow: ShadowIndex, progress: Optional[MigrationProgress], throttle: bool):
+        """Append shadow rows in id order until they cover every id committed so far."""
+        while True:
+            with self._write_lock:
+                upto = self.next_id
+                ids = self.chunk_store.chunk_ids(min_id=len(shadow.vectors))
+            ids = ids[ids < upto]
+            if progress:
+                progress.set_pending(self.name, len(ids))
+            first = len(shadow.vectors)
+            if not len(ids):
+                # Rows of the removed chunks at the end, so row i stays id i
+                if upto > first:
+                    shadow.vectors.append(np.zeros((upto - first, shadow.vectors.dim), dtype="float32"))
+                return
+
+            start = time.perf_counter()
+            ids = ids[:EMBEDDING_MIGRATION_BATCH]
+            # A chunk removed since ids were listed keeps a zero row, like any removed id
+            chunks = self.chunk_store.get_chunks(ids.tolist())
+            present = [int(i) for i in ids if int(i) in chunks]
+            rows = np.zeros((int(ids[-1]) + 1 - first, shadow.vectors.dim), dtype="float32")
+            if present:
+                rows[np.array(present) - first] = self._embed_texts(
+                    [chunks[i]['content'] for i in present], shadow.model, shadow.cache
+                )
+            shadow.vectors.append(rows)
+            if progress:
+                progress.advance(self.name, len(ids))
+            if throttle:
+                # Leave the rest of the time (and the cores) to queries and regular indexing
+                elapsed = time.perf_counter() - start
+                time.sleep(elapsed * (1 - EMBEDDING_MIGRATION_DUTY_CYCLE) / EMBEDDING_MIGRATION_DUTY_CYCLE)
+
+    def cut_over(self, shadow: ShadowIndex) -> VectorStore:
+        """
+        Swap a build_shadow() result in for the current vectors, index and embedding model, and
+        return the retired vector store. The caller holds `_compaction_lock` and `_write_lock`,
+        so nothing is indexed with the old model in between, then calls finish_cut_over().
+        """
+        self._fill_shadow(shadow, None, throttle=False)
+        live = self.chunk_store.chunk_ids()
+        added = live[~np.isin(live, shadow.base_ids)]
+        removed = np.setdiff1d(shadow.base_ids, live)
+        delta = DeltaBuffer(shadow.vectors.dim)
+        if len(added):
+            delta = delta.append(shadow.vectors.get(added), added)
+        shadow.vectors.sync()
+        # Snapshots from before this marker hold the old model's vectors and are never loaded again
+        self.chunk_store.log_index_op("compact", [])
+        self._embedding_seq = self._snapshot_seq = self.chunk_store.last_index_seq()
+        if len(added):
+            self.chunk_store.log_index_op("add", added.tolist())
+        if len(removed):
+            self.chunk_store.log_index_op("remove", removed.tolist())
+        # Section centroids are averages of the old vectors; they are recomputed on first use
+        self.chunk_store.clear_sections()
+        self.section_index = None
+
+        retired = self.vector_store
+        self.vector_store, self.vectors_path = shadow.vectors, shadow.vectors.path
+        # The old cache is not closed: ingestion in flight may still hold it
+        self.embedding_model, self.embedding_model_name, self.embedding_cache = shadow.model, shadow.model_name, shadow.cache
+        self.index, self._delta = shadow.base, delta
+        self.index_built_size, self.index_recall = len(shadow.base_ids), None
+        # Rerank scores stay valid, but cached answers and query embeddings belong to the old model
+        self._index_generation += 1
+        self._commit_changes()
+        logging.info(f"Collection '{self.name}' now serves {self.embedding_model_name} embeddings "
+                     f"({len(live)} chunks).")
+        return retired
+
+    def finish_cut_over(self, shadow: ShadowIndex, retired: Optional[VectorStore]):
+        """Write the cut-over base as the on-disk snapshot and delete the old model's files."""
+        tmp_path = self._save_snapshot(shadow.base, self._embedding_seq)
+        with self._write_lock:
+            if self.index is not shadow.base:
+                # Rebuilt meanwhile; the snapshot of whatever replaced it is written by compaction
+                tmp_path.unlink()
+            else:
+                os.replace(tmp_path, tmp_path.with_suffix(".bin"))
+                self.chunk_store.truncate_index_log(self._embedding_seq)
+                self._prune_snapshots(keep_seq=self._embedding_seq)
+        if retired is not None and retired.path != self.vectors_path:
+            try:
+                retired.clear()
+            except OSError as e:
+                # Still mapped by a query in flight; removed as a stray file on the next load
+                logging.warning(f"Could not delete old vector file {retired.path.name}: {e}")
 
     # === START MODIFICATION 4: Integrate rephrasing into retrieve_context ===
-    async def retrieve_context(self, query: str) -> List[Dict[str, Any]]:
-        if not self.is_running or not self.index:
-            raise RuntimeError("Resources not loaded or index is not built. Please wait.")
+    async def retrieve_context(self, query: str, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                               filters: Optional[Dict[str, Any]] = None,
+                               query_embedding: Optional[np.ndarray] = None) -> List[Dict[str, Any]]:
+        """
+        nprobe/ef_search override the IVF/HNSW search breadth for this request only. `filters`
+        (see normalize_filters) scopes the search to matching chunks; relative path prefixes
+        are taken relative to this collection's directory. A caller searching several
+        collections passes the normalized `query_embedding` it already computed.
+        """
+        filters = normalize_filters(filters, str(self.documents_dir))
+        start = time.perf_counter()
+        try:
+            with self._reading():
+                return await self._retrieve_context(query, nprobe, ef_search, filters, query_embedding)
+        finally:
+            self._latencies["scoped" if filters else "unscoped"].append(time.perf_counter() - start)
 
-        if self.index.ntotal == 0:
+    @contextmanager
+    def _reading(self):
+        """
+        Register a query with cleanup(), which turns new ones away and waits for those in flight
+        before it closes the batcher, stores and models they use.
+        """
+        with self._readers_done:
+            if not self.is_running or self._version is None:
+                raise RuntimeError("Resources not loaded or index is not built. Please wait.")
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._readers_done:
+                self._readers -= 1
+                self._readers_done.notify_all()
+
+    async def _retrieve_context(self, query: str, nprobe: Optional[int], ef_search: Optional[int],
+                                filters: Dict[str, Any], query_embedding: Optional[np.ndarray]) -> List[Dict[str, Any]]:
+        version = self._version
+        if version.ntotal == 0:
             logging.warning("Attempted to retrieve context from an empty index.")
             return []
 
         # Query is assumed to be already rephrased by the caller
         transformed_query = self._transform_query(query)
 
-        # Offload embedding to a worker thread and normalize to match index vectors
-        query_emb = await asyncio.to_thread(
-            self.embedding_model.encode,
-            [transformed_query],
-            # ...existing code...
-            normalize_embeddings=True,  # fixed: pass as keyword, not positional
-            show_progress_bar=False
+        # Encoding, search and chunk lookups run on the batcher thread, shared with concurrent queries
+        retrieved_docs = await self._retrieval_batcher.submit(
+            (transformed_query, nprobe, ef_search, filters or None, query_embedding)
         )
-        query_emb = np.array(query_emb, dtype="float32")
-
-        distances, indices = self.index.search(query_emb, RETRIEVAL_TOP_K)
-        valid_indices = [i for i in indices[0] if i != -1]
-        if not valid_indices:
-            return []
-
-        retrieved_docs = [self.doc_store[i] for i in valid_indices]
         if not retrieved_docs:
             return []
 
-        query_doc_pairs = [[transformed_query, doc['content']] for doc in retrieved_docs]
-        rerank_scores = await asyncio.to_thread(self.reranker.predict, query_doc_pairs)
+        # Lexical overlap and the dense score gap prune before anything reaches the cross-encoder
+        candidates = prune_candidates(transformed_query, retrieved_docs, RERANK_DENSE_GAP, RERANK_TOP_K)
+        if not candidates:
+            return []
+        scored = await asyncio.to_thread(
+            cascade_rerank, transformed_query, candidates, self.reranker.predict,
+            self._rerank_cache, self._index_generation,
+            RERANK_BATCH_SIZE, RERANK_TOP_K, RERANK_CONFIDENT_SCORE
+        )
 
         reranked_results = []
-        query_tokens = set(re.findall(r'\w+', transformed_query.lower()))
-        for i, doc in enumerate(retrieved_docs):
-            score = float(rerank_scores[i])
+        for chunk_id, doc, score in scored:
             meta = doc['metadata']
             if score < MIN_RERANK_SCORE:
                 continue
-            content_tokens = set(re.findall(r'\w+', doc['content'].lower()))
-            if not query_tokens.intersection(content_tokens):
-                continue
             reranked_results.append({
+                "id": int(chunk_id),
                 "rerank_score": score,
                 "content": doc['content'],
                 "source": meta.get("source", meta.get("filename", "Unknown")),
-                "page": meta.get("page_number", "N/A")
+                "chunk_index": meta.get("chunk_index"),
+                "page": meta.get("page_number", "N/A"),
+                "page_end": meta.get("page_end", meta.get("page_number", "N/A")),
+                "heading": meta.get("heading_path", ""),
+                "duplicate_sources": meta.get("duplicate_sources", [])
             })
 
         reranked_results.sort(key=lambda x: x["rerank_score"], reverse=True)
         return reranked_results[:RERANK_TOP_K]
     # === END MODIFICATION 4 ===
 
-    def _extract_structured_text(self, path: Path) -> List[Dict[str, Any]]:
-        try:
-            elements = partition(filename=str(path))
-            structured_docs = []
-            for el in elements:
-                metadata = {"source": str(path), "filename": path.name}
-                if hasattr(el, 'metadata') and el.metadata.page_number:
-                    metadata["page_number"] = el.metadata.page_number
-                structured_docs.append({"content": el.text, "metadata": metadata})
-            return structured_docs
-        except Exception as e:
-            logging.warning(f"Failed to parse with unstructured {path.name}: {e}")
-            return [{"content": path.read_text(errors="ignore"), "metadata": {"source": str(path), "filename": path.name}}]
+    def rescore(self, query: str, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Cross-encode results retrieved for another query against `query`, e.g. the raw query's
+        hits against its rephrase. Results scoring under MIN_RERANK_SCORE are dropped.
+        """
+        if not results:
+            return []
+        candidates = [(result["id"], result, 0.0) for result in results]
+        with self._reading():
+            scored = cascade_rerank(query, candidates, self.reranker.predict, self._rerank_cache,
+                                    self._index_generation, RERANK_BATCH_SIZE, len(candidates), RERANK_CONFIDENT_SCORE)
+        return [{**result, "rerank_score": score} for _, result, score in scored if score >= MIN_RERANK_SCORE]
+
+    def _search_batch(self, requests: List[Tuple]) -> List[List[Tuple[int, Dict]]]:
+        """
+        Serve a micro-batch of (query, nprobe, ef_search, filters, query_embedding) requests with
+        one encode call for the queries that come without an embedding and one multi-row search
+        per distinct search setting and scope. Dense hits are fused with
+        BM25 hits from the chunk store by reciprocal rank fusion, and the fused hits are thinned
+        to a diverse MMR_TOP_K by maximal marginal relevance. Returns [(chunk_id, chunk,
+        dense_score)] per request in MMR pick order. The whole batch searches one published
+        index version and reads its chunk store.
+        """
+        version = self._version
+        if version is None:
+            return [[] for _ in requests]
+        vectors, store = version.vectors, version.chunk_store
+        query_embs = np.empty((len(requests), vectors.dim), dtype="float32")
+        # An embedding made just before an embedding model cut-over may not fit this version
+        missing = [row for row, request in enumerate(requests) if request[4] is None or len(request[4]) != vectors.dim]
+        if missing:
+            query_embs[missing] = version.model.encode(
+                [requests[row][0] for row in missing], batch_size=EMBEDDING_BATCH_SIZE,
+                normalize_embeddings=True, show_progress_bar=False
+            )
+        for row, request in enumerate(requests):
+            if row not in missing:
+                query_embs[row] = request[4]
+
+        # Over-fetch by the number of tombstones so removed chunks don't eat into the top k
+        k = min(2 * RETRIEVAL_TOP_K, RETRIEVAL_TOP_K + max(0, version.ntotal - len(store)))
+        # Quantized codes only shortlist; the shortlist is ranked by exact float32 scores
+        quantized = quantization_of(version.base) != "none"
+        fetch_k = INDEX_RESCORE_FACTOR * k if quantized else k
+        groups = {}
+        for row, (_, nprobe, ef_search, filters, _) in enumerate(requests):
+            scope = json.dumps(filters, sort_keys=True) if filters else None
+            groups.setdefault((nprobe, ef_search, scope), []).append(row)
+        dense = [None] * len(requests)
+        for (nprobe, ef_search, scope), rows in groups.items():
+            queries = query_embs[rows]
+            if scope is None and self._use_sections():
+                distances, indices = self._section_search(version, queries, k)
+            elif scope is None:
+                distances, indices = version.search(queries, fetch_k, params=search_params(version.base, nprobe, ef_search))
+                if quantized:
+                    distances, indices = rescore(vectors, queries, indices, k)
+            else:
+                distances, indices = self._scoped_search(version, queries, k, nprobe, ef_search, requests[rows[0]][3])
+            for row, scores, ids in zip(rows, distances, indices):
+                dense[row] = {int(i): float(score) for i, score in zip(ids, scores) if i != -1}
+        lexical = [store.lexical_search(query, k, filters) for query, _, _, filters, _ in requests]
+        fused = [
+            reciprocal_rank_fusion([list(dense_hits), [i for i, _ in lexical_hits]], RRF_K)
+            for dense_hits, lexical_hits in zip(dense, lexical)
+        ]
+
+        # Only the rows for these ~RETRIEVAL_TOP_K ids per query are read from disk. Ids are never
+        # reused, so they resolve to the chunk they were indexed with or to nothing (removed);
+        # only a forced rebuild restarts them, which the generation check catches
+        chunks = store.get_chunks({i for ids in fused for i in ids})
+        if version.generation != self._index_generation:
+            return [[] for _ in requests]
+        results = []
+        for row, ids in enumerate(fused):
+            ids = [i for i in ids if i in chunks and i < len(vectors)][:RETRIEVAL_TOP_K]
+            # Near-duplicate hits (notes copied across courses, chunk overlap) would each cost a
+            # cross-encoder pair and prompt tokens; MMR over the stored vectors keeps a diverse few.
+            # Relevance is the fused rank, so an exact-term BM25 hit in notes sharing boilerplate
+            # is weighed as fusion ranked it rather than by its dense score alone.
+            # The stored vectors also give every hit, lexical-only ones included, its exact dense score
+            hit_vectors = vectors.get(ids)
+            scores = (hit_vectors @ query_embs[row]).tolist()
+            relevance = 1.0 - np.arange(len(ids), dtype="float32") / max(len(ids), 1)
+            picked = mmr_select(relevance, hit_vectors, MMR_TOP_K, MMR_LAMBDA, MMR_DUPLICATE_SIMILARITY, MMR_KEEP_TOP)
+            results.append([(ids[p], chunks[ids[p]], scores[p]) for p in picked])
+        return results
+
+    def _scoped_search(self, version: IndexVersion, queries: np.ndarray, k: int, nprobe: Optional[int],
+                       ef_search: Optional[int], filters: Dict[str, Any]):
+        """
+        Dense top-k restricted to the chunks matching `filters`, resolved by the chunk store's
+        metadata. A small scope is scanned exactly from the vector side file, touching only its
+        own vectors; a large one searches the index through an id selector.
+        """
+        allowed = version.chunk_store.filter_chunk_ids(filters)
+        if len(allowed) <= SCOPED_EXACT_MAX_VECTORS:
+            # Every live chunk has its row in the side file, including ones still in the delta
+            return exact_search(version.vectors, allowed, queries, k)
+        selector = faiss.IDSelectorBatch(allowed)
+        quantized = quantization_of(version.base) != "none"
+        distances, indices = version.search(
+            queries, INDEX_RESCORE_FACTOR * k if quantized else k,
+            params=search_params(version.base, nprobe, ef_search, selector), allowed=allowed
+        )
+        if quantized:
+            distances, indices = rescore(version.vectors, queries, indices, k)
+        return distances, indices
+
+    def _use_sections(self) -> bool:
+        if HIERARCHICAL_RETRIEVAL == "auto":
+            return len(self.chunk_store) >= HIERARCHICAL_MIN_CHUNKS
+        return HIERARCHICAL_RETRIEVAL == "on"
+
+    def _section_search(self, version: IndexVersion, queries: np.ndarray, k: int):
+        """
+        Two-level dense top-k: shortlist HIERARCHICAL_TOP_SECTIONS sections per query by their
+        centroid, then scan only the chunks inside them exactly. The cost follows the shortlist,
+        not the size of the vault.
+        """
+        distances = np.full((len(queries), k), -np.inf, dtype="float32")
+        indices = np.full((len(queries), k), -1, dtype="int64")
+        for row, sections in enumerate(self._get_section_index().search(queries, HIERARCHICAL_TOP_SECTIONS)):
+            ids = version.chunk_store.section_chunk_ids(sections, HIERARCHICAL_SECTION_CHUNKS)
+            scores, found = exact_search(version.vectors, ids, queries[row:row + 1], k)
+            distances[row, :found.shape[1]], indices[row, :found.shape[1]] = scores[0], found[0]
+        return distances, indices
+
+    def _get_section_index(self) -> SectionIndex:
+        """The section index, loaded from the chunk store on first use (filling in older files)."""
+        if self.section_index is not None:
+            return self.section_index
+        with self._write_lock:
+            if self.section_index is None:
+                start = time.perf_counter()
+                index = SectionIndex(self.vector_store.dim)
+                for source_id in self.chunk_store.unsectioned_sources():
+                    positions = self.chunk_store.source_chunks(source_id)
+                    self.chunk_store.set_sections(source_id, section_centroids(
+                        [chunk_index for chunk_index, _ in positions],
+                        self.vector_store.get([chunk_id for _, chunk_id in positions])
+                    ))
+                for source_id, centroids in self.chunk_store.sections():
+                    index.replace_source(source_id, centroids)
+                self.section_index = index
+                logging.info(f"Loaded {len(index)} section vectors for two-level retrieval "
+                             f"in {time.perf_counter() - start:.2f}s.")
+            return self.section_index
 
     @staticmethod
-    def _clean_text(text: str) -> str:
-        return re.sub(r"\s+", " ", text).strip()
-
-    def _save_faiss_index(self):
-        if self.index and self.index.ntotal > 0:
-            logging.info(f"Saving FAISS index to {self.index_path}")
-            faiss.write_index(self.index, str(self.index_path))
-            with open(self.doc_store_path, "wb") as f:
-                pickle.dump(self.doc_store, f)
-            logging.info("Index and doc store saved.")
-        else:
-            logging.warning("Attempted to save an empty index. Skipping.")
+    def _hash_file(path: Path) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
 
+    def _new_index(self):
+        d = self.embedding_model.get_sentence_embedding_dimension()
+        if self.vector_store is None:
+            self.vector_store = VectorStore(self.vectors_path, d)
+        return create_index(choose_index_mode(0), d)
+
+    def _commit_changes(self):
+        """
+        Make pending writes durable. Only new vector rows, chunk rows and index log records are
+        written, so the cost is proportional to the change rather than the corpus.
+        """
+        with self._write_lock:
+            if self.index is None:
+                logging.warning("Attempted to save before the index was loaded. Skipping.")
+                return
+            # Vectors first: a committed log record must never point at rows that are not on disk
+            self.vector_store.sync()
+            self.chunk_store.set_meta("next_id", self.next_id)
+            self.chunk_store.set_meta("index_built_size", self.index_built_size)
+            self.chunk_store.set_meta("embedding_model", self.embedding_model_name)
+            self.chunk_store.set_meta("vectors_file", self.vectors_path.name)
+            self.chunk_store.set_meta("embedding_seq", self._embedding_seq)
+            self.chunk_store.commit()
+            self._manifest_dirty = False
+            self._publish()
+
+    def _snapshot_paths(self) -> List[Tuple[int, Path]]:
+        """Index snapshots as (log seq, path), oldest first. The seq lives in the file name."""
+        snapshots = []
+        for path in self.index_dir.glob("faiss_index.*.bin"):
+            seq = path.name.split(".")[1]
+            if seq.isdigit():
+                snapshots.append((int(seq), path))
+        return sorted(snapshots)
+
+    def _save_snapshot(self, index, seq: int) -> Path:
+        """
+        Write `index` to a temporary file and fsync it; the caller renames it into place, so a
+        crash leaves either the old or the new snapshot, never half of one.
+        """
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_dir / f"faiss_index.{seq}.tmp"
+        logging.info(f"Writing FAISS index snapshot {seq}...")
+        faiss.write_index(index, str(tmp_path))
+        with open(tmp_path, "rb+") as f:
+            os.fsync(f.fileno())
+        return tmp_path
+
+    def _prune_snapshots(self, keep_seq: Optional[int]):
+        """Delete every snapshot but `keep_seq`, plus the pre-snapshot faiss_index.bin."""
+        if self.index is not self._mapped_index:
+            # Release the mapping so its file can be deleted (Windows refuses to delete mapped files)
+            self._mapped_index = self._mapped_path = None
+        for seq, path in self._snapshot_paths():
+            if seq != keep_seq:
+                try:
+                    path.unlink()
+                except OSError as e:
+                    # Still mapped by a query in flight; the next compaction retries
+                    logging.warning(f"Could not delete old snapshot {path.name}: {e}")
+        if self.index_path.exists(): self.index_path.unlink()
+
+    def _compaction_loop(self):
+        while not self._compaction_stop.wait(INDEX_COMPACTION_INTERVAL_SECONDS):
+            try:
+                if self.chunk_store:
+                    self._maybe_compact_index()
+            except Exception as e:
+                logging.error(f"Background index compaction failed: {e}", exc_info=True)
+
+    def _stored_embedding_model(self) -> Optional[str]:
+        """The model this collection's stored vectors were embedded with; None for a new collection."""
+        stored = self.chunk_store.get_meta("embedding_model")
+        if stored:
+            return stored
+        # Stores that predate recording it were embedded with the default model
+        if self.chunk_store.get_meta("next_id", 0) or self.doc_store_path.exists() or self.index_path.exists():
+            return DEFAULT_EMBEDDING_MODEL_NAME
+        return None
 
     def _load_faiss_index(self):
-        if self.index_path.exists() and self.doc_store_path.exists():
-            logging.info(f"Loading FAISS index from {self.index_path}")
-            self.index = faiss.read_index(str(self.index_path))
-            with open(self.doc_store_path, "rb") as f:
-                self.doc_store = pickle.load(f)
-            logging.info(f"FAISS index with {self.index.ntotal} vectors and doc store loaded.")
+        d = self.embedding_model.get_sentence_embedding_dimension()
+        self.vectors_path = self.index_dir / self.chunk_store.get_meta("vectors_file", self.vectors_path.name)
+        self.vector_store = VectorStore(self.vectors_path, d)
+        self._embedding_seq = self.chunk_store.get_meta("embedding_seq", 0)
+        self.next_id = self.chunk_store.get_meta("next_id", 0)
+        self._remove_stray_vector_files()
+
+        start = time.perf_counter()
+        stored = self._stored_embedding_model()
+        if stored is not None and stored != self.embedding_model_name:
+            # Another collection already loaded the shared model; this one cannot be searched with it
+            logging.info(f"Collection '{self.name}' was embedded with {stored}; "
+                         f"re-embedding it with {self.embedding_model_name} before serving it...")
+            shadow = self.build_shadow(self.embedding_model, self.embedding_model_name, throttle=False)
+            with self._compaction_lock, self._write_lock:
+                retired = self.cut_over(shadow)
+            self.finish_cut_over(shadow, retired)
+            self.startup_timings["re_embedding"] = time.perf_counter() - start
+            return
+
+        self.embedding_cache = EmbeddingCache(self.embedding_cache_path, self.embedding_model_name)
+        self._delta = DeltaBuffer(d)
+        snapshots = self._snapshot_paths()
+        # A crash right after an embedding model switch can leave only snapshots of the old vectors
+        stale = bool(snapshots) and snapshots[-1][0] < self._embedding_seq
+        if (snapshots or self.index_path.exists()) and not stale:
+            # A pre-snapshot faiss_index.bin counts as the snapshot taken before any logged operation
+            self._snapshot_seq, snapshot_path = snapshots[-1] if snapshots else (0, self.index_path)
+            # The base is never written to once loaded (logged operations replay into the delta),
+            # so any snapshot can be mapped; a legacy file may need converting and is read normally
+            mmap = INDEX_MMAP and bool(snapshots)
+            logging.info(f"Loading FAISS index from {snapshot_path}{' (memory-mapped)' if mmap else ''}")
+            self.index = read_index(snapshot_path, mmap=mmap)
+            if mmap and is_memory_mapped(self.index):
+                self._mapped_index, self._mapped_path = self.index, snapshot_path
+            elif mmap:
+                logging.info(f"{snapshot_path.name} could not be used in place and was read into memory.")
+            if self.doc_store_path.exists():
+                self._import_pickled_doc_store()
+        elif stale:
+            # Rebuilt from the vector file below; nothing in the log needs replaying
+            logging.warning("FAISS index snapshot predates the embedding model switch. Rebuilding it.")
+            self._snapshot_seq = self.chunk_store.last_index_seq()
+            self.index = self._new_index()
         else:
-            logging.warning("No FAISS index found. Initializing a new one.")
-            d = self.embedding_model.get_sentence_embedding_dimension()
-            self.index = faiss.IndexFlatIP(d) 
+            # The log is only truncated once a snapshot exists, so without one it holds every
+            # operation since the store was created and replays onto an empty index
+            logging.warning("No FAISS index snapshot found. Initializing a new one.")
+            self._snapshot_seq = 0
+            self.index = self._new_index()
+        self.startup_timings["index_load"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        self.index_built_size = self.chunk_store.get_meta("index_built_size", self.index.ntotal)
+        # Vector rows past the last committed id belong to a write that never committed
+        self._sync_vector_store()
+        self._replay_index_log()
+        self._publish()
+        if stale:
+            self._compact_index(choose_index_mode(len(self.chunk_store)), rebuild=True)
+        elif not snapshots and self._version.ntotal:
+            self._compact_index(index_mode_of(self.index), rebuild=False)
+        self.startup_timings["recovery"] = time.perf_counter() - start
+        logging.info(f"FAISS {index_mode_of(self.index)} index with {self._version.ntotal} vectors "
+                     f"and {len(self.chunk_store)} stored chunks loaded.")
+
+    def _remove_stray_vector_files(self):
+        """Delete vector files of other models: retired ones that were in use, or an interrupted migration's."""
+        for path in self.index_dir.glob("vectors*.f32"):
+            if path != self.vectors_path:
+                try:
+                    path.unlink()
+                except OSError as e:
+                    logging.warning(f"Could not delete stray vector file {path.name}: {e}")
+
+    def _replay_index_log(self):
+        """
+        Re-apply index operations committed after the loaded snapshot was written: additions go to
+        the delta, removals stay tombstones until the next compaction folds both into the base.
+        """
+        ops = self.chunk_store.index_log(self._snapshot_seq)
+        for _, op, ids in ops:
+            if op == "add":
+                self._delta = self._delta.append(self.vector_store.get(ids), ids)
+        if ops:
+            logging.info(f"Recovered {len(ops)} index operations from the write-ahead log.")
+
+    def _sync_vector_store(self):
+        """Make row i of the vector side file match FAISS id i again after a crash or an older layout."""
+        rows = len(self.vector_store)
+        if rows >= self.next_id:
+            self.vector_store.truncate(self.next_id)
+            return
+        if index_mode_of(self.index) != "flat" or quantization_of(self.index) != "none":
+            logging.warning("Vector side file is incomplete; index migrations will be unavailable until a rebuild.")
+            return
+        logging.info(f"Restoring {self.next_id - rows} missing rows of the vector side file from the flat index...")
+        missing = np.zeros((self.next_id - rows, self.vector_store.dim), dtype='float32')
+        for chunk_id in self.chunk_store.chunk_ids(min_id=rows).tolist():
+            missing[chunk_id - rows] = self.index.reconstruct(chunk_id)
+        self.vector_store.append(missing)
+
+    def _import_pickled_doc_store(self):
+        """
+        Move a pickled doc store into the chunk store. The original positional layout (a list
+        aligned with a plain IndexFlatIP) is also converted to an ID-mapped index; its files get
+        no hash, so the next directory sync re-embeds each of them once.
+        """
+        logging.info(f"Importing {self.doc_store_path} into {self.chunk_store_path}...")
+        with open(self.doc_store_path, "rb") as f:
+            doc_store = pickle.load(f)
+
+        if isinstance(doc_store, list):
+            vectors = self.index.reconstruct_n(0, self.index.ntotal) if self.index.ntotal else None
+            doc_store = dict(enumerate(doc_store))
+            self.index = self._new_index()
+            self.vector_store.clear()
+            if vectors is not None:
+                self.vector_store.append(vectors)
+                # A quantized or IVF index must be trained before vectors can be added
+                ids = np.arange(len(doc_store), dtype='int64')
+                self.index = build_index(choose_index_mode(len(ids)), self.vector_store, ids)
+            files = {}
+            for chunk_id, chunk in doc_store.items():
+                record = files.setdefault(chunk['metadata']['source'], {"hash": None, "ids": []})
+                record["ids"].append(chunk_id)
+            next_id = self.index_built_size = len(doc_store)
+        else:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            files, next_id = manifest["files"], manifest["next_id"]
+            self.index_built_size = manifest.get("index_built_size", self.index.ntotal)
+
+        self.chunk_store.clear()
+        for path, record in files.items():
+            self.chunk_store.replace_file(path, record, record["ids"], [doc_store[i] for i in record["ids"]])
+        self.next_id = next_id
+        self._compact_index(index_mode_of(self.index), rebuild=False)
+        self.doc_store_path.unlink()
+        if self.manifest_path.exists(): self.manifest_path.unlink()
 
     def load_resources(self):
+        load_start = time.perf_counter()
+        if self.chunk_store is None:
+            start = time.perf_counter()
+            self.chunk_store = ChunkStore(self.chunk_store_path)
+            self.startup_timings["chunk_store"] = time.perf_counter() - start
+
         if not self.embedding_model:
-            logging.info("Loading embedding and re-ranker models...")
-            self.embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME, device=EMBEDDING_DEVICE)
-            self.reranker = CrossEncoder(RERANKER_MODEL_NAME, device=EMBEDDING_DEVICE)
+            # The first collection loaded picks the shared model: the one its vectors were embedded with
+            self.embedding_model, self.embedding_model_name, self.reranker, timings = acquire_models(
+                self._stored_embedding_model() or EMBEDDING_MODEL_NAME
+            )
+            self.startup_timings.update(timings)
 
         if not self.index:
             self._load_faiss_index()
-            
+
+        if not self._retrieval_batcher:
+            self._retrieval_batcher = MicroBatcher(
+                self._search_batch, RETRIEVAL_BATCH_WINDOW_MS, RETRIEVAL_MAX_BATCH, name="rag-retrieval"
+            )
+
+        if not (self._compaction_thread and self._compaction_thread.is_alive()):
+            self._compaction_stop.clear()
+            self._compaction_thread = threading.Thread(target=self._compaction_loop, daemon=True)
+            self._compaction_thread.start()
+
         self.is_running = True
-        logging.info("All resources loaded and ready.")
+        self.startup_timings["ready"] = time.perf_counter() - load_start
+        logging.info(f"Collection '{self.name}' loaded and ready. Startup timings: " +
+                     ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.startup_timings.items()))
+
+    def _start(self):
+        self.load_resources()
+        if SYNC_INDEX_ON_STARTUP:
+            # Re-embeds only files whose content hash changed while the app was closed
+            start = time.perf_counter()
+            self.build_index_from_directory()
+            self.startup_timings["startup_sync"] = time.perf_counter() - start
+            logging.info(f"Startup sync finished in {self.startup_timings['startup_sync']:.2f}s.")
+        # An index saved before the vault crossed a size threshold is upgraded while queries are served
+        self._maybe_compact_index()
+        if self.watcher is None and self.documents_dir.is_dir():
+            try:
+                self.watcher = start_watcher(self)
+            except Exception as e:
+                logging.error(f"Failed to start the vault watcher: {e}", exc_info=True)
 
     def run(self):
-        thread = threading.Thread(target=self.load_resources)
+        thread = threading.Thread(target=self._start)
         thread.start()
-    
+
     def persist_index(self):
-        self._save_faiss_index()
+        """Fold pending changes into a fresh on-disk snapshot now rather than at the next compaction."""
+        if self.index is not None:
+            self._compact_index(index_mode_of(self.index), rebuild=False)
 
     def cleanup(self):
-        self.embedding_model = None
+        # New queries are turned away; the ones in flight finish before anything they read goes
+        with self._readers_done:
+            self.is_running = False
+            self._readers_done.wait_for(lambda: not self._readers)
+        self._compaction_stop.set()
+        if self.watcher:
+            self.watcher.stop()
+            self.watcher = None
+        self.persist_index()
+        self._version = None
+        if self._retrieval_batcher:
+            self._retrieval_batcher.close()
+            self._retrieval_batcher = None
+        if self.embedding_model:
+            release_models()
+        self.embedding_model = self.embedding_model_name = None
         self.reranker = None
-        self.index = None
-        self.doc_store = []
-        self.is_running = False
+        self.index = self._delta = None
+        self._mapped_index = self._mapped_path = None
+        self.section_index = None
+        self.vector_store = None
+        if self.chunk_store:
+            self.chunk_store.close()
+        self.chunk_store = None
+        if self.embedding_cache:
+            self.embedding_cache.close()
+        self.embedding_cache = None
         gc.collect()
-        logging.info("RAG System resources cleaned up.")
+        logging.info(f"RAG System resources of collection '{self.name}' cleaned up.")
 
 
 class DocumentHandler:
+    """
+    Coalesces vault events into batches. Bursts of create/modify events for one path collapse
+    into a single pending change, and a batch is handed to the RAG system once the vault has been
+    quiet for WATCHER_DEBOUNCE_SECONDS, WATCHER_MAX_BATCH_FILES paths are pending, or the oldest
+    event has waited WATCHER_MAX_BATCH_DELAY_SECONDS. Each batch is embedded and committed as one job.
+    """
+
     def __init__(self, rag_system: RAGSystem):
         self.rag_system = rag_system
-        self.debounce_timers = {}
+        self.observer = None
+        # path -> [change, first event time]; insertion order is arrival order
+        self._pending = {}
+        self._last_event = 0.0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._in_flight = 0
+        self._in_flight_since = None
+        self._last_batch = {"files": 0, "seconds": 0.0}
+        self._thread = threading.Thread(target=self._flush_loop, name="rag-watcher", daemon=True)
+        self._thread.start()
 
-    def _debounce(self, path_str: str, action):
-        if path_str in self.debounce_timers:
-            self.debounce_timers[path_str].cancel()
-        timer = threading.Timer(WATCHER_DEBOUNCE_SECONDS, action)
-        self.debounce_timers[path_str] = timer
-        timer.start()
+    def dispatch(self, event):
+        # Same contract as watchdog's FileSystemEventHandler.dispatch, without importing watchdog here
+        handler = getattr(self, f"on_{event.event_type}", None)
+        if handler:
+            handler(event)
 
-    def _process_and_index(self, path_str: str):
-        try:
-            result = self.rag_system.process_document(Path(path_str))
-            if result:
-                chunks, embeddings = result
-                self.rag_system.add_chunks_to_index(chunks, embeddings)
-        except Exception as e:
-            logging.error(f"Failed to process/index {path_str}: {e}", exc_info=True)
+    @staticmethod
+    def _is_supported(path_str: str) -> bool:
+        return Path(path_str).suffix.lower() in SUPPORTED_EXTS
+
+    def _queue(self, path_str: str, change: Tuple, first_seen: Optional[float] = None):
+        with self._cond:
+            now = time.monotonic()
+            entry = self._pending.get(path_str)
+            if entry is None:
+                self._pending[path_str] = [change, first_seen or now]
+            elif not (entry[0][0] == "move" and change[0] == "index"):
+                moved_from = entry[0][1] if entry[0][0] == "move" else None
+                # A pending move re-checks the destination's content anyway, so an edit keeps it
+                entry[0] = change
+                if moved_from is not None and change[0] == "remove":
+                    # Moved then deleted: the chunks are still indexed under the source path. A
+                    # change already pending there re-indexes that path, which replaces them anyway
+                    self._pending.setdefault(moved_from, [("remove", moved_from), entry[1]])
+            self._last_event = now
+            self._cond.notify()
 
     def on_created(self, event):
-        if not event.is_directory:
-            self._debounce(event.src_path, lambda: self._process_and_index(event.src_path))
+        if not event.is_directory and self._is_supported(event.src_path):
+            self._queue(event.src_path, ("index", event.src_path))
 
     def on_modified(self, event):
-        if not event.is_directory:
-            self._debounce(event.src_path, lambda: self._process_and_index(event.src_path))
+        if not event.is_directory and self._is_supported(event.src_path):
+            self._queue(event.src_path, ("index", event.src_path))
+
+    def on_deleted(self, event):
+        if not event.is_directory and self._is_supported(event.src_path):
+            self._queue(event.src_path, ("remove", event.src_path))
+
+    def on_moved(self, event):
+        if event.is_directory or not (self._is_supported(event.src_path) or self._is_supported(event.dest_path)):
+            return
+        with self._cond:
+            pending = self._pending.pop(event.src_path, None)
+        if pending is None:
+            self._queue(event.dest_path, ("move", event.src_path, event.dest_path))
+            return
+        if pending[0][0] == "move":
+            # Renamed twice before the batch ran: move straight from the original path
+            change = ("move", pending[0][1], event.dest_path)
+        else:
+            # Created or edited under the old name (e.g. an editor's temp file): index the new name
+            change = ("index", event.dest_path)
+        self._queue(event.dest_path, change, first_seen=pending[1])
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self._pending:
+                        now = time.monotonic()
+                        oldest = next(iter(self._pending.values()))[1]
+                        if (len(self._pending) >= WATCHER_MAX_BATCH_FILES
+                                or now - self._last_event >= WATCHER_DEBOUNCE_SECONDS
+                                or now - oldest >= WATCHER_MAX_BATCH_DELAY_SECONDS):
+                            break
+                        self._cond.wait(min(self._last_event + WATCHER_DEBOUNCE_SECONDS,
+                                            oldest + WATCHER_MAX_BATCH_DELAY_SECONDS) - now)
+                    else:
+                        self._cond.wait()
+                if self._stopped:
+                    return
+                paths = list(self._pending)[:WATCHER_MAX_BATCH_FILES]
+                batch = [self._pending.pop(path) for path in paths]
+                self._in_flight = len(batch)
+                self._in_flight_since = batch[0][1]
+
+            started = time.monotonic()
+            try:
+                self.rag_system.apply_file_changes([change for change, _ in batch])
+            except Exception as e:
+                logging.error(f"Failed to apply a batch of {len(batch)} vault changes: {e}", exc_info=True)
+            with self._cond:
+                self._in_flight = 0
+                self._in_flight_since = None
+                self._last_batch = {"files": len(batch), "seconds": round(time.monotonic() - started, 3)}
+
+    def stats(self) -> Dict[str, Any]:
+        """Pending paths, the batch being applied, and how long the oldest unapplied event has waited."""
+        with self._cond:
+            waiting = [entry[1] for entry in list(self._pending.values())[:1]]
+            if self._in_flight_since is not None:
+                waiting.append(self._in_flight_since)
+            return {
+                "queue_depth": len(self._pending),
+                "in_flight": self._in_flight,
+                "lag_seconds": round(time.monotonic() - min(waiting), 3) if waiting else 0.0,
+                "last_batch": dict(self._last_batch),
+            }
+
+    def stop(self):
+        if self.observer:
+            self.observer.stop()
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
 
 
-def start_watcher(rag_system: RAGSystem):
+def start_watcher(rag_system: RAGSystem) -> DocumentHandler:
     from watchdog.observers import Observer
     handler = DocumentHandler(rag_system)
-    observer = Observer()
-    observer.schedule(handler, path=DOCUMENTS_DIR, recursive=True)
-    observer.start()
-    logging.info(f"Started watching {DOCUMENTS_DIR} for changes.")
-    return observer
\ No newline at end of file
+    handler.observer = Observer()
+    handler.observer.schedule(handler, path=str(rag_system.documents_dir), recursive=True)
+    handler.observer.start()
+    logging.info(f"Started watching {rag_system.documents_dir} for changes.")
+    return handler
@@ -1,6 +1,8 @@
 import { createSignal, onMount } from 'solid-js';
 import { invoke } from '@tauri-apps/api/core';
-import { setStoreValue, getStoreValue } from '@/config/store';
+import { setStoreValue, getStoreValue, saveStore } from '@/config/store';
+
+const DEFAULT_EMBEDDING_MODEL = 'all-MiniLM-L6-v2';
 
 export default function useAdvanced() {
 	const [voice, setVoice] = createSignal<string>('enabled');
@@ -12,6 +14,7 @@ export default function useAdvanced() {
 	const [ragKeyModel, setRagKeyModel] = createSignal<string>('enabled');
 	const [topK, setTopK] = createSignal<number>(5);
 	const [embeddingSize, setEmbeddingSize] = createSignal<number>(1536);
+	const [embeddingModel, setEmbeddingModel] = createSignal<string>(DEFAULT_EMBEDDING_MODEL);
 	const [contextSize, setContextSize] = createSignal<number>(8192);
 	const [watchRagDirectories, setWatchRagDirectories] = createSignal<boolean>(true);
 	const [gpuAcceleration, setGpuAcceleration] = createSignal<boolean>(true);
@@ -57,6 +60,7 @@ export default function useAdvanced() {
 		const storedRagKeyModel = await getStoreValue('ragKeyModel');
 		const storedTopK = await getStoreValue('topK');
 		const storedEmbeddingSize = await getStoreValue('embeddingSize');
+		const storedEmbeddingModel = await getStoreValue('embeddingModel');
 		const storedContextSize = await getStoreValue('contextSize');
 		const storedWatchRagDirectories = await getStoreValue('watchRagDirectories');
 		const storedGpuAcceleration = await getStoreValue('gpuAcceleration');
@@ -70,12 +74,14 @@ export default function useAdvanced() {
 		storedRagKeyModel && typeof storedRagKeyModel === 'string' && setRagKeyModel(storedRagKeyModel);
 		storedTopK && typeof storedTopK === 'number' && setTopK(storedTopK);
 		storedEmbeddingSize && typeof storedEmbeddingSize === 'number' && setEmbeddingSize(storedEmbeddingSize);
+		storedEmbeddingModel && typeof storedEmbeddingModel === 'string' && setEmbeddingModel(storedEmbeddingModel);
 		storedContextSize && typeof storedContextSize === 'number' && setContextSize(storedContextSize);
 		typeof storedWatchRagDirectories === 'boolean' && setWatchRagDirectories(storedWatchRagDirectories);
 		typeof storedGpuAcceleration === 'boolean' && setGpuAcceleration(storedGpuAcceleration);
 	});
 
 	const saveSettings = async () => {
+		const previousEmbeddingModel = (await getStoreValue<string>('embeddingModel')) || DEFAULT_EMBEDDING_MODEL;
 		await setStoreValue('voice', voice());
 		await setStoreValue('chatModel', chatModel());
 		await setStoreValue('transcriptMode', transcriptMode());
@@ -83,9 +89,22 @@ export default function useAdvanced() {
 		await setStoreValue('ragKeyModel', ragKeyModel());
 		await setStoreValue('topK', topK());
 		await setStoreValue('embeddingSize', embeddingSize());
+		await setStoreValue('embeddingModel', embeddingModel());
 		await setStoreValue('contextSize', contextSize());
 		await setStoreValue('watchRagDirectories', watchRagDirectories());
 		await setStoreValue('gpuAcceleration', gpuAcceleration());
+
+		if (embeddingModel() !== previousEmbeddingModel) {
+			// The RAG server reads the model from the store, and re-embeds every collection in the background
+			await saveStore();
+			try {
+				const response = await fetch('http://localhost:5001/embedding-model', { method: 'POST' });
+				if (!response.ok) console.error('Embedding model switch refused:', await response.text());
+			} catch (error) {
+				// Not running: it switches to the saved model on its next start
+				console.error('Failed to reach the RAG server:', error);
+			}
+		}
 	};
 
 	return {
@@ -104,6 +123,8 @@ export default function useAdvanced() {
 		setTopK,
 		embeddingSize,
 		setEmbeddingSize,
+		embeddingModel,
+		setEmbeddingModel,
 		contextSize,
 		setContextSize,
 		gpuAcceleration,
@@ -13,6 +13,7 @@ export default function Advanced() {
     ragKeyModel, setRagKeyModel,
     topK, setTopK,
     embeddingSize, setEmbeddingSize,
+    embeddingModel, setEmbeddingModel,
     contextSize, setContextSize,
     gpuAcceleration, toggleGpuAcceleration,
     watchRagDirectories, toggleWatchRagDirectories, saveSettings
@@ -145,6 +146,22 @@ export default function Advanced() {
             id="topk-input"
           />
 
+          {/* Embedding Model */}
+          <label class="block mb-4">
+            <span class="text-gray-500">Embedding Model</span>
+          </label>
+          <SelectInput
+            options={[
+              { value: "all-MiniLM-L6-v2", label: "MiniLM" },
+              { value: "BAAI/bge-small-en-v1.5", label: "BGE Small" },
+              { value: "all-mpnet-base-v2", label: "MPNet" },
+            ]}
+            selected={embeddingModel()}
+            onChange={setEmbeddingModel}
+            class="w-full"
+            id="embedding-model-selector"
+          />
+
           {/* Embedding Size */}
           <label class="block mb-4">
             <span class="text-gray-500">Embeddings Size</span>